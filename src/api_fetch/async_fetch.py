@@ -0,0 +1,362 @@
+"""
+async_fetch.py
+
+Asyncio fetch engine for the Mapillary Graph API.
+
+- MAX_INFLIGHT_TILES workers take tiles from a shared queue and paginate them
+  (pagination inside one tile stays sequential, it follows the `after` cursor)
+- A shared TokenBucket (RATE_LIMIT_RPS + RATE_BURST) decides when a request
+  may be sent, so wall time scales with the allowed request rate instead of
+  with the number of worker threads. With ADAPTIVE_RATE the bucket is an
+  AIMD controller fed by every response (rate_control.py); its rate and wait
+  time are logged as [RATE] lines every RATE_MONITOR_INTERVAL seconds
+- With TILING_MODE = "quadtree", dense or timed-out tiles are split into
+  quadrants and pushed back onto the queue (see tiling.py)
+- Every tile is checkpointed in a per-project fetch manifest (manifest.py):
+  status, last `after` cursor and the pages it produced. An interrupted run
+  resumes each tile from its last cursor and loses at most one page.
+- Pages are named per tile (tile id + page number within the tile),
+  so names do not depend on which task finished first
+- refresh=True re-queries every fetched tile with start_captured_at set to its
+  last fetch time minus REFRESH_OVERLAP_DAYS, so only new images are pulled
+- With RAW_STORE, pages are appended to the compact raw store
+  (src/preprocess/raw_store.py) instead of one JSON file per page
+
+Configuration lives in fetch_images.py; values are read at call time.
+Entry point: fetch_images_async(raw_dir, bbox)
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import aiohttp
+
+from src.api_fetch import fetch_images as fi
+from src.api_fetch import tiling
+from src.api_fetch import manifest as mf
+from src.api_fetch.rate_control import TokenBucket, AdaptiveRateController, format_stats
+from src.preprocess.raw_store import RawStore
+
+
+class TileTimeout(Exception):
+    """First request of a splittable tile timed out: split instead of retrying."""
+
+
+# ================== Request with retry (429 / 5xx / timeout with backoff) ==================
+
+async def _request_with_retry_async(
+    session: aiohttp.ClientSession,
+    bucket: TokenBucket,
+    params: dict,
+    split_on_timeout: bool = False,
+):
+    last_err = None
+
+    for attempt in range(1, fi.MAX_RETRIES + 1):
+        await bucket.acquire()
+        t0 = time.monotonic()
+        try:
+            async with session.get(fi.BASE_URL, params=params) as resp:
+                # Latency signal = time to the response headers: reading a full 2000-item body
+                # takes longer without the server being congested
+                latency_s = time.monotonic() - t0
+                if resp.status == 429 or 500 <= resp.status < 600:
+                    bucket.on_throttle(str(resp.status))
+                    retry_after = resp.headers.get("Retry-After")
+                    sleep_s = float(retry_after) if retry_after else (fi.BACKOFF_BASE_SECONDS * (2 ** (attempt - 1)))
+                    print(f"[WARN] Status {resp.status}, retry {attempt}/{fi.MAX_RETRIES} after {sleep_s:.1f}s")
+                    await asyncio.sleep(sleep_s)
+                    continue
+
+                resp.raise_for_status()
+                data = await resp.json(content_type=None)
+                bucket.on_success(latency_s)
+                return data
+
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError as e:
+            bucket.on_throttle("timeout")
+            if split_on_timeout:
+                raise TileTimeout(str(e) or "timeout") from e
+            last_err = e
+            sleep_s = fi.BACKOFF_BASE_SECONDS * (2 ** (attempt - 1))
+            print(f"[WARN] Request timed out, retry {attempt}/{fi.MAX_RETRIES} after {sleep_s:.1f}s")
+            await asyncio.sleep(sleep_s)
+        except Exception as e:
+            last_err = e
+            sleep_s = fi.BACKOFF_BASE_SECONDS * (2 ** (attempt - 1))
+            print(f"[WARN] Request failed: {e!r}, retry {attempt}/{fi.MAX_RETRIES} after {sleep_s:.1f}s")
+            await asyncio.sleep(sleep_s)
+
+    raise RuntimeError(f"Request failed after {fi.MAX_RETRIES} retries: {last_err!r}")
+
+
+# ================== Tile pagination ==================
+
+def _tile_id(tile_bbox: str) -> str:
+    return hashlib.sha1(tile_bbox.encode("utf-8")).hexdigest()[:12]
+
+
+def _page_name(big_bbox_safe: str, tile_bbox: str, page_no: int) -> str:
+    return f"images_bbox_{big_bbox_safe}_limit{fi.LIMIT}_tile{_tile_id(tile_bbox)}_page{page_no}.json"
+
+
+def _write_page(out_path: Path, data: dict):
+    """Atomic write: a page file is either complete or absent."""
+    tmp = out_path.with_suffix(out_path.suffix + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, out_path)
+
+
+class _FetchRun:
+    """State shared by all workers of one fetch run (single event loop, no locks needed)."""
+
+    def __init__(self, raw_dir: Path, big_bbox_safe: str, session, bucket, tree, manifest: mf.FetchManifest, store, on_page=None):
+        self.raw_dir = raw_dir
+        self.store = store
+        self.on_page = on_page
+        self.big_bbox_safe = big_bbox_safe
+        self.session = session
+        self.bucket = bucket
+        self.tree = tree
+        self.manifest = manifest
+        self.queue = asyncio.Queue()
+        self.pages_written = 0
+        self.tile_index = 0
+        self.failed = 0
+
+    def enqueue(self, tile_bbox: str, depth: int):
+        self.tile_index += 1
+        self.queue.put_nowait((self.tile_index, tile_bbox, depth))
+
+
+def _iso_utc(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _split_tile(run: _FetchRun, tile_index: int, tile_bbox: str, depth: int, reason: str):
+    print(f"[INFO] TILE {tile_index} {reason}, splitting into quadrants (depth {depth + 1})")
+    children = tiling.split_bbox(tile_bbox)
+    # Children are registered before the parent is closed, so a crash in between re-runs the parent
+    since = run.manifest.tiles[tile_bbox].get("since")
+    for child in children:
+        run.manifest.add(child, depth + 1, since=since)
+    run.manifest.finish(tile_bbox, mf.STATUS_SPLIT)
+    run.tree.mark(tile_bbox, depth, tiling.STATUS_SPLIT)
+    for child in children:
+        run.enqueue(child, depth + 1)
+
+
+async def _process_one_tile_async(run: _FetchRun, tile_index: int, tile_bbox: str, depth: int):
+    """Fetch one tile. Pagination inside a tile must remain sequential."""
+    params = {
+        "access_token": fi.ACCESS_TOKEN,
+        "bbox": tile_bbox,
+        "fields": fi.FIELDS,
+        "limit": fi.LIMIT,
+    }
+    entry = run.manifest.tiles[tile_bbox]
+    page_no = len(entry["pages"])
+    if entry.get("since"):
+        params["start_captured_at"] = _iso_utc(entry["since"])
+    if entry.get("after"):
+        params["after"] = entry["after"]
+        print(f"[RESUME] TILE {tile_index} continuing after page {page_no}")
+
+    # Split decisions are only taken on the first page of a fresh tile
+    first_page = page_no == 0
+    splittable = run.tree is not None and tiling.can_split(tile_bbox, depth)
+
+    print(f"[INFO] TILE {tile_index} bbox={tile_bbox} depth={depth}")
+    started = time.time()
+    run.manifest.start(tile_bbox)
+
+    while True:
+        try:
+            data = await _request_with_retry_async(
+                run.session, run.bucket, params, split_on_timeout=splittable and first_page
+            )
+        except TileTimeout:
+            _split_tile(run, tile_index, tile_bbox, depth, "timed out")
+            return
+        except Exception as e:
+            print(f"[ERROR] TILE {tile_index} failed, skipping tile. Error: {e}")
+            run.manifest.finish(tile_bbox, mf.STATUS_FAILED, error=str(e))
+            run.failed += 1
+            return
+
+        items = data.get("data", [])
+
+        if first_page and run.tree is not None:
+            # Full first page: the tile is dense, its quadrants page faster.
+            # The page is dropped; the children cover the same area without overlap.
+            if splittable and len(items) >= fi.LIMIT:
+                _split_tile(run, tile_index, tile_bbox, depth, f"is dense ({len(items)} records)")
+                return
+            # Empty tile: the whole subtree is empty, nothing to save
+            if not items:
+                run.manifest.finish(tile_bbox, mf.STATUS_EMPTY, fetched_at=started)
+                run.tree.mark(tile_bbox, depth, tiling.STATUS_EMPTY)
+                print(f"[INFO] TILE {tile_index} is empty")
+                return
+        first_page = False
+
+        after_cursor = data.get("paging", {}).get("cursors", {}).get("after")
+
+        # Refresh passes mostly return nothing new: no empty pages in the raw data
+        if items:
+            page_no += 1
+            page_name = _page_name(run.big_bbox_safe, tile_bbox, page_no)
+            if run.store is not None:
+                await asyncio.to_thread(run.store.append_page, page_name, items)
+            else:
+                await asyncio.to_thread(_write_page, run.raw_dir / page_name, data)
+
+            run.manifest.record_page(tile_bbox, page_name, len(items), after_cursor)
+            run.pages_written += 1
+
+            print(f"[INFO] Page {page_name}: saved {len(items)} records (from tile {tile_index})")
+            if run.on_page is not None:
+                run.on_page(items)
+
+        if not after_cursor:
+            break
+        params["after"] = after_cursor
+
+    run.manifest.finish(tile_bbox, mf.STATUS_DONE, fetched_at=started)
+    if run.tree is not None:
+        run.tree.mark(tile_bbox, depth, tiling.STATUS_LEAF, run.manifest.tiles[tile_bbox]["count"])
+
+
+async def _tile_worker(run: _FetchRun):
+    while True:
+        tile_index, tile_bbox, depth = await run.queue.get()
+        try:
+            await _process_one_tile_async(run, tile_index, tile_bbox, depth)
+        except Exception as e:
+            print(f"[ERROR] Tile worker exception: {e!r}")
+            run.manifest.finish(tile_bbox, mf.STATUS_FAILED, error=repr(e))
+            run.failed += 1
+        finally:
+            run.queue.task_done()
+
+
+# ================== Engine ==================
+
+def _make_bucket() -> TokenBucket:
+    if fi.ADAPTIVE_RATE:
+        return AdaptiveRateController(
+            rate=fi.RATE_LIMIT_RPS,
+            burst=fi.RATE_BURST,
+            min_rate=fi.RATE_MIN_RPS,
+            max_rate=fi.RATE_MAX_RPS,
+            increase=fi.RATE_INCREASE_RPS,
+            decrease_factor=fi.RATE_DECREASE_FACTOR,
+            latency_rise_factor=fi.LATENCY_RISE_FACTOR,
+        )
+    return TokenBucket(fi.RATE_LIMIT_RPS, fi.RATE_BURST)
+
+
+async def _rate_monitor(bucket: TokenBucket):
+    while True:
+        await asyncio.sleep(fi.RATE_MONITOR_INTERVAL)
+        print(f"[RATE] {format_stats(bucket.stats())}")
+
+
+async def _fetch_images_core_async(raw_dir: Path, bbox: str, on_page=None, refresh=False):
+    raw_dir.mkdir(parents=True, exist_ok=True)
+
+    big_bbox = bbox
+    big_bbox_safe = big_bbox.replace(",", "_")
+
+    tree = None
+    if fi.TILING_MODE == "quadtree":
+        tree = tiling.TileTree.load(tiling.tile_tree_path(raw_dir, big_bbox_safe), big_bbox)
+        if tree.nodes:
+            print(f"[RESUME] Reusing learned tile tree: {tree.summary()}")
+
+    manifest = mf.FetchManifest.load(mf.manifest_path(raw_dir, big_bbox_safe), big_bbox)
+    if refresh:
+        if manifest.tiles:
+            reopened = manifest.begin_refresh(fi.REFRESH_OVERLAP_DAYS * 86400)
+            print(f"[REFRESH] Re-querying {reopened} tiles for images captured since their last fetch "
+                  f"(overlap {fi.REFRESH_OVERLAP_DAYS} days)")
+        else:
+            print("[REFRESH] No previous fetch manifest, running a full fetch")
+    if manifest.tiles:
+        tiles = manifest.unfinished()
+        print(f"[RESUME] Manifest found: {manifest.summary()}")
+        if not tiles:
+            print(f"[RESUME] All tiles already fetched. Delete {manifest.path.name} to refetch from scratch.")
+            return
+        if not refresh and not fi.ONLY_FAILED_TILES:
+            print(f"[WARN] ONLY_FAILED_TILES=False is ignored by the async engine, it resumes the unfinished "
+                  f"tiles of the manifest. Delete {manifest.path.name} to refetch all tiles.")
+    else:
+        if tree is not None:
+            tiles = tree.expand([(t, 0) for t in tiling.root_tiles(big_bbox)])
+        else:
+            grid = fi._tile_bboxes(big_bbox, tile_size=fi.TILE_SIZE_DEG, overlap_ratio=fi.TILE_OVERLAP_RATIO)
+            tiles = [(t, 0) for t in grid]
+        for tile_bbox, depth in tiles:
+            manifest.add(tile_bbox, depth)
+        manifest.save()
+
+    print(f"[FETCH_IMAGES_VERSION] engine=async timeout={fi.REQUEST_TIMEOUT} LIMIT={fi.LIMIT} file={__file__}")
+    print(f"[FETCH_IMAGES_VERSION] rate={fi.RATE_LIMIT_RPS}/s burst={fi.RATE_BURST} adaptive={fi.ADAPTIVE_RATE} "
+          f"inflight_tiles={fi.MAX_INFLIGHT_TILES} tiling={fi.TILING_MODE}")
+    print(f"[INFO] Starting Mapillary fetch (async mode), big_bbox={big_bbox}")
+    print(f"[INFO] Processing {len(tiles)} initial tiles")
+
+    bucket = _make_bucket()
+    timeout = aiohttp.ClientTimeout(total=fi.REQUEST_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=fi.MAX_INFLIGHT_TILES)
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        store = RawStore.open(raw_dir) if fi.RAW_STORE else None
+        run = _FetchRun(raw_dir, big_bbox_safe, session, bucket, tree, manifest, store, on_page)
+        for tile_bbox, depth in tiles:
+            run.enqueue(tile_bbox, depth)
+
+        workers = [asyncio.create_task(_tile_worker(run)) for _ in range(fi.MAX_INFLIGHT_TILES)]
+        workers.append(asyncio.create_task(_rate_monitor(bucket)))
+        try:
+            await run.queue.join()
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            manifest.save()
+            if tree is not None:
+                tree.save()
+
+    if run.failed:
+        print(f"[WARN] {run.failed} tiles failed in this run; rerun to resume them from their last cursor")
+    else:
+        print("[INFO] No failed tiles in this run")
+
+    if tree is not None:
+        print(f"[INFO] Tile tree: {tree.summary()} -> {tree.path.name}")
+    print(f"[INFO] Manifest: {manifest.summary()} -> {manifest.path.name}")
+    print(f"[RATE] final {format_stats(bucket.stats())}")
+    if run.store is not None:
+        print(f"[INFO] Raw store: {run.store.totals()} -> {run.store.root}")
+    print(f"[DONE] Fetch completed. Pages written in this run: {run.pages_written} "
+          f"(IDs may overlap across tiles; deduplicate by id during parsing)")
+
+
+def fetch_images_async(raw_dir, bbox: str, on_page=None, refresh=False):
+    """
+    Synchronous wrapper, safe to call from FastAPI's threadpool or the CLI.
+
+    on_page: optional callback(items), called after each page is persisted.
+    refresh: incremental pass over an already fetched bbox (see module docstring).
+    """
+    asyncio.run(_fetch_images_core_async(Path(raw_dir), bbox, on_page, refresh))
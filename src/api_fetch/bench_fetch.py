@@ -0,0 +1,152 @@
+"""
+bench_fetch.py
+
+Fetch benchmark against the local mock API (mock_server.py).
+
+Starts a MockMapillary server, points fetch_images.BASE_URL at it, runs one
+fetch engine into a temporary raw_dir and reports:
+    wall time, requests/s, records/s, retries (429 / timeouts / errors),
+    pages, unique images fetched, coverage of the images in the bbox and the
+    share of served records that were redundant (tile overlap, dropped dense pages).
+
+Examples:
+    python -m src.api_fetch.bench_fetch
+    python -m src.api_fetch.bench_fetch --engine threads --tiling grid
+    python -m src.api_fetch.bench_fetch --points 200000 --max-rps 30 --timeout-over-records 5000 --json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from src.api_fetch import fetch_images as fi
+from src.api_fetch.mock_server import add_mock_arguments, mock_from_args
+from src.preprocess import parse_json
+
+
+def _fetched_ids(raw_dir: Path) -> set:
+    ids = set()
+    stats = parse_json._new_stats()
+    for _, items in parse_json._iter_raw_pages(raw_dir, stats):
+        for item in items:
+            if item.get("id"):
+                ids.add(str(item["id"]))
+    return ids
+
+
+def run_benchmark(mock, bbox: str, overrides: dict, quiet: bool = True, keep_dir: Path = None) -> dict:
+    """
+    Run one fetch against a started mock server.
+
+    overrides: fetch_images module constants to set for this run (restored afterwards).
+    """
+    saved = {k: getattr(fi, k) for k in overrides}
+    saved["BASE_URL"] = fi.BASE_URL
+    raw_dir = Path(keep_dir) if keep_dir else Path(tempfile.mkdtemp(prefix="bench_fetch_")) / "raw"
+
+    try:
+        for k, v in overrides.items():
+            setattr(fi, k, v)
+        fi.BASE_URL = f"{mock.base_url}/images"
+
+        before = dict(mock.stats)
+        out = io.StringIO()
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext():
+            fi._run_engine(raw_dir, bbox)
+        wall = time.perf_counter() - t0
+
+        delta = {k: mock.stats[k] - before.get(k, 0) for k in mock.stats}
+        with contextlib.redirect_stdout(out) if quiet else contextlib.nullcontext():
+            ids = _fetched_ids(raw_dir)
+        expected = mock.count_in_bbox(bbox)
+        return {
+            "engine": fi.FETCH_ENGINE,
+            "tiling": fi.TILING_MODE,
+            "wall_s": round(wall, 3),
+            "requests": delta["requests"],
+            "requests_per_s": round(delta["requests"] / wall, 2) if wall else 0.0,
+            "records_served": delta["records_served"],
+            "records_per_s": round(delta["records_served"] / wall, 1) if wall else 0.0,
+            "retries": delta["requests"] - delta["ok"],
+            "http_429": delta["http_429"],
+            "timeouts": delta["timeouts"],
+            "bad_request": delta["bad_request"],
+            "pages_ok": delta["ok"],
+            "unique_images": len(ids),
+            "expected_images": expected,
+            "coverage": round(len(ids) / expected, 4) if expected else 1.0,
+            "redundant_ratio": round(1 - len(ids) / delta["records_served"], 4) if delta["records_served"] else 0.0,
+        }
+    finally:
+        for k, v in saved.items():
+            setattr(fi, k, v)
+        if not keep_dir:
+            shutil.rmtree(raw_dir.parent, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Mapillary fetch engines against a local mock API")
+    add_mock_arguments(parser)
+    g = parser.add_argument_group("fetch engine")
+    g.add_argument("--engine", choices=["async", "threads"], default=fi.FETCH_ENGINE)
+    g.add_argument("--tiling", choices=["quadtree", "grid"], default=fi.TILING_MODE)
+    g.add_argument("--limit", type=int, default=fi.LIMIT)
+    g.add_argument("--rate", type=float, default=fi.RATE_LIMIT_RPS, help="Token bucket (start) rate")
+    g.add_argument("--burst", type=float, default=fi.RATE_BURST)
+    g.add_argument("--no-adaptive", action="store_true", help="Fixed token bucket instead of AIMD")
+    g.add_argument("--inflight-tiles", type=int, default=fi.MAX_INFLIGHT_TILES)
+    g.add_argument("--tile-workers", type=int, default=fi.MAX_TILE_WORKERS)
+    g.add_argument("--interval", type=float, default=fi.REQUEST_INTERVAL, help="Threaded engine request interval")
+    g.add_argument("--request-timeout", type=float, default=10.0)
+    g.add_argument("--max-retries", type=int, default=fi.MAX_RETRIES)
+    g.add_argument("--backoff", type=float, default=0.2)
+    g.add_argument("--no-raw-store", action="store_true")
+    g.add_argument("--keep-dir", default=None, help="Keep raw output in this directory")
+    g.add_argument("--verbose", action="store_true", help="Show fetch logs")
+    g.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args()
+
+    overrides = {
+        "FETCH_ENGINE": args.engine,
+        "TILING_MODE": args.tiling,
+        "LIMIT": args.limit,
+        "RATE_LIMIT_RPS": args.rate,
+        "RATE_BURST": args.burst,
+        "ADAPTIVE_RATE": not args.no_adaptive,
+        "MAX_INFLIGHT_TILES": args.inflight_tiles,
+        "MAX_TILE_WORKERS": args.tile_workers,
+        "REQUEST_INTERVAL": args.interval,
+        "REQUEST_TIMEOUT": args.request_timeout,
+        "MAX_RETRIES": args.max_retries,
+        "BACKOFF_BASE_SECONDS": args.backoff,
+        "RAW_STORE": not args.no_raw_store,
+    }
+
+    mock = mock_from_args(args)
+    mock.start()
+    try:
+        result = run_benchmark(mock, args.bbox, overrides, quiet=not args.verbose, keep_dir=args.keep_dir)
+    finally:
+        mock.stop()
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f"[BENCH] engine={result['engine']} tiling={result['tiling']}")
+    print(f"[BENCH] wall {result['wall_s']:.2f}s | {result['requests']} requests ({result['requests_per_s']}/s) | "
+          f"{result['records_served']} records ({result['records_per_s']}/s)")
+    print(f"[BENCH] retries {result['retries']} (429: {result['http_429']}, timeouts: {result['timeouts']}, "
+          f"bad: {result['bad_request']})")
+    print(f"[BENCH] images {result['unique_images']} / {result['expected_images']} "
+          f"(coverage {result['coverage']:.2%}, redundant records {result['redundant_ratio']:.2%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,12 @@ and save each page of JSON results into the data/raw/ directory.
 
 This file can be used in two ways:
 1) Called by FastAPI: run_fetch_images(project_dir)
-2) Run as a standalone script: python src/api_fetch/fetch_images.py
+2) Run as a standalone script: python -m src.api_fetch.fetch_images
+
+Two fetch engines are available (see FETCH_ENGINE):
+- "async":   asyncio engine in async_fetch.py, token-bucket rate limit,
+             many tiles paginated concurrently (default)
+- "threads": original ThreadPoolExecutor engine in this file
 """
 
 import json
@@ -26,7 +31,7 @@ ACCESS_TOKEN = "MLY|25127541310273769|fe32f1ed00dec71d413c5f9cb19005d7"
 # west,south,east,north
 DEFAULT_BBOX = "6.865833,52.205278,6.917778,52.233889"
 
-FIELDS = "id,thumb_2048_url,computed_geometry"
+FIELDS = "id,thumb_256_url,thumb_1024_url,thumb_2048_url,computed_geometry"
 
 # ✅ Mapillary max limit per request
 LIMIT = 2000
@@ -54,15 +59,58 @@ REQUEST_TIMEOUT = 120
 # ✅ Tile-level concurrency
 MAX_TILE_WORKERS = 3
 
-# ✅ Record failed tiles
+# ✅ Record failed tiles (threaded engine; the async engine keeps tile state in its fetch manifest)
 WRITE_FAILED_TILES = True
 
-# ✅ Resume mode: only retry failed tiles (recommended True)
+# ✅ Resume mode: only retry failed tiles (recommended True, threaded engine;
+#    the async engine always resumes only the unfinished tiles of its manifest and warns if this is False)
 ONLY_FAILED_TILES = True
 
 # ✅ Reuse HTTP connections (faster and more stable)
 SESSION = requests.Session()
 
+# ====== Fetch engine ======
+# "async":   asyncio + token bucket (async_fetch.py), fetch time scales with the allowed request rate
+# "threads": legacy ThreadPoolExecutor engine below (MAX_TILE_WORKERS + REQUEST_INTERVAL)
+FETCH_ENGINE = "async"
+
+# ✅ Token bucket: sustained requests per second + burst capacity (async engine)
+# With ADAPTIVE_RATE, RATE_LIMIT_RPS is only the starting rate
+RATE_LIMIT_RPS = 10.0
+RATE_BURST = 20
+
+# ====== AIMD adaptive rate control (async engine) ======
+# Rate grows additively while responses are healthy and is cut
+# multiplicatively on 429 / 5xx / timeouts / rising latency
+ADAPTIVE_RATE = True
+RATE_MIN_RPS = 1.0
+RATE_MAX_RPS = 50.0
+RATE_INCREASE_RPS = 0.5       # Additive increase (req/s gained per second of healthy traffic)
+RATE_DECREASE_FACTOR = 0.5    # Multiplicative decrease on congestion
+LATENCY_RISE_FACTOR = 2.0     # Latency EWMA above baseline x this counts as congestion
+RATE_MONITOR_INTERVAL = 10.0  # Seconds between [RATE] log lines
+
+# ✅ Number of tiles paginated concurrently (async engine)
+MAX_INFLIGHT_TILES = 32
+
+# ====== Adaptive quadtree tiling (async engine) ======
+# "quadtree": split dense / timed-out tiles into quadrants, skip empty subtrees,
+#             learned tree is persisted in raw_dir and reused by later runs
+# "grid":     fixed TILE_SIZE_DEG grid with TILE_OVERLAP_RATIO
+TILING_MODE = "quadtree"
+QUADTREE_ROOT_DEG = 0.04        # Root tile size (no overlap)
+QUADTREE_MIN_TILE_DEG = 0.0025  # Tiles are never split below this size; they are paginated instead
+QUADTREE_MAX_DEPTH = 6
+
+# ✅ Refresh mode (run_fetch_images(..., refresh=True), async engine):
+# every fetched tile is re-queried with start_captured_at = last fetch - overlap.
+# The overlap absorbs the delay between capture and upload of new sequences.
+REFRESH_OVERLAP_DAYS = 30
+
+# ✅ Append pages to the compact raw store (data/raw/store, gzip NDJSON + index, ids deduplicated)
+# instead of one images_bbox_*.json file per page (async engine)
+RAW_STORE = True
+
 # ===========================================
 
 
@@ -251,6 +299,7 @@ def _process_one_tile(
     page_counter: dict,
     failed_tiles: list,
     failed_lock: threading.Lock,
+    on_page=None,
 ):
     """Fetch one tile. Pagination inside a tile must remain sequential."""
     after_cursor = None
@@ -290,6 +339,8 @@ def _process_one_tile(
             json.dump(data, f, ensure_ascii=False)
 
         print(f"[INFO] Page {current_page}: saved {len(items)} records (from tile {tile_index})")
+        if on_page is not None:
+            on_page(items)
 
         paging = data.get("paging", {})
         after_cursor = paging.get("cursors", {}).get("after")
@@ -346,17 +397,22 @@ def _merge_failed_tiles(old_list: list, new_list: list) -> list:
     return sorted(merged.values(), key=_key)
 
 
-def _fetch_images_core(raw_dir: Path, bbox: str):
-    raw_dir.mkdir(parents=True, exist_ok=True)
-
-    big_bbox = bbox
-    big_bbox_safe = big_bbox.replace(",", "_")
-
+def _plan_tiles(raw_dir: Path, big_bbox: str, big_bbox_safe: str):
+    """
+    Resume logic of the threaded engine (failed_tiles_bbox_*.json + ONLY_FAILED_TILES)
+    over the fixed TILE_SIZE_DEG grid. The async engine resumes from its fetch
+    manifest instead (async_fetch.py).
+
+    Returns:
+        (tiles, prev_failed, resume_from)
+        tiles:       tile bboxes to fetch in this run
+        prev_failed: failed tile records from previous runs
+        resume_from: highest existing page number in raw_dir
+    """
     all_tiles = _tile_bboxes(big_bbox, tile_size=TILE_SIZE_DEG, overlap_ratio=TILE_OVERLAP_RATIO)
 
     resume_from = _resume_page_from_raw(raw_dir, big_bbox_safe)
-    page_counter = {"page": resume_from}
-    print(f"[RESUME] Resuming from page {page_counter['page'] + 1} (max existing page={resume_from})")
+    print(f"[RESUME] Resuming from page {resume_from + 1} (max existing page={resume_from})")
 
     prev_failed = _load_failed_tiles(raw_dir, big_bbox_safe)
     if prev_failed:
@@ -370,6 +426,31 @@ def _fetch_images_core(raw_dir: Path, bbox: str):
         if ONLY_FAILED_TILES and not prev_failed:
             print("[RESUME] ONLY_FAILED_TILES=True, but no failed tiles found. Fetching all tiles.")
 
+    return tiles, prev_failed, resume_from
+
+
+def _write_failed_tiles(raw_dir: Path, big_bbox_safe: str, prev_failed: list, failed_tiles: list):
+    if not WRITE_FAILED_TILES:
+        return
+    merged_failed = _merge_failed_tiles(prev_failed, failed_tiles)
+    if merged_failed:
+        fail_path = _failed_tiles_path(raw_dir, big_bbox_safe)
+        with fail_path.open("w", encoding="utf-8") as f:
+            json.dump(merged_failed, f, ensure_ascii=False, indent=2)
+        print(f"[WARN] Failed tile records written ({len(merged_failed)} entries): {fail_path}")
+    else:
+        print("[INFO] No failed tiles in this run")
+
+
+def _fetch_images_core(raw_dir: Path, bbox: str, on_page=None):
+    raw_dir.mkdir(parents=True, exist_ok=True)
+
+    big_bbox = bbox
+    big_bbox_safe = big_bbox.replace(",", "_")
+
+    tiles, prev_failed, resume_from = _plan_tiles(raw_dir, big_bbox, big_bbox_safe)
+    page_counter = {"page": resume_from}
+
     print(f"[INFO] Starting Mapillary fetch (tile concurrency mode), big_bbox={big_bbox}")
     print(f"[INFO] Processing {len(tiles)} tiles (tile_size={TILE_SIZE_DEG}, overlap={TILE_OVERLAP_RATIO}), workers={MAX_TILE_WORKERS}")
 
@@ -389,6 +470,7 @@ def _fetch_images_core(raw_dir: Path, bbox: str):
                     page_counter,
                     failed_tiles,
                     failed_lock,
+                    on_page,
                 )
             )
 
@@ -398,30 +480,40 @@ def _fetch_images_core(raw_dir: Path, bbox: str):
             except Exception as e:
                 print(f"[ERROR] Tile worker exception: {e}")
 
-    if WRITE_FAILED_TILES:
-        merged_failed = _merge_failed_tiles(prev_failed, failed_tiles)
-        if merged_failed:
-            fail_path = _failed_tiles_path(raw_dir, big_bbox_safe)
-            with fail_path.open("w", encoding="utf-8") as f:
-                json.dump(merged_failed, f, ensure_ascii=False, indent=2)
-            print(f"[WARN] Failed tile records written ({len(merged_failed)} entries): {fail_path}")
-        else:
-            print("[INFO] No failed tiles in this run")
+    _write_failed_tiles(raw_dir, big_bbox_safe, prev_failed, failed_tiles)
 
     print(f"[DONE] Fetch completed. Total pages: {page_counter['page']} "
           f"(IDs may overlap across tiles; deduplicate by id during parsing)")
 
 
-def run_fetch_images(project_dir):
+def run_fetch_images(project_dir, on_page=None, refresh=False):
+    """
+    on_page: optional callback(items), called from the fetch thread
+             after each page has been saved (used by the streaming pipeline).
+    refresh: only fetch images captured since each tile's last fetch
+             (async engine, needs the fetch manifest of a previous run).
+    """
     project_dir = Path(project_dir)
     raw_dir = project_dir / "data" / "raw"
     bbox = _resolve_bbox_from_project(project_dir)
-    _fetch_images_core(raw_dir, bbox)
+    _run_engine(raw_dir, bbox, on_page, refresh)
+
+
+def _run_engine(raw_dir: Path, bbox: str, on_page=None, refresh=False):
+    """Dispatch to the configured fetch engine."""
+    if FETCH_ENGINE == "async":
+        # Lazy import: aiohttp is only needed by the async engine
+        from src.api_fetch import async_fetch
+        async_fetch.fetch_images_async(raw_dir, bbox, on_page, refresh)
+    else:
+        if refresh:
+            raise ValueError('Refresh mode requires FETCH_ENGINE = "async"')
+        _fetch_images_core(raw_dir, bbox, on_page)
 
 
 def _cli_default():
     print("[INFO] Running fetch_images.py as a standalone script using GLOBAL_RAW_DIR and DEFAULT_BBOX")
-    _fetch_images_core(GLOBAL_RAW_DIR, DEFAULT_BBOX)
+    _run_engine(GLOBAL_RAW_DIR, DEFAULT_BBOX)
 
 
 if __name__ == "__main__":
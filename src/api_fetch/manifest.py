@@ -0,0 +1,180 @@
+"""
+manifest.py
+
+Per-project fetch manifest: checkpoint of every tile of one bbox fetch.
+
+For each tile the manifest records
+    - status: pending | in_progress | done | empty | split | failed
+    - depth:  quadtree depth of the tile
+    - after:  last `after` cursor returned by the API (resume point)
+    - pages:  raw page files produced so far (in order)
+    - count:  records saved so far
+    - error:  last error (failed tiles only)
+    - fetched_at: unix time at which the last successful pass over the tile started
+    - since:  refresh passes only: lower bound (unix time) for captured_at
+
+Storage (in raw_dir):
+    fetch_manifest_bbox_{bbox}.json   snapshot, replaced atomically (tmp + os.replace)
+    fetch_manifest_bbox_{bbox}.jsonl  journal, one line appended and flushed per change
+
+Every page is written before its journal line, so an interrupted fetch
+loses at most the page that was in flight. On load, the journal is replayed
+on top of the snapshot (a torn last line is ignored). The journal is folded
+into the snapshot every MANIFEST_SNAPSHOT_EVERY events and at the end of a run.
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+
+STATUS_PENDING = "pending"
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_DONE = "done"
+STATUS_EMPTY = "empty"
+STATUS_SPLIT = "split"
+STATUS_FAILED = "failed"
+
+# Tiles that never need another request
+FINAL_STATUSES = {STATUS_DONE, STATUS_EMPTY, STATUS_SPLIT}
+
+MANIFEST_SNAPSHOT_EVERY = 500
+
+
+def manifest_path(raw_dir: Path, big_bbox_safe: str) -> Path:
+    return Path(raw_dir) / f"fetch_manifest_bbox_{big_bbox_safe}.json"
+
+
+def _atomic_write_json(path: Path, data):
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class FetchManifest:
+    def __init__(self, path: Path, big_bbox: str):
+        self.path = Path(path)
+        self.journal_path = self.path.with_suffix(".jsonl")
+        self.big_bbox = big_bbox
+        self.tiles = {}
+        self._journal = None
+        self._events = 0
+
+    # ---------- Load / save ----------
+
+    @classmethod
+    def load(cls, path: Path, big_bbox: str) -> "FetchManifest":
+        m = cls(path, big_bbox)
+        if m.path.exists():
+            try:
+                data = json.loads(m.path.read_text(encoding="utf-8"))
+                if data.get("bbox") == big_bbox:
+                    m.tiles = data.get("tiles") or {}
+            except Exception as e:
+                print(f"[WARN] Failed to read manifest {m.path}, ignoring snapshot. Error: {e}")
+
+        if m.journal_path.exists():
+            with m.journal_path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        m._apply(json.loads(line))
+                    except Exception:
+                        # Torn last line of an interrupted run
+                        break
+        return m
+
+    def save(self):
+        """Write a snapshot and start a fresh journal."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_write_json(self.path, {"bbox": self.big_bbox, "updated": time.time(), "tiles": self.tiles})
+        self.close()
+        if self.journal_path.exists():
+            self.journal_path.unlink()
+        self._events = 0
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    # ---------- Journal ----------
+
+    def _apply(self, event: dict):
+        entry = self.tiles.setdefault(
+            event["tile"], {"status": STATUS_PENDING, "depth": 0, "after": None, "pages": [], "count": 0}
+        )
+        entry.update(event.get("set") or {})
+        # Idempotent: replaying a journal over a snapshot that already has the page is harmless
+        if event.get("page") and event["page"] not in entry["pages"]:
+            entry["pages"].append(event["page"])
+            entry["count"] += int(event.get("records", 0))
+
+    def _log(self, event: dict):
+        self._apply(event)
+        if self._journal is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._journal = self.journal_path.open("a", encoding="utf-8")
+        self._journal.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        self._events += 1
+        if self._events >= MANIFEST_SNAPSHOT_EVERY:
+            self.save()
+
+    # ---------- Tile state ----------
+
+    def add(self, tile_bbox: str, depth: int, since: float = None):
+        """Register a tile to fetch (no-op if already known)."""
+        if tile_bbox not in self.tiles:
+            fields = {"status": STATUS_PENDING, "depth": depth}
+            if since is not None:
+                fields["since"] = since
+            self._log({"tile": tile_bbox, "set": fields})
+
+    def start(self, tile_bbox: str):
+        self._log({"tile": tile_bbox, "set": {"status": STATUS_IN_PROGRESS}})
+
+    def record_page(self, tile_bbox: str, page_name: str, records: int, after):
+        self._log({"tile": tile_bbox, "set": {"after": after}, "page": page_name, "records": records})
+
+    def finish(self, tile_bbox: str, status: str, error: str = None, fetched_at: float = None):
+        fields = {"status": status}
+        if error is not None:
+            fields["error"] = error
+        if fetched_at is not None:
+            fields["fetched_at"] = fetched_at
+        self._log({"tile": tile_bbox, "set": fields})
+
+    def begin_refresh(self, overlap_s: float) -> int:
+        """
+        Reopen every fetched leaf tile (done / empty) for an incremental pass
+        that only asks for images captured since its last fetch minus overlap_s.
+        Tiles without fetched_at (older manifests) are refetched in full.
+
+        Returns the number of reopened tiles.
+        """
+        n = 0
+        for bbox, entry in list(self.tiles.items()):
+            if entry.get("status") not in (STATUS_DONE, STATUS_EMPTY):
+                continue
+            fetched_at = entry.get("fetched_at")
+            since = fetched_at - overlap_s if fetched_at else None
+            self._log({"tile": bbox, "set": {"status": STATUS_PENDING, "after": None, "since": since}})
+            n += 1
+        return n
+
+    def unfinished(self):
+        """Tiles that still need requests, as (tile_bbox, depth)."""
+        return [
+            (bbox, int(entry.get("depth", 0)))
+            for bbox, entry in self.tiles.items()
+            if entry.get("status") not in FINAL_STATUSES
+        ]
+
+    def summary(self) -> dict:
+        counts = {}
+        for entry in self.tiles.values():
+            counts[entry.get("status")] = counts.get(entry.get("status"), 0) + 1
+        return counts
@@ -0,0 +1,362 @@
+"""
+mock_server.py
+
+Local stand-in for https://graph.mapillary.com/images, for benchmarks and
+offline tuning of the fetch engines (see bench_fetch.py).
+
+Supported:
+    GET /images?bbox=w,s,e,n&limit=N&fields=...&after=CURSOR
+        - synthetic images: dense city-centre clusters + uniform background
+        - `after` cursor pagination (opaque cursor, like the real API)
+        - `start_captured_at` filter (ISO 8601), used by refresh fetches
+        - only the requested fields are returned
+          (id, computed_geometry, captured_at, thumb_{256,1024,2048,original}_url)
+    GET /img/{id}_{size}.jpg
+        - JPEG with long side `size` (same bytes for every id)
+
+Fault injection (all optional):
+    latency_s / latency_per_item_s   response delay
+    max_rps                          server-side rate limit -> 429 with Retry-After
+    error_429_rate                   random 429s
+    timeout_rate                     random hangs of hang_s seconds
+    timeout_over_records             hang when the bbox holds more images than this
+                                     (dense tiles time out, like the real API)
+    image_latency_s                  delay of every /img/ response
+    image_error_rate                 random 503s on /img/
+
+Run standalone:
+    python -m src.api_fetch.mock_server --port 8765 --points 200000 --max-rps 20
+"""
+
+import argparse
+import base64
+import json
+import math
+import random
+import threading
+import time
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from src.api_fetch import fetch_images as fi
+
+# Grid used to index the synthetic points (degrees)
+INDEX_CELL_DEG = 0.005
+THUMB_SIZES = (256, 1024, 2048)
+
+
+class MockMapillary:
+    def __init__(
+        self,
+        bbox: str = fi.DEFAULT_BBOX,
+        points: int = 20000,
+        clusters: int = 3,
+        cluster_sigma_deg: float = 0.004,
+        background_ratio: float = 0.2,
+        seed: int = 42,
+        latency_s: float = 0.0,
+        latency_per_item_s: float = 0.0,
+        max_rps: float = 0.0,
+        error_429_rate: float = 0.0,
+        timeout_rate: float = 0.0,
+        timeout_over_records: int = 0,
+        hang_s: float = 5.0,
+        image_aspect: float = 0.75,
+        image_latency_s: float = 0.0,
+        image_error_rate: float = 0.0,
+    ):
+        self.latency_s = latency_s
+        self.latency_per_item_s = latency_per_item_s
+        self.max_rps = max_rps
+        self.error_429_rate = error_429_rate
+        self.timeout_rate = timeout_rate
+        self.timeout_over_records = timeout_over_records
+        self.hang_s = hang_s
+        self.image_aspect = image_aspect
+        self.image_latency_s = image_latency_s
+        self.image_error_rate = image_error_rate
+
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._jpeg_cache = {}
+        self.base_url = None
+        self._httpd = None
+
+        self.stats = {"requests": 0, "ok": 0, "http_429": 0, "timeouts": 0, "bad_request": 0,
+                      "records_served": 0, "image_requests": 0, "image_errors": 0}
+
+        self._generate(bbox, points, clusters, cluster_sigma_deg, background_ratio)
+
+    # ---------- Synthetic data ----------
+
+    def _generate(self, bbox, points, clusters, sigma, background_ratio):
+        w, s, e, n = fi._parse_bbox_str(bbox)
+        rng = self._rng
+        centres = [(rng.uniform(w, e), rng.uniform(s, n)) for _ in range(max(1, clusters))]
+        self.points = []
+        for i in range(points):
+            if rng.random() < background_ratio:
+                lon, lat = rng.uniform(w, e), rng.uniform(s, n)
+            else:
+                cx, cy = centres[i % len(centres)]
+                lon = min(max(rng.gauss(cx, sigma), w), e)
+                lat = min(max(rng.gauss(cy, sigma), s), n)
+            captured_at = 1_500_000_000_000 + rng.randrange(0, 250_000_000_000)
+            self.points.append((str(10**14 + i), lon, lat, captured_at))
+
+        self._index = {}
+        for p in self.points:
+            self._index.setdefault(self._cell(p[1], p[2]), []).append(p)
+
+    def add_points(self, bbox: str, count: int, captured_at_ms: int = None) -> list:
+        """Add uniformly spread new images (e.g. to exercise refresh fetches). Returns their ids."""
+        w, s, e, n = fi._parse_bbox_str(bbox)
+        captured_at_ms = captured_at_ms or int(time.time() * 1000)
+        new = []
+        with self._lock:
+            for _ in range(count):
+                p = (str(10**14 + len(self.points)), self._rng.uniform(w, e), self._rng.uniform(s, n), captured_at_ms)
+                self.points.append(p)
+                self._index.setdefault(self._cell(p[1], p[2]), []).append(p)
+                new.append(p[0])
+        return new
+
+    @staticmethod
+    def _cell(lon, lat):
+        return int(math.floor(lon / INDEX_CELL_DEG)), int(math.floor(lat / INDEX_CELL_DEG))
+
+    def count_in_bbox(self, bbox: str) -> int:
+        return len(self._select(*fi._parse_bbox_str(bbox)))
+
+    def _select(self, w, s, e, n):
+        cx0, cy0 = self._cell(w, s)
+        cx1, cy1 = self._cell(e, n)
+        out = []
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                for p in self._index.get((cx, cy), ()):
+                    if w <= p[1] <= e and s <= p[2] <= n:
+                        out.append(p)
+        out.sort(key=lambda p: p[0])
+        return out
+
+    def _item(self, p, fields):
+        img_id, lon, lat, captured_at = p
+        item = {}
+        for f in fields:
+            if f == "id":
+                item["id"] = img_id
+            elif f == "computed_geometry":
+                item["computed_geometry"] = {"type": "Point", "coordinates": [lon, lat]}
+            elif f == "captured_at":
+                item["captured_at"] = captured_at
+            elif f.startswith("thumb_") and f.endswith("_url"):
+                size = f[len("thumb_"):-len("_url")]
+                size = 2048 if size == "original" else int(size)
+                item[f] = f"{self.base_url}/img/{img_id}_{size}.jpg"
+        return item
+
+    # ---------- Request handling ----------
+
+    def _throttled(self) -> bool:
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.max_rps > 0:
+                now = time.monotonic()
+                if now - self._window_start >= 1.0:
+                    self._window_start = now
+                    self._window_count = 0
+                self._window_count += 1
+                if self._window_count > self.max_rps:
+                    return True
+            return self.error_429_rate > 0 and self._rng.random() < self.error_429_rate
+
+    def handle_images(self, query: dict):
+        """Returns (status, headers, body_dict, delay_s)."""
+        if self._throttled():
+            with self._lock:
+                self.stats["http_429"] += 1
+            return 429, {"Retry-After": "1"}, {"error": {"message": "rate limited"}}, 0.0
+
+        try:
+            w, s, e, n = fi._parse_bbox_str(query["bbox"][0])
+            limit = min(int(query.get("limit", ["2000"])[0]), 2000)
+            fields = query.get("fields", ["id"])[0].split(",")
+            after = query.get("after", [None])[0]
+            since = query.get("start_captured_at", [None])[0]
+            since_ms = int(datetime.fromisoformat(since.replace("Z", "+00:00")).timestamp() * 1000) if since else None
+            offset = int(base64.urlsafe_b64decode(after.encode()).decode()) if after else 0
+        except Exception as ex:
+            with self._lock:
+                self.stats["bad_request"] += 1
+            return 400, {}, {"error": {"message": f"bad request: {ex}"}}, 0.0
+
+        sel = self._select(w, s, e, n)
+        if since_ms is not None:
+            sel = [p for p in sel if p[3] >= since_ms]
+        hang = (self.timeout_over_records and len(sel) > self.timeout_over_records) or \
+            (self.timeout_rate > 0 and self._rng.random() < self.timeout_rate)
+        if hang:
+            with self._lock:
+                self.stats["timeouts"] += 1
+            return None, {}, None, self.hang_s
+
+        page = sel[offset:offset + limit]
+        body = {"data": [self._item(p, fields) for p in page]}
+        if offset + limit < len(sel):
+            cursor = base64.urlsafe_b64encode(str(offset + limit).encode()).decode()
+            body["paging"] = {"cursors": {"before": after or "", "after": cursor}}
+
+        with self._lock:
+            self.stats["ok"] += 1
+            self.stats["records_served"] += len(page)
+        return 200, {}, body, self.latency_s + self.latency_per_item_s * len(page)
+
+    def image_failed(self) -> bool:
+        with self._lock:
+            if self.image_error_rate > 0 and self._rng.random() < self.image_error_rate:
+                self.stats["image_errors"] += 1
+                return True
+            return False
+
+    def jpeg_bytes(self, size: int) -> bytes:
+        with self._lock:
+            self.stats["image_requests"] += 1
+            if size in self._jpeg_cache:
+                return self._jpeg_cache[size]
+        # Lazy import: only the image endpoint needs numpy / OpenCV
+        import numpy as np
+        import cv2
+        h = int(round(size * self.image_aspect))
+        yy, xx = np.mgrid[0:h, 0:size]
+        img = np.stack([(xx * 255 // max(1, size - 1)), (yy * 255 // max(1, h - 1)),
+                        ((xx + yy) % 256)], axis=-1).astype(np.uint8)
+        data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+        with self._lock:
+            self._jpeg_cache[size] = data
+        return data
+
+    # ---------- Server ----------
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, headers, payload: bytes, ctype):
+                self.send_response(status)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(payload)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path.startswith("/img/"):
+                    try:
+                        size = int(url.path.rsplit("_", 1)[1].split(".")[0])
+                    except Exception:
+                        size = 2048
+                    if mock.image_latency_s:
+                        time.sleep(mock.image_latency_s)
+                    if mock.image_failed():
+                        self._send(503, {}, b"unavailable", "text/plain")
+                        return
+                    self._send(200, {}, mock.jpeg_bytes(size), "image/jpeg")
+                    return
+
+                if url.path.rstrip("/") != "/images":
+                    self._send(404, {}, b"{}", "application/json")
+                    return
+
+                status, headers, body, delay = mock.handle_images(parse_qs(url.query))
+                if delay:
+                    time.sleep(delay)
+                if status is None:
+                    # Simulated timeout: hang, then drop the connection without a response
+                    self.close_connection = True
+                    return
+                self._send(status, headers, json.dumps(body).encode("utf-8"), "application/json")
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._httpd.daemon_threads = True
+        self.base_url = f"http://{host}:{self._httpd.server_port}"
+        threading.Thread(target=self._httpd.serve_forever, name="mock-mapillary", daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser):
+    g = parser.add_argument_group("mock server")
+    g.add_argument("--bbox", default=fi.DEFAULT_BBOX)
+    g.add_argument("--points", type=int, default=20000)
+    g.add_argument("--clusters", type=int, default=3)
+    g.add_argument("--cluster-sigma-deg", type=float, default=0.004)
+    g.add_argument("--background-ratio", type=float, default=0.2)
+    g.add_argument("--seed", type=int, default=42)
+    g.add_argument("--latency-s", type=float, default=0.05)
+    g.add_argument("--latency-per-item-s", type=float, default=0.0)
+    g.add_argument("--max-rps", type=float, default=0.0)
+    g.add_argument("--error-429-rate", type=float, default=0.0)
+    g.add_argument("--timeout-rate", type=float, default=0.0)
+    g.add_argument("--timeout-over-records", type=int, default=0)
+    g.add_argument("--hang-s", type=float, default=5.0)
+    g.add_argument("--image-latency-s", type=float, default=0.0)
+    g.add_argument("--image-error-rate", type=float, default=0.0)
+
+
+def mock_from_args(args) -> MockMapillary:
+    return MockMapillary(
+        bbox=args.bbox,
+        points=args.points,
+        clusters=args.clusters,
+        cluster_sigma_deg=args.cluster_sigma_deg,
+        background_ratio=args.background_ratio,
+        seed=args.seed,
+        latency_s=args.latency_s,
+        latency_per_item_s=args.latency_per_item_s,
+        max_rps=args.max_rps,
+        error_429_rate=args.error_429_rate,
+        timeout_rate=args.timeout_rate,
+        timeout_over_records=args.timeout_over_records,
+        hang_s=args.hang_s,
+        image_latency_s=args.image_latency_s,
+        image_error_rate=args.image_error_rate,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Mapillary /images stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock = mock_from_args(args)
+    url = mock.start(args.host, args.port)
+    print(f"[INFO] Mock Mapillary API at {url}/images ({len(mock.points)} images in {args.bbox})")
+    print("[INFO] Point fetch_images.BASE_URL at it. Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"[STATS] {mock.stats}")
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
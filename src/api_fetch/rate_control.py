@@ -0,0 +1,181 @@
+"""
+rate_control.py
+
+Request rate limiting shared by all concurrent fetch tasks.
+
+TokenBucket:
+    Classic token bucket for asyncio code.
+    - rate:  sustained requests per second (tokens added per second)
+    - burst: bucket capacity (requests allowed back-to-back after idle time)
+
+AdaptiveRateController:
+    TokenBucket whose rate follows AIMD (additive increase, multiplicative decrease):
+    - every healthy response raises the rate so that it grows by about
+      `increase` requests/s per second of traffic
+    - a 429, a 5xx, a timeout or a latency rise cuts the rate by `decrease_factor`
+      (latency = time to the response headers, so the size of a page's body
+      does not read as congestion)
+      (at most once per `cooldown` seconds, so one burst of 429s from
+      concurrent requests counts as a single congestion signal)
+    Current rate, wait time and latency are available via stats().
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket.
+
+    Every request calls `await bucket.acquire()` before hitting the API.
+    Waiters are served in FIFO order; a waiter only sleeps for the time
+    needed to refill the missing tokens, so the bucket never idles while
+    requests are queued.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0:
+            raise ValueError(f"rate must be > 0, got {rate}")
+        self.rate = float(rate)
+        self.capacity = float(max(1.0, burst))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+        # Monitoring
+        self.acquired = 0
+        self.total_wait_s = 0.0
+        self.last_wait_s = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def acquire(self, tokens: float = 1.0):
+        t0 = time.monotonic()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    break
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+        wait = time.monotonic() - t0
+        self.acquired += 1
+        self.total_wait_s += wait
+        self.last_wait_s = wait
+
+    def on_success(self, latency_s: float):
+        """Feedback hook: a request succeeded (fixed-rate bucket ignores it)."""
+
+    def on_throttle(self, reason: str):
+        """Feedback hook: a request was throttled or failed (fixed-rate bucket ignores it)."""
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "requests": self.acquired,
+            "last_wait_s": self.last_wait_s,
+            "avg_wait_s": self.total_wait_s / self.acquired if self.acquired else 0.0,
+        }
+
+
+class AdaptiveRateController(TokenBucket):
+    """AIMD-controlled token bucket shared by all fetch workers."""
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float,
+        min_rate: float,
+        max_rate: float,
+        increase: float,
+        decrease_factor: float,
+        latency_rise_factor: float,
+        cooldown: float = 1.0,
+    ):
+        super().__init__(rate, burst)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max(max_rate, min_rate))
+        self.increase = float(increase)
+        self.decrease_factor = float(decrease_factor)
+        self.latency_rise_factor = float(latency_rise_factor)
+        self.cooldown = float(cooldown)
+        self.rate = min(max(self.rate, self.min_rate), self.max_rate)
+
+        self._last_decrease = 0.0
+        self.latency_ewma = None      # fast EWMA of response latency
+        self.latency_base = None      # slow baseline (tracks the healthy latency)
+
+        # Monitoring
+        self.increases = 0
+        self.decreases = 0
+        self.last_signal = None
+
+    # ---------- Signals ----------
+
+    def on_success(self, latency_s: float):
+        if self.latency_ewma is None:
+            self.latency_ewma = latency_s
+            self.latency_base = latency_s
+        else:
+            self.latency_ewma += 0.3 * (latency_s - self.latency_ewma)
+            if self.latency_ewma < self.latency_base:
+                self.latency_base = self.latency_ewma
+            else:
+                self.latency_base += 0.01 * (self.latency_ewma - self.latency_base)
+
+        # Rising latency: the server is queueing our requests, back off before it starts throttling
+        if self.latency_ewma > self.latency_base * self.latency_rise_factor and \
+                self.latency_ewma - self.latency_base > 0.05:
+            self._decrease("latency")
+            return
+
+        # Additive increase: +increase req/s per second of traffic at the current rate
+        self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+        self.increases += 1
+
+    def on_throttle(self, reason: str):
+        """429, 5xx or timeout."""
+        self._decrease(reason)
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+        # Drop saved-up burst so the cut takes effect immediately
+        self._tokens = min(self._tokens, 1.0)
+        self.decreases += 1
+        self.last_signal = reason
+
+    def stats(self) -> dict:
+        out = super().stats()
+        out.update(
+            {
+                "latency_ewma_s": self.latency_ewma or 0.0,
+                "latency_base_s": self.latency_base or 0.0,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "last_signal": self.last_signal,
+            }
+        )
+        return out
+
+
+def format_stats(stats: dict) -> str:
+    """One-line monitoring summary, e.g. for [RATE] log lines."""
+    line = (
+        f"rate={stats['rate']:.2f}/s requests={stats['requests']} "
+        f"wait(last/avg)={stats['last_wait_s']:.2f}s/{stats['avg_wait_s']:.2f}s"
+    )
+    if "decreases" in stats:
+        line += (
+            f" latency={stats['latency_ewma_s']:.2f}s (base {stats['latency_base_s']:.2f}s)"
+            f" cuts={stats['decreases']} last_signal={stats['last_signal']}"
+        )
+    return line
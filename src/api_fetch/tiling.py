@@ -0,0 +1,127 @@
+"""
+tiling.py
+
+Adaptive quadtree tiling for the Mapillary fetch.
+
+Instead of a fixed TILE_SIZE_DEG grid, the bbox is cut into coarse root tiles
+(QUADTREE_ROOT_DEG, no overlap). A tile is split into 4 quadrants when
+    - its first page is full (LIMIT records), or
+    - its first request times out,
+as long as it is larger than QUADTREE_MIN_TILE_DEG. Tiles whose first page is
+empty are leaves: their subtree is never requested.
+
+The resulting tree is persisted as tile_tree_bbox_{bbox}.json in raw_dir,
+so later runs start directly from the learned leaves.
+
+Tree file format:
+    {
+        "bbox": "w,s,e,n",
+        "nodes": {
+            "<tile_bbox>": {"depth": 0, "status": "split" | "leaf" | "empty", "count": 123},
+            ...
+        }
+    }
+"""
+
+import json
+import os
+from pathlib import Path
+
+from src.api_fetch import fetch_images as fi
+
+STATUS_SPLIT = "split"
+STATUS_LEAF = "leaf"
+STATUS_EMPTY = "empty"
+
+
+def root_tiles(big_bbox: str):
+    """Coarse, non-overlapping root tiles covering the bbox."""
+    return fi._tile_bboxes(big_bbox, tile_size=fi.QUADTREE_ROOT_DEG, overlap_ratio=0.0)
+
+
+def split_bbox(tile_bbox: str):
+    """Split a tile into 4 quadrants (SW, SE, NW, NE). Quadrants share edges only."""
+    w, s, e, n = fi._parse_bbox_str(tile_bbox)
+    mx = (w + e) / 2.0
+    my = (s + n) / 2.0
+    return [
+        fi._format_bbox(w, s, mx, my),
+        fi._format_bbox(mx, s, e, my),
+        fi._format_bbox(w, my, mx, n),
+        fi._format_bbox(mx, my, e, n),
+    ]
+
+
+def can_split(tile_bbox: str, depth: int) -> bool:
+    w, s, e, n = fi._parse_bbox_str(tile_bbox)
+    if depth >= fi.QUADTREE_MAX_DEPTH:
+        return False
+    # Children must not be smaller than the minimum tile size
+    return max(e - w, n - s) / 2.0 >= fi.QUADTREE_MIN_TILE_DEG
+
+
+def tile_tree_path(raw_dir: Path, big_bbox_safe: str) -> Path:
+    return Path(raw_dir) / f"tile_tree_bbox_{big_bbox_safe}.json"
+
+
+class TileTree:
+    """Learned quadtree of one bbox, keyed by tile bbox string."""
+
+    def __init__(self, path: Path, big_bbox: str):
+        self.path = Path(path)
+        self.big_bbox = big_bbox
+        self.nodes = {}
+
+    @classmethod
+    def load(cls, path: Path, big_bbox: str) -> "TileTree":
+        tree = cls(path, big_bbox)
+        if not tree.path.exists():
+            return tree
+        try:
+            data = json.loads(tree.path.read_text(encoding="utf-8"))
+        except Exception as e:
+            print(f"[WARN] Failed to read tile tree {tree.path}, starting fresh. Error: {e}")
+            return tree
+        if data.get("bbox") == big_bbox:
+            tree.nodes = data.get("nodes") or {}
+        return tree
+
+    def save(self):
+        """Atomic write: readers never see a half-written tree."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump({"bbox": self.big_bbox, "nodes": self.nodes}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def mark(self, tile_bbox: str, depth: int, status: str, count: int = 0):
+        self.nodes[tile_bbox] = {"depth": depth, "status": status, "count": count}
+
+    def depth_of(self, tile_bbox: str) -> int:
+        return int((self.nodes.get(tile_bbox) or {}).get("depth", 0))
+
+    def expand(self, tiles):
+        """
+        Replace every tile already known to be dense by its learned leaves.
+
+        Args:
+            tiles: list of (tile_bbox, depth)
+        Returns:
+            list of (tile_bbox, depth) to request
+        """
+        out = []
+        stack = list(reversed(tiles))
+        while stack:
+            tile_bbox, depth = stack.pop()
+            node = self.nodes.get(tile_bbox)
+            if node and node.get("status") == STATUS_SPLIT:
+                stack.extend(reversed([(c, depth + 1) for c in split_bbox(tile_bbox)]))
+            else:
+                out.append((tile_bbox, depth))
+        return out
+
+    def summary(self) -> dict:
+        counts = {STATUS_SPLIT: 0, STATUS_LEAF: 0, STATUS_EMPTY: 0}
+        for node in self.nodes.values():
+            counts[node.get("status")] = counts.get(node.get("status"), 0) + 1
+        return counts
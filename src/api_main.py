@@ -1,11 +1,15 @@
 # api_main.py
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.exceptions import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from pathlib import Path
+from typing import List, Optional
+from contextlib import asynccontextmanager
 import json
+import threading
 
 # Import your script modules
 # NOTE: segmentation is imported lazily to avoid loading torch/mmcv at startup
@@ -13,9 +17,33 @@ from src.preprocess import download_images
 from src.preprocess import parse_json
 from src.api_fetch import fetch_images
 from src.geojson_builder import build_geojson
+from src.pipeline import fetch_pipeline
+from src.preprocess import packed_store
 
 
-app = FastAPI()
+# ✅ Load the SegFormer model once, in the background at server start, so the first
+# /api/process-images call does not pay the torch / mmseg import and checkpoint load.
+# The model stays resident for all later requests (segment_building.MODEL).
+WARM_MODEL_ON_STARTUP = True
+
+
+def _warm_model():
+    try:
+        from src.segmentation import segment_building
+        segment_building.MODEL.warm()
+        print(f"[INFO] SegFormer model ready ({segment_building.MODEL.describe()}).")
+    except Exception as e:
+        print(f"[WARN] SegFormer model not preloaded: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if WARM_MODEL_ON_STARTUP:
+        threading.Thread(target=_warm_model, name="warm-model", daemon=True).start()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
 
 # ==========================================================
 # ✅ Projects root directory:
@@ -26,12 +54,40 @@ app = FastAPI()
 BASE_DIR = Path(__file__).resolve().parents[1]
 PROJECT_ROOT = BASE_DIR / "projects"
 
+class ProjectStaticFiles(StaticFiles):
+    """
+    Project files. Images and segmentation outputs kept in a project's packed
+    store (PACKED_STORE) have no file; they are rendered under the same url.
+    """
+
+    async def get_response(self, path: str, scope):
+        try:
+            return await super().get_response(path, scope)
+        except HTTPException as e:
+            parts = Path(path).parts
+            # <project>/data/<folder>/<name>
+            if e.status_code != 404 or len(parts) != 4 or parts[1] != "data":
+                raise
+            data_dir = PROJECT_ROOT / parts[0] / "data"
+            if not packed_store.has_packed(data_dir):
+                raise
+            if parts[2] == "images":
+                blob = packed_store.PackedStore.open(data_dir).get(Path(parts[3]).stem, "image")
+            else:
+                # ✅ Lazy import, as for /api/process-images
+                from src.segmentation import segment_building
+                blob = segment_building.render_packed(data_dir, parts[2], parts[3])
+            if blob is None:
+                raise
+            return Response(blob, media_type="image/jpeg" if parts[3].endswith(".jpg") else "image/png")
+
+
 # Mount static resources only if the directory exists
 # (otherwise the container may crash on startup)
 if PROJECT_ROOT.exists():
     app.mount(
         "/static/projects",
-        StaticFiles(directory=str(PROJECT_ROOT)),
+        ProjectStaticFiles(directory=str(PROJECT_ROOT)),
         name="projects_static",
     )
 
@@ -44,6 +100,10 @@ app.add_middleware(
     allow_headers=["*"],      # allow all headers
 )
 
+# ✅ Fetch step: stream records from fetched pages through parsing into downloads
+# (False = run fetch, parse and download strictly one after another)
+STREAM_PIPELINE = True
+
 # ---------- Request body models ----------
 class InitProjectBody(BaseModel):
     project_name: str
@@ -55,6 +115,17 @@ class BBoxBody(BaseModel):
 class ProjectBody(BaseModel):
     project_name: str
 
+class ProcessBody(BaseModel):
+    project_name: str
+    fused: Optional[bool] = None          # one pass per image (default: segment_building.FUSED_PIPELINE)
+    artifacts: Optional[List[str]] = None  # fused: "masks" / "rgba" / "palettes" to write (default: all)
+    new_only: bool = False                 # only segment the images of the last refresh (images_meta_new.csv)
+
+class FetchBody(BaseModel):
+    project_name: str
+    refresh: bool = False   # only fetch images captured since the last fetch
+    segment: bool = False   # also segment + extract colors while downloading (streaming pipeline)
+
 # ---------- List all projects ----------
 @app.get("/api/projects")
 def list_projects():
@@ -138,13 +209,19 @@ def set_bbox(body: BBoxBody):
 
 # ---------- API 3: Fetch image metadata & download ----------
 @app.post("/api/fetch-images")
-async def api_fetch_images(body: ProjectBody):
+async def api_fetch_images(body: FetchBody):
     project_dir = PROJECT_ROOT / body.project_name
 
-    def fetch_pipeline():
+    if STREAM_PIPELINE:
+        return StreamingResponse(
+            fetch_pipeline.run_fetch_pipeline(project_dir, refresh=body.refresh, segment=body.segment),
+            media_type="text/plain",
+        )
+
+    def fetch_steps():
         yield "[INFO] 🚀 Starting Mapillary API request to fetch metadata...\n"
         try:
-            fetch_images.run_fetch_images(project_dir)
+            fetch_images.run_fetch_images(project_dir, refresh=body.refresh)
             yield "[SUCCESS] Metadata API request completed.\n"
         except Exception as e:
             yield f"[ERROR] API request failed: {e}\n"
@@ -160,7 +237,7 @@ async def api_fetch_images(body: ProjectBody):
 
         yield "[INFO] Starting downloader...\n"
         try:
-            for log in download_images.run_download_images(project_dir):
+            for log in download_images.run_download_images(project_dir, new_only=body.refresh):
                 yield log
         except Exception as e:
             yield f"[ERROR] Download interrupted: {e}\n"
@@ -168,11 +245,11 @@ async def api_fetch_images(body: ProjectBody):
 
         yield "[DONE] ✅ All steps completed.\n"
 
-    return StreamingResponse(fetch_pipeline(), media_type="text/plain")
+    return StreamingResponse(fetch_steps(), media_type="text/plain")
 
 # ---------- API 4: Process images (segmentation + color extraction) ----------
 @app.post("/api/process-images")
-async def api_process_images(body: ProjectBody):
+async def api_process_images(body: ProcessBody):
     project_dir = PROJECT_ROOT / body.project_name
 
     def process_pipeline():
@@ -180,7 +257,9 @@ async def api_process_images(body: ProjectBody):
         try:
             # ✅ Lazy import: avoid loading torch/mmcv at server startup
             from src.segmentation import segment_building
-            for log in segment_building.run_segment_building(project_dir):
+            for log in segment_building.run_segment_building(project_dir, fused=body.fused,
+                                                             artifacts=body.artifacts,
+                                                             new_only=body.new_only):
                 yield log
         except Exception as e:
             yield f"[ERROR] Segmentation processing failed: {e}\n"
@@ -26,12 +26,20 @@ B) FastAPI multi-project mode:
         projects/{project_name}/data/geojson/facade_colors.geojson
     Call:
         build_geojson.run_build_geojson(project_dir)
+
+Streaming build (STREAM_BUILD):
+    Only the colors are held in memory, as their raw CSV strings; metadata rows
+    are joined one at a time and every Feature is written as soon as it is
+    built, so peak memory does not grow with the metadata CSV or the number of
+    features. Features follow the order of images_meta.csv.
 """
 
 from pathlib import Path
 import csv
 import json
 import ast
+import os
+import textwrap
 
 # Repository root directory: .../city-color-map/
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
@@ -42,13 +50,16 @@ DEFAULT_COLOR_CSV = PROJECT_ROOT / "data" / "csv" / "color_summary.csv"
 DEFAULT_OUT_GEOJSON = PROJECT_ROOT / "web" / "public" / "data" / "city_colors.geojson"
 # ==================================================================
 
+# Join metadata rows one at a time and write Features incrementally
+STREAM_BUILD = True
 
-def load_metadata(path: Path):
+
+def iter_metadata(path: Path):
     """
-    Read images_meta / image_metadata CSV.
+    Iterate images_meta / image_metadata CSV rows.
 
-    Returns:
-        dict: image_id -> dict(lon=..., lat=..., thumb_url=...)
+    Yields:
+        (image_id, dict(lon=..., lat=..., thumb_url=...))
 
     Supports two possible field name conventions:
         - id / image_id
@@ -58,7 +69,6 @@ def load_metadata(path: Path):
     if not path.exists():
         raise SystemExit(f"[ERROR] Metadata CSV not found: {path}")
 
-    meta = {}
     with path.open("r", encoding="utf-8") as f:
         reader = csv.DictReader(f)
         for row in reader:
@@ -76,22 +86,68 @@ def load_metadata(path: Path):
             except ValueError:
                 continue
 
-            meta[image_id] = {
+            yield image_id, {
                 "lon": lon_f,
                 "lat": lat_f,
                 "thumb_url": thumb_url,
             }
 
-    print(f"[INFO] Loaded {len(meta)} metadata records from {path.name}")
+
+def load_metadata(path: Path):
+    """
+    Read images_meta / image_metadata CSV.
+
+    Returns:
+        dict: image_id -> dict(lon=..., lat=..., thumb_url=...)
+    """
+    meta = dict(iter_metadata(path))
+    print(f"[INFO] Loaded {len(meta)} metadata records from {Path(path).name}")
     return meta
 
 
-def load_colors(path: Path):
+def _color_image_id(fname: str) -> str:
+    # file example: "123456_building_shadowfree.png"
+    if "_building_shadowfree" in fname:
+        return fname.split("_building_shadowfree", 1)[0]
+    return Path(fname).stem
+
+
+def parse_color_values(raw_palette: str, raw_ratios: str):
+    """
+    Parse the palette_rgb / ratios strings of one color_summary.csv row.
+
+    Returns:
+        dict(palette_rgb=[[r,g,b], ...], ratios=[...]) or None if invalid
+    """
+    # Values are stored as Python-style strings in CSV (plain lists are also valid JSON)
+    try:
+        palette = json.loads(raw_palette)
+        ratios = json.loads(raw_ratios)
+    except Exception:
+        try:
+            palette = ast.literal_eval(raw_palette)
+            ratios = ast.literal_eval(raw_ratios)
+        except Exception:
+            return None
+
+    if not isinstance(palette, list) or not isinstance(ratios, list):
+        return None
+    if len(palette) == 0 or len(palette) != len(ratios):
+        return None
+    return {
+        "palette_rgb": palette,
+        "ratios": ratios,
+    }
+
+
+def load_colors(path: Path, raw: bool = False):
     """
     Read color_summary.csv.
 
     Returns:
         dict: image_id -> dict(palette_rgb=[[r,g,b], ...], ratios=[...])
+        (raw=True: image_id -> (palette_rgb string, ratios string), validated
+        but not kept as Python lists, for the streaming build)
 
     The image_id is derived from the 'file' field by removing
     '_building_shadowfree'.
@@ -108,31 +164,13 @@ def load_colors(path: Path):
             if not fname:
                 continue
 
-            # file example: "123456_building_shadowfree.png"
-            if "_building_shadowfree" in fname:
-                image_id = fname.split("_building_shadowfree", 1)[0]
-            else:
-                image_id = Path(fname).stem
-
             raw_palette = row.get("palette_rgb", "")
             raw_ratios = row.get("ratios", "")
-
-            # Values are stored as Python-style strings in CSV
-            try:
-                palette = ast.literal_eval(raw_palette)
-                ratios = ast.literal_eval(raw_ratios)
-            except Exception:
-                continue
-
-            if not isinstance(palette, list) or not isinstance(ratios, list):
-                continue
-            if len(palette) == 0 or len(palette) != len(ratios):
+            colors = parse_color_values(raw_palette, raw_ratios)
+            if colors is None:
                 continue
 
-            color_map[image_id] = {
-                "palette_rgb": palette,
-                "ratios": ratios,
-            }
+            color_map[_color_image_id(fname)] = (raw_palette, raw_ratios) if raw else colors
 
     print(f"[INFO] Loaded {len(color_map)} color records from {path.name}")
     return color_map
@@ -144,57 +182,89 @@ def rgb_to_hex(rgb):
     return "#{:02x}{:02x}{:02x}".format(r, g, b)
 
 
+def make_feature(image_id, m, c):
+    """Build one GeoJSON Feature from a metadata record and a color record."""
+    lon = m["lon"]
+    lat = m["lat"]
+    thumb_url = m.get("thumb_url")
+
+    palette = c["palette_rgb"]
+    ratios = c["ratios"]
+
+    # Use the first color as the dominant color
+    main_rgb = palette[0]
+    main_ratio = float(ratios[0]) if ratios else None
+    main_hex = rgb_to_hex(main_rgb)
+
+    # Corresponding palette image filename (under data/palettes)
+    palette_image_name = f"{image_id}_palette.png"
+    # Relative path for frontend access (can be adjusted depending on deployment)
+    palette_image_path = f"/data/palettes/{palette_image_name}"
+
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [lon, lat],
+        },
+        "properties": {
+            "image_id": image_id,
+            "lon": lon,
+            "lat": lat,
+            "thumb_url": thumb_url,
+            "main_color_rgb": main_rgb,
+            "main_color_hex": main_hex,
+            "main_ratio": main_ratio,
+            "palette_rgb": palette,
+            "ratios": ratios,
+            "palette_image": palette_image_path,
+        },
+    }
+
+
 def build_features(meta_map, color_map):
     """
     Merge metadata and color data to build a list of GeoJSON Features.
     """
-    features = []
     common_ids = set(meta_map.keys()) & set(color_map.keys())
     print(f"[INFO] Number of matched image_id entries: {len(common_ids)}")
+    return [make_feature(image_id, meta_map[image_id], color_map[image_id]) for image_id in common_ids]
 
-    for image_id in common_ids:
-        m = meta_map[image_id]
-        c = color_map[image_id]
-
-        lon = m["lon"]
-        lat = m["lat"]
-        thumb_url = m.get("thumb_url")
-
-        palette = c["palette_rgb"]
-        ratios = c["ratios"]
-
-        # Use the first color as the dominant color
-        main_rgb = palette[0]
-        main_ratio = float(ratios[0]) if ratios else None
-        main_hex = rgb_to_hex(main_rgb)
-
-        # Corresponding palette image filename (under data/palettes)
-        palette_image_name = f"{image_id}_palette.png"
-        # Relative path for frontend access (can be adjusted depending on deployment)
-        palette_image_path = f"/data/palettes/{palette_image_name}"
-
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [lon, lat],
-            },
-            "properties": {
-                "image_id": image_id,
-                "lon": lon,
-                "lat": lat,
-                "thumb_url": thumb_url,
-                "main_color_rgb": main_rgb,
-                "main_color_hex": main_hex,
-                "main_ratio": main_ratio,
-                "palette_rgb": palette,
-                "ratios": ratios,
-                "palette_image": palette_image_path,
-            },
-        }
-        features.append(feature)
 
-    return features
+def iter_features(meta_csv: Path, color_raw_map):
+    """
+    Streaming join: yield one Feature per metadata row with colors,
+    in metadata CSV order (each image_id once).
+    """
+    emitted = set()
+    for image_id, m in iter_metadata(meta_csv):
+        raw = color_raw_map.get(image_id)
+        if raw is None or image_id in emitted:
+            continue
+        emitted.add(image_id)
+        yield make_feature(image_id, m, parse_color_values(*raw))
+
+
+def write_feature_collection(features, out_geojson: Path) -> int:
+    """
+    Write a FeatureCollection from an iterable of Features, one Feature at a time.
+
+    The output is formatted like json.dump(fc, indent=2). It is written to a
+    temporary file first, so a failed build keeps the previous GeoJSON.
+    Returns the number of features written.
+    """
+    out_geojson = Path(out_geojson)
+    tmp = out_geojson.with_name(out_geojson.name + ".tmp")
+    count = 0
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write('{\n  "type": "FeatureCollection",\n  "features": [')
+        for feature in features:
+            f.write(",\n" if count else "\n")
+            f.write(textwrap.indent(json.dumps(feature, ensure_ascii=False, indent=2), "    "))
+            count += 1
+        f.write("\n  ]\n}" if count else "]\n}")
+    os.replace(tmp, out_geojson)
+    return count
 
 
 def build_geojson_from_paths(meta_csv: Path,
@@ -206,26 +276,24 @@ def build_geojson_from_paths(meta_csv: Path,
         - Write GeoJSON to out_geojson
         - Return the output path
     """
-    meta_map = load_metadata(meta_csv)
-    color_map = load_colors(color_csv)
-    features = build_features(meta_map, color_map)
-
-    if not features:
-        print("[WARN] No Features generated. Check whether image_id values match in both CSV files.")
-
     out_geojson = Path(out_geojson)
     out_dir = out_geojson.parent
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    fc = {
-        "type": "FeatureCollection",
-        "features": features,
-    }
-
-    with out_geojson.open("w", encoding="utf-8") as f:
-        json.dump(fc, f, ensure_ascii=False, indent=2)
+    if STREAM_BUILD:
+        color_raw_map = load_colors(color_csv, raw=True)
+        total = write_feature_collection(iter_features(meta_csv, color_raw_map), out_geojson)
+        print(f"[INFO] Number of matched image_id entries: {total}")
+    else:
+        meta_map = load_metadata(meta_csv)
+        color_map = load_colors(color_csv)
+        features = build_features(meta_map, color_map)
+        total = write_feature_collection(features, out_geojson)
+
+    if not total:
+        print("[WARN] No Features generated. Check whether image_id values match in both CSV files.")
 
-    print(f"[DONE] GeoJSON generated: {out_geojson}, total features: {len(features)}")
+    print(f"[DONE] GeoJSON generated: {out_geojson}, total features: {total}")
     return out_geojson
 
 
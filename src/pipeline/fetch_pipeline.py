@@ -0,0 +1,299 @@
+"""
+fetch_pipeline.py
+
+Streaming fetch -> parse -> download pipeline.
+
+The sequential /api/fetch-images flow (fetch all pages, then parse, then
+download) downloads nothing until the last metadata page of the bbox has
+arrived. Here the three stages run concurrently:
+
+    fetch thread      run_fetch_images(on_page=...) pushes every saved page
+         |            into page_q
+         v
+    parse thread      dedup + 50m thinning (parse_json._parse_items),
+         |            writes images_meta.csv row by row and pushes accepted
+         v            rows into the bounded download queue (backpressure)
+    download threads  DOWNLOAD_WORKERS x download_images._download_one
+                      (images cached by another project are hardlinked, not fetched)
+         |
+         v            segment=True: every written image goes into a bounded queue
+    segment thread    segment_building.StreamingSegmenter: mask, shadow removal
+                      and colors per image while the downloads continue; writes
+                      color_summary.csv at the end (no separate /api/process-images)
+
+Pages that already exist in data/raw when the pipeline starts are parsed
+first, so a resumed project still ends with a complete images_meta.csv.
+Rows that were not in the previous images_meta.csv also go to
+images_meta_new.csv; with refresh=True only new images are fetched at all,
+and only those rows go on to download and segmentation (the other rows are
+still written to images_meta.csv, their colors are kept from the last run).
+
+Rows are accepted as they arrive, so the parse stage always uses the
+first-come cell winner (parse_json CELL_WINNER = "first"); running
+run_parse_json afterwards rewrites images_meta.csv with the
+order-independent "centre" winners.
+
+With segment=True the end-to-end time approaches max(download, inference)
+instead of their sum; the download threads block while the segment queue is
+full, so at most SEGMENT_QUEUE_SIZE downloaded images wait for inference.
+
+run_fetch_pipeline(project_dir) is a generator of log lines for
+FastAPI's StreamingResponse, like the other run_* entry points.
+"""
+
+import csv
+import queue
+import threading
+from pathlib import Path
+
+from src.api_fetch import fetch_images
+from src.preprocess import parse_json
+from src.preprocess import download_images
+
+DOWNLOAD_QUEUE_SIZE = 256   # Accepted rows waiting for download (parse blocks when full)
+DOWNLOAD_WORKERS = 4
+SEGMENT_QUEUE_SIZE = 64     # Written images waiting for segmentation (downloads block when full)
+
+_END = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    """Blocking put that gives up once the pipeline is stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def run_fetch_pipeline(project_dir, refresh=False, segment=False):
+    project_dir = Path(project_dir)
+    raw_dir = project_dir / "data" / "raw"
+    csv_dir = project_dir / "data" / "csv"
+    img_dir = project_dir / "data" / "images"
+    csv_dir.mkdir(parents=True, exist_ok=True)
+    img_dir.mkdir(parents=True, exist_ok=True)
+    out_csv = csv_dir / "images_meta.csv"
+
+    page_q = queue.Queue()
+    download_q = queue.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+    segment_q = queue.Queue(maxsize=SEGMENT_QUEUE_SIZE)
+    log_q = queue.Queue()
+    stop = threading.Event()
+
+    counters = {"queued": 0, "done": 0, "failed": 0, "segmented": 0, "segment_failed": 0}
+    cache = download_images._image_cache()
+    hits_before = cache.hits if cache is not None else 0
+    counters_lock = threading.Lock()
+    fetch_error = []
+
+    # Fix the already-fetched pages before the fetch thread starts appending new ones
+    existing = parse_json._snapshot_raw_sources(raw_dir)
+    previous_ids = parse_json._read_csv_ids(out_csv)
+
+    # ---------- Stage 1: fetch ----------
+    def fetch_stage():
+        try:
+            fetch_images.run_fetch_images(project_dir, on_page=page_q.put, refresh=refresh)
+            log_q.put("[SUCCESS] Metadata API request completed.\n")
+        except Exception as e:
+            fetch_error.append(e)
+            log_q.put(f"[ERROR] API request failed: {e}\n")
+        finally:
+            page_q.put(_END)
+            log_q.put(_END)
+
+    # ---------- Stage 2: parse (dedup + thinning) ----------
+    def parse_stage():
+        seen_ids = set()
+        used_cells = set()
+        stats = parse_json._new_stats()
+
+        def emit(rows):
+            for row in rows:
+                if row["id"] not in previous_ids:
+                    new_writer.writerow(row)
+                    stats["new"] += 1
+                elif refresh:
+                    continue   # known image: not downloaded / segmented again
+                if not _put(download_q, row, stop):
+                    return False
+                with counters_lock:
+                    counters["queued"] += 1
+            return True
+
+        try:
+            with out_csv.open("w", newline="", encoding="utf-8") as f, \
+                    (csv_dir / parse_json.NEW_CSV_NAME).open("w", newline="", encoding="utf-8") as fnew:
+                writer = csv.DictWriter(f, fieldnames=parse_json.CSV_FIELDS)
+                writer.writeheader()
+                new_writer = csv.DictWriter(fnew, fieldnames=parse_json.CSV_FIELDS)
+                new_writer.writeheader()
+
+                for _, items in parse_json._iter_raw_pages(raw_dir, stats, sources=existing):
+                    if not emit(parse_json._parse_items(items, writer, seen_ids, used_cells, stats)):
+                        return
+                f.flush()
+                log_q.put(f"[INFO] Existing raw pages parsed: {stats['written']} images queued.\n")
+
+                while True:
+                    try:
+                        items = page_q.get(timeout=0.5)
+                    except queue.Empty:
+                        if stop.is_set():
+                            return
+                        continue
+                    if items is _END:
+                        break
+                    if not emit(parse_json._parse_items(items, writer, seen_ids, used_cells, stats)):
+                        return
+                    f.flush()
+                    fnew.flush()
+
+            log_q.put(f"[INFO] New images in this run: {stats['new']}.\n")
+            log_q.put(f"[SUCCESS] JSON parsing completed. {parse_json._format_stats(stats)}\n")
+        except Exception as e:
+            log_q.put(f"[ERROR] JSON parsing failed: {e}\n")
+        finally:
+            for _ in range(DOWNLOAD_WORKERS):
+                _put(download_q, _END, stop)
+            log_q.put(_END)
+
+    # ---------- Stage 3: download ----------
+    def download_stage():
+        try:
+            while not stop.is_set():
+                try:
+                    row = download_q.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if row is _END:
+                    break
+
+                img_id = row["id"]
+                out_path = img_dir / f"{img_id}.jpg"
+                if download_images._have_image(out_path):
+                    with counters_lock:
+                        counters["done"] += 1
+                    if segment:
+                        _put(segment_q, out_path, stop)
+                    continue
+
+                with counters_lock:
+                    prefix = f"[{counters['done'] + 1}/{counters['queued']}]"
+                log_q.put(f"[INFO] {prefix} Downloading {img_id} ...\n")
+                try:
+                    if not download_images._download_one(download_images._pick_thumb_url(row), out_path):
+                        log_q.put(f"[WARN] {prefix} Failed to decode image, skipping {img_id}\n")
+                        with counters_lock:
+                            counters["failed"] += 1
+                    elif segment:
+                        _put(segment_q, out_path, stop)
+                except Exception as e:
+                    log_q.put(f"[WARN] {prefix} Failed to download or save {img_id}: {e}\n")
+                    with counters_lock:
+                        counters["failed"] += 1
+                with counters_lock:
+                    counters["done"] += 1
+        finally:
+            if segment:
+                _put(segment_q, _END, stop)
+            log_q.put(_END)
+
+    # ---------- Stage 4 (segment=True): segmentation + colors ----------
+    def segment_stage():
+        segmenter = None
+        ends = 0
+        try:
+            # Lazy import: torch / mmseg are only needed in this mode
+            from src.segmentation import segment_building
+            segmenter = segment_building.StreamingSegmenter(project_dir)
+            if not segment_building.MODEL.loaded:
+                log_q.put(f"[INFO] Loading SegFormer model (Device: {segment_building.pick_device()}) "
+                          "while images download...\n")
+            loaded_now = segmenter.load_model()
+            log_q.put(f"[INFO] {'Model loaded' if loaded_now else 'Using resident SegFormer model'} "
+                      f"({segment_building.MODEL.describe()}). Segmenting images as they arrive...\n")
+        except Exception as e:
+            log_q.put(f"[ERROR] Segmentation unavailable: {e}\n")
+
+        try:
+            while ends < DOWNLOAD_WORKERS:
+                try:
+                    img_path = segment_q.get(timeout=0.5)
+                except queue.Empty:
+                    if stop.is_set():
+                        return
+                    continue
+                if img_path is _END:
+                    ends += 1
+                    continue
+                if segmenter is None or segmenter.model is None:
+                    continue  # keep draining so downloads never block
+
+                with counters_lock:
+                    prefix = f"[{counters['segmented'] + counters['segment_failed'] + 1}/{counters['queued']}]"
+                log_q.put(f"[INFO] [Segment] {prefix} Segmenting and extracting colors: {img_path.name} ...\n")
+                try:
+                    ok = segmenter.process(img_path)
+                except Exception as e:
+                    ok = False
+                    log_q.put(f"[WARN] [Segment] {prefix} Failed to process {img_path.name}: {e}\n")
+                with counters_lock:
+                    counters["segmented" if ok else "segment_failed"] += 1
+        finally:
+            if segmenter is not None and segmenter.model is not None:
+                try:
+                    n = segmenter.finish()
+                    log_q.put(f"[SUCCESS] Color summary written: {n} rows.\n")
+                except Exception as e:
+                    log_q.put(f"[ERROR] Writing color_summary.csv failed: {e}\n")
+            if segmenter is not None:
+                segmenter.close()
+            log_q.put(_END)
+
+    if segment:
+        yield "[INFO] 🚀 Starting streaming pipeline: fetch -> parse -> download -> segment run concurrently...\n"
+    else:
+        yield "[INFO] 🚀 Starting streaming pipeline: fetch -> parse -> download run concurrently...\n"
+
+    threads = [
+        threading.Thread(target=fetch_stage, name="pipeline-fetch", daemon=True),
+        threading.Thread(target=parse_stage, name="pipeline-parse", daemon=True),
+    ] + [
+        threading.Thread(target=download_stage, name=f"pipeline-download-{i}", daemon=True)
+        for i in range(DOWNLOAD_WORKERS)
+    ]
+    if segment:
+        threads.append(threading.Thread(target=segment_stage, name="pipeline-segment", daemon=True))
+    for t in threads:
+        t.start()
+
+    finished = 0
+    try:
+        while finished < len(threads):
+            msg = log_q.get()
+            if msg is _END:
+                finished += 1
+                continue
+            yield msg
+    finally:
+        # Client disconnected or pipeline done: release blocked stages.
+        # The fetch thread cannot be interrupted; its progress is kept in the fetch manifest.
+        stop.set()
+
+    yield (f"[INFO] Images ready: {counters['done'] - counters['failed']} / {counters['queued']} "
+           f"({counters['failed']} failed).\n")
+    if cache is not None:
+        trimmed = cache.evict()
+        yield (f"[INFO] Shared image cache: {cache.hits - hits_before} images linked without download, "
+               f"{trimmed['entries']} entries ({trimmed['evicted']} evicted).\n")
+    if segment:
+        yield (f"[INFO] Images segmented: {counters['segmented']} / {counters['queued']} "
+               f"({counters['segment_failed']} without colors).\n")
+    if fetch_error:
+        yield "[WARN] Fetch did not complete; run again to resume the remaining tiles.\n"
+    else:
+        yield "[DONE] ✅ All steps completed.\n"
@@ -4,20 +4,116 @@ download_images.py
 Modified version:
     Supports generator-based (yield) log output,
     designed for FastAPI streaming responses.
+
+Concurrent download:
+    Images are downloaded by DOWNLOAD_CONCURRENCY threads sharing one pooled
+    requests.Session (keep-alive connections), with at most
+    DOWNLOAD_CONCURRENCY images in flight and PER_HOST_LIMIT concurrent
+    requests per host. 429 / 5xx / network errors are retried with
+    Retry-After or exponential backoff. Progress lines keep the sequential
+    format: "Downloading" when an image is started, warnings when it fails.
+
+Decoding:
+    Downloaded bytes are handed to a separate pool of DECODE_WORKERS threads
+    (OpenCV releases the GIL), so decoding overlaps the network I/O of the
+    other images. JPEGs are decoded at 1/2, 1/4 or 1/8 scale
+    (cv2.IMREAD_REDUCED_COLOR_*) when the reduced image is still at least
+    MAX_LONG_SIDE, e.g. a 2048 px thumbnail is decoded straight to 512 px.
+    Decode times are summarised in a [STATS] line (per image with
+    LOG_DECODE_TIMES).
+
+Thumbnail choice:
+    images_meta.csv carries thumb_256 / 1024 / 2048 urls; the smallest one
+    whose long side is >= MAX_LONG_SIDE is downloaded (thumb_1024 for 512 px).
+    A JPEG that is already at most MAX_LONG_SIDE is saved as downloaded,
+    without decoding or re-encoding.
+
+Download order (DOWNLOAD_ORDER):
+    Rows are downloaded coarse-to-fine over the bbox (spatial_order.py):
+    one image per quadrant, then per sub-quadrant, ... so a cancelled or
+    unfinished run still covers the whole map evenly. "csv" keeps the
+    images_meta.csv order.
+
+Shared image cache (IMAGE_CACHE):
+    Saved images are stored once in IMAGE_CACHE_DIR, keyed by image id and
+    MAX_LONG_SIDE, and hardlinked into the project's data/images (see
+    image_cache.py). An image already cached by another project is linked
+    without any request; the cache is trimmed to IMAGE_CACHE_MAX_BYTES
+    (least recently used first) after each run.
+
+Packed store (PACKED_STORE):
+    Images are appended to the project's data/packed store
+    (packed_store.py) instead of one JPEG file each in data/images.
 """
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from urllib.parse import urlparse
 import csv
+import os
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
 import cv2
 import time
 
+from src.preprocess.image_cache import ImageCache, write_atomic
+from src.preprocess.spatial_order import order_rows
+from src.preprocess.packed_store import PackedStore
+from src.preprocess.parse_json import NEW_CSV_NAME
+
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
 
 # Maximum length of the longest image side after resizing (pixels)
 MAX_LONG_SIDE = 512
 
+# Thumbnail url columns of images_meta.csv and their long side (px)
+THUMB_SIZES = {256: "thumb_256_url", 1024: "thumb_1024_url", 2048: "thumb_2048_url"}
+
+# ===== Concurrent download =====
+DOWNLOAD_CONCURRENCY = 16      # Images in flight (worker threads)
+PER_HOST_LIMIT = 8             # Concurrent requests per host
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_RETRIES = 4
+BACKOFF_BASE_SECONDS = 0.5
+
+# ===== Download order =====
+DOWNLOAD_ORDER = "coarse_to_fine"   # "coarse_to_fine" (even coverage of any prefix) or "csv"
+
+# ===== Shared image cache =====
+IMAGE_CACHE = True
+IMAGE_CACHE_DIR = PROJECT_ROOT / "projects" / ".image_cache"   # Hidden from the project list
+IMAGE_CACHE_MAX_BYTES = 20 * 1024 ** 3
+
+# ===== Packed store =====
+PACKED_STORE = False   # Append images to data/packed instead of writing data/images/*.jpg
+
+# ✅ Shared HTTP client: keep-alive connection pool sized for the per-host limit
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=PER_HOST_LIMIT))
+SESSION.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=PER_HOST_LIMIT))
+
+# ===== Decoding =====
+DECODE_WORKERS = max(1, os.cpu_count() or 1)
+REDUCED_DECODE = True          # Decode JPEGs at 1/2, 1/4 or 1/8 scale when large enough
+LOG_DECODE_TIMES = False       # One log line per image with its decode time and scale
+
+_REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+# Start-of-frame markers (all JPEG coding processes except DHT / JPG / DAC)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+_cache = None
+_cache_lock = threading.Lock()
+
 
 def _resize_keep_ratio(img_bgr, max_long_side=MAX_LONG_SIDE):
     """
@@ -36,14 +132,206 @@ def _resize_keep_ratio(img_bgr, max_long_side=MAX_LONG_SIDE):
     return resized
 
 
-def run_download_images(project_dir):
+@contextmanager
+def _host_slot(url: str):
+    """Limit concurrent requests per host to PER_HOST_LIMIT."""
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(PER_HOST_LIMIT)
+    with slot:
+        yield
+
+
+def _get_with_retry(url: str) -> bytes:
+    """GET url through the shared session; retries 429 / 5xx / network errors with backoff."""
+    last_err = None
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        backoff = BACKOFF_BASE_SECONDS * (2 ** (attempt - 1))
+        try:
+            with _host_slot(url):
+                resp = SESSION.get(url, timeout=DOWNLOAD_TIMEOUT)
+                content = resp.content
+        except requests.RequestException as e:
+            last_err = e
+            time.sleep(backoff)
+            continue
+
+        if resp.status_code == 429 or 500 <= resp.status_code < 600:
+            last_err = requests.HTTPError(f"{resp.status_code} for url: {url}", response=resp)
+            retry_after = resp.headers.get("Retry-After")
+            time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else backoff)
+            continue
+
+        resp.raise_for_status()   # Other 4xx (e.g. expired thumbnail url): no retry
+        return content
+
+    raise RuntimeError(f"Download failed after {DOWNLOAD_RETRIES} attempts: {last_err}")
+
+
+def _jpeg_size(content: bytes):
+    """(width, height) from the JPEG start-of-frame header, or None if not a JPEG."""
+    if content[:2] != b"\xff\xd8":
+        return None
+    i = 2
+    n = len(content)
+    while i + 9 <= n:
+        if content[i] != 0xFF:
+            i += 1
+            continue
+        marker = content[i + 1]
+        if marker == 0xFF or marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2  # fill byte / markers without a length
+            continue
+        if marker in _SOF_MARKERS:
+            h = int.from_bytes(content[i + 5:i + 7], "big")
+            w = int.from_bytes(content[i + 7:i + 9], "big")
+            return w, h
+        i += 2 + int.from_bytes(content[i + 2:i + 4], "big")
+    return None
+
+
+def _pick_thumb_url(row: dict, max_long_side=MAX_LONG_SIDE):
+    """Smallest thumbnail url with long side >= max_long_side (else the largest available), or None."""
+    available = [(size, row.get(field)) for size, field in sorted(THUMB_SIZES.items()) if row.get(field)]
+    for size, url in available:
+        if size >= max_long_side:
+            return url
+    return available[-1][1] if available else None
+
+
+def _decode_scale(size, max_long_side=MAX_LONG_SIDE) -> int:
+    """Largest JPEG DCT scale-down (8, 4, 2) that keeps the long side >= max_long_side; 1 = full decode."""
+    if not REDUCED_DECODE or size is None:
+        return 1
+    long_side = max(size)
+    for scale in (8, 4, 2):
+        if long_side // scale >= max_long_side:
+            return scale
+    return 1
+
+
+def _image_cache():
+    """Shared ImageCache, or None when IMAGE_CACHE is off."""
+    global _cache
+    if not IMAGE_CACHE:
+        return None
+    with _cache_lock:
+        if _cache is None or _cache.root != Path(IMAGE_CACHE_DIR):
+            _cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+        _cache.max_bytes = IMAGE_CACHE_MAX_BYTES
+        return _cache
+
+
+def _packed(out_path: Path) -> bool:
+    return PACKED_STORE and out_path.suffix.lower() == ".jpg"
+
+
+def _pack_for(out_path: Path) -> PackedStore:
+    """Packed store of the project that out_path (data/images/{id}.jpg) belongs to."""
+    return PackedStore.open(out_path.parent.parent)
+
+
+def _have_image(out_path: Path) -> bool:
+    """Image already saved (as a file, or in the packed store)."""
+    return out_path.exists() or (_packed(out_path) and _pack_for(out_path).has(out_path.stem, "image"))
+
+
+def _link_cached(out_path: Path) -> bool:
+    """Link the cached image for out_path (id = file stem) into place; False on a cache miss."""
+    cache = _image_cache()
+    if cache is None:
+        return False
+    if _packed(out_path):
+        data = cache.read(out_path.stem, MAX_LONG_SIDE)
+        if data is None:
+            return False
+        _pack_for(out_path).put_image(out_path.stem, data)
+        return True
+    return cache.link_into(out_path.stem, MAX_LONG_SIDE, out_path)
+
+
+def _write_image(out_path: Path, data: bytes):
+    """Store the saved image in the shared cache and link it to out_path (or write it directly)."""
+    cache = _image_cache()
+    if _packed(out_path):
+        if cache is not None:
+            cache.put(out_path.stem, MAX_LONG_SIDE, data)
+        _pack_for(out_path).put_image(out_path.stem, data)
+    elif cache is not None and out_path.suffix.lower() == ".jpg":
+        cache.put(out_path.stem, MAX_LONG_SIDE, data, out_path)
+    else:
+        write_atomic(out_path, data)
+
+
+def _save_image(content: bytes, out_path: Path) -> dict:
+    """
+    Decode downloaded bytes, resize and save to out_path (runs in the decode pool).
+
+    Returns {"ok", "decode_ms", "scale"}; ok is False if the bytes cannot be decoded,
+    scale 0 means the downloaded JPEG was saved as is.
+    """
+    size = _jpeg_size(content)
+
+    # ---- 0. JPEG already at the target size: keep the downloaded bytes ----
+    if size is not None and max(size) <= MAX_LONG_SIDE and out_path.suffix.lower() in (".jpg", ".jpeg"):
+        _write_image(out_path, content)
+        return {"ok": True, "decode_ms": 0.0, "scale": 0}
+
+    # ---- 1. Decode bytes into a BGR image (at reduced scale when possible) ----
+    scale = _decode_scale(size)
+    data = np.frombuffer(content, np.uint8)
+    t0 = time.perf_counter()
+    img_bgr = cv2.imdecode(data, _REDUCED_FLAGS[scale] if scale > 1 else cv2.IMREAD_COLOR)
+    decode_ms = (time.perf_counter() - t0) * 1000
+    if img_bgr is None:
+        return {"ok": False, "decode_ms": decode_ms, "scale": scale}
+
+    # ---- 2. Resize: reduce resolution (no-op when the reduced decode hit the target) ----
+    img_small = _resize_keep_ratio(img_bgr, MAX_LONG_SIDE)
+
+    # ---- 3. Save resized image (temp file + rename: no partial .jpg after an interrupt) ----
+    ok, buf = cv2.imencode(out_path.suffix or ".jpg", img_small)
+    if ok:
+        _write_image(out_path, buf.tobytes())
+    return {"ok": bool(ok), "decode_ms": decode_ms, "scale": scale}
+
+
+def _download_one(url: str, out_path: Path) -> bool:
+    """
+    Download one image, resize it and save it to out_path
+    (linked from the shared image cache when it is already there).
+
+    Returns False if the bytes cannot be decoded; raises on HTTP / IO errors.
+    """
+    if _link_cached(out_path):
+        return True
+    return _save_image(_get_with_retry(url), out_path)["ok"]
+
+
+def _format_decode_stats(decode_ms: list, scales: list) -> str:
+    kept = sum(1 for s in scales if s == 0)
+    ms = np.array([t for t, s in zip(decode_ms, scales) if s > 0])
+    if not len(ms):
+        return f"[STATS] decode: no images decoded | saved as downloaded {kept}/{len(scales)} images"
+    reduced = sum(1 for s in scales if s > 1)
+    return (
+        f"[STATS] decode avg {ms.mean():.1f} ms | p50 {np.percentile(ms, 50):.1f} ms | "
+        f"p95 {np.percentile(ms, 95):.1f} ms | reduced-scale decode {reduced}/{len(scales)} images | "
+        f"saved as downloaded {kept}/{len(scales)} images"
+    )
+
+
+def run_download_images(project_dir, new_only=False):
     """
     Generator function:
     Gradually yields log strings instead of executing everything at once.
     Intended for FastAPI streaming output.
+    new_only: download only the rows of images_meta_new.csv (after a refresh fetch).
     """
     project_dir = Path(project_dir)
-    csv_path = project_dir / "data" / "csv" / "images_meta.csv"
+    csv_path = project_dir / "data" / "csv" / (NEW_CSV_NAME if new_only else "images_meta.csv")
     img_dir = project_dir / "data" / "images"
     img_dir.mkdir(parents=True, exist_ok=True)
 
@@ -59,50 +347,82 @@ def run_download_images(project_dir):
 
     total_count = len(rows)
     yield f"[INFO] Found {total_count} image records. Starting processing...\n"
+    if DOWNLOAD_ORDER == "coarse_to_fine":
+        rows = order_rows(rows)
 
-    # 2. Iterate and download images
+    # 2. Download concurrently; at most DOWNLOAD_CONCURRENCY images in flight
+    todo = []
+    linked = 0
     for index, row in enumerate(rows):
         img_id = row.get("id")
-        url = row.get("thumb_2048_url")
-
-        # Progress prefix, e.g. [1/50]
-        prefix = f"[{index + 1}/{total_count}]"
-
+        url = _pick_thumb_url(row)
         if not img_id or not url:
             continue
-
         out_path = img_dir / f"{img_id}.jpg"
-        if out_path.exists():
-            # yield f"[INFO] {prefix} Already exists, skipping {img_id}\n"
-            # To avoid flooding logs, skip messages can be commented out
+        if _have_image(out_path):
+            # Already downloaded (skip messages are not logged to avoid flooding)
             continue
+        if _link_cached(out_path):
+            # Downloaded by another project: hardlinked from the shared cache, no request
+            linked += 1
+            continue
+        # Progress prefix, e.g. [1/50]
+        todo.append((f"[{index + 1}/{total_count}]", img_id, url, out_path))
 
-        yield f"[INFO] {prefix} Downloading {img_id} ...\n"
-
-        try:
-            resp = requests.get(url, timeout=60)
-            resp.raise_for_status()
-
-            # ---- 1. Decode bytes into a BGR image ----
-            data = np.frombuffer(resp.content, np.uint8)
-            img_bgr = cv2.imdecode(data, cv2.IMREAD_COLOR)
-
-            if img_bgr is None:
-                yield f"[WARN] {prefix} Failed to decode image, skipping {img_id}\n"
-                continue
-
-            # ---- 2. Resize: reduce resolution ----
-            img_small = _resize_keep_ratio(img_bgr, MAX_LONG_SIDE)
-
-            # ---- 3. Save resized image ----
-            cv2.imwrite(str(out_path), img_small)
-
-            # (Optional) Small delay to avoid overwhelming the frontend renderer
-            # time.sleep(0.05)
+    # Network pool fetches bytes, decode pool decodes / resizes / encodes them.
+    # An image counts as in flight until it is saved, which bounds buffered bytes.
+    net = ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="download")
+    cpu = ThreadPoolExecutor(max_workers=DECODE_WORKERS, thread_name_prefix="decode")
+    in_flight = {}
+    failed = 0
+    decode_ms = []
+    scales = []
+    try:
+        pending = iter(todo)
+        while True:
+            for prefix, img_id, url, out_path in pending:
+                yield f"[INFO] {prefix} Downloading {img_id} ...\n"
+                in_flight[net.submit(_get_with_retry, url)] = (prefix, img_id, out_path)
+                if len(in_flight) >= DOWNLOAD_CONCURRENCY:
+                    break
+            if not in_flight:
+                break
 
-        except Exception as e:
-            yield f"[WARN] {prefix} Failed to download or save {img_id}: {e}\n"
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                prefix, img_id, out_path = in_flight.pop(fut)
+                try:
+                    result = fut.result()
+                    if isinstance(result, bytes):
+                        # Downloaded: hand over to the decode pool
+                        in_flight[cpu.submit(_save_image, result, out_path)] = (prefix, img_id, out_path)
+                        continue
+                    decode_ms.append(result["decode_ms"])
+                    scales.append(result["scale"])
+                    if not result["ok"]:
+                        failed += 1
+                        yield f"[WARN] {prefix} Failed to decode image, skipping {img_id}\n"
+                    elif LOG_DECODE_TIMES and result["scale"] == 0:
+                        yield f"[INFO] {prefix} Saved {img_id} (no decode, already at target size)\n"
+                    elif LOG_DECODE_TIMES:
+                        yield (f"[INFO] {prefix} Saved {img_id} "
+                               f"(decode {result['decode_ms']:.1f} ms at 1/{result['scale']} scale)\n")
+                except Exception as e:
+                    failed += 1
+                    yield f"[WARN] {prefix} Failed to download or save {img_id}: {e}\n"
+    finally:
+        # Client disconnected: drop queued work, let running tasks finish in the background
+        net.shutdown(wait=False, cancel_futures=True)
+        cpu.shutdown(wait=False, cancel_futures=True)
 
+    yield f"[INFO] Downloaded {len(todo) - failed} / {len(todo)} new images ({failed} failed).\n"
+    yield _format_decode_stats(decode_ms, scales) + "\n"
+    cache = _image_cache()
+    if cache is not None:
+        trimmed = cache.evict()
+        yield (f"[STATS] image cache: {linked} linked from cache | {trimmed['entries']} entries, "
+               f"{trimmed['bytes'] / 1024 ** 2:.1f} MB | evicted {trimmed['evicted']} "
+               f"({trimmed['freed_bytes'] / 1024 ** 2:.1f} MB)\n")
     yield "[SUCCESS] ✅ All images have been processed.\n"
 
 
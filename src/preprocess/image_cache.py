@@ -0,0 +1,145 @@
+"""
+image_cache.py
+
+Shared, size-bounded cache of downloaded images, used by download_images.py
+so that projects with overlapping bboxes download each image only once.
+
+    projects/.image_cache/
+        512/            one directory per resolution (MAX_LONG_SIDE)
+            69/         shard: last two characters of the image id
+                1234567890123469.jpg
+
+Entries are keyed by (image id, resolution) and hold the processed image
+(resized, as saved into data/images). Projects get a hardlink to the cache
+entry (a copy where hardlinks are not supported, e.g. across filesystems),
+so an image shared by several projects is stored and downloaded once.
+
+LRU: a cache hit touches the entry's mtime; evict() removes the least
+recently used entries until the cache is below max_bytes. Evicting an entry
+does not affect projects that already link it (their link keeps the file).
+Files are replaced atomically (temp file + rename), never written in place,
+so a project's linked image never changes underneath it.
+"""
+
+import os
+import shutil
+import threading
+from pathlib import Path
+
+
+class ImageCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+
+        # Monitoring
+        self.hits = 0
+        self.added = 0
+
+    def path_for(self, img_id: str, size: int) -> Path:
+        img_id = str(img_id)
+        return self.root / str(size) / img_id[-2:] / f"{img_id}.jpg"
+
+    # ---------- Read ----------
+
+    def link_into(self, img_id: str, size: int, out_path: Path) -> bool:
+        """
+        Link the cached image into out_path (and mark it recently used).
+
+        Returns False if the image is not cached.
+        """
+        src = self.path_for(img_id, size)
+        try:
+            os.utime(src)
+            _link_or_copy(src, out_path)
+        except FileNotFoundError:
+            return False
+        with self._lock:
+            self.hits += 1
+        return True
+
+    def read(self, img_id: str, size: int):
+        """Cached image bytes (and mark them recently used), or None."""
+        src = self.path_for(img_id, size)
+        try:
+            os.utime(src)
+            data = src.read_bytes()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    # ---------- Write ----------
+
+    def put(self, img_id: str, size: int, data: bytes, out_path: Path = None) -> Path:
+        """Store image bytes (atomically) and link them into out_path if given."""
+        dst = self.path_for(img_id, size)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(dst, data)
+        with self._lock:
+            self.added += 1
+        if out_path is not None:
+            _link_or_copy(dst, out_path)
+        return dst
+
+    # ---------- Eviction ----------
+
+    def _entries(self):
+        """(mtime, size, path) of every cache entry."""
+        out = []
+        if not self.root.exists():
+            return out
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(".jpg"):
+                    continue
+                p = Path(dirpath) / name
+                try:
+                    st = p.stat()
+                except FileNotFoundError:
+                    continue
+                out.append((st.st_mtime, st.st_size, p))
+        return out
+
+    def evict(self) -> dict:
+        """Remove least recently used entries until the cache is within max_bytes."""
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        removed = 0
+        freed = 0
+        if total > self.max_bytes:
+            entries.sort(key=lambda e: e[0])
+            for _, size, p in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    p.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= size
+                freed += size
+                removed += 1
+        return {"entries": len(entries) - removed, "bytes": total, "evicted": removed, "freed_bytes": freed}
+
+
+def write_atomic(out_path: Path, data: bytes):
+    """Write to a temp file next to out_path, then rename over it."""
+    out_path = Path(out_path)
+    tmp_path = out_path.with_name(f"{out_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, out_path)
+
+
+def _link_or_copy(src: Path, dst: Path):
+    """Hardlink src to dst (replacing dst); copy when hardlinks are not possible."""
+    dst = Path(dst)
+    tmp = dst.with_name(f"{dst.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        os.link(src, tmp)
+    except FileNotFoundError:
+        raise                       # src evicted meanwhile: a cache miss
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
@@ -0,0 +1,194 @@
+"""
+packed_store.py
+
+Optional packed per-project store for images and segmentation masks
+(download_images.PACKED_STORE / segment_building.PACKED_STORE), instead of
+four small files per image in images/, masks/, building_rgba/ and palettes/:
+
+    data/packed/
+        blob_000001.bin     blobs appended back to back (new file every SEGMENT_MAX_BYTES)
+        index.bin           fixed-width records (INDEX_DTYPE), memory-mapped on open
+
+Blob kinds:
+    image   JPEG bytes as saved by download_images (no re-encode)
+    mask    building mask: np.packbits + zlib (one bit per pixel)
+    alpha   shadow-free building alpha (mask minus shadows), same encoding
+
+The shadow-free RGBA PNG is image + alpha and the palette PNG is that plus
+the colors in color_summary.csv, so neither is stored; api_main renders
+them (and masks / images) on request under their usual static urls.
+
+Like raw_store, the index record is written after its blob, so an
+interrupted append leaves no record; unreferenced blob tails and a torn
+index record are cut off on open. The last record of a (key, kind) wins:
+blobs are never modified in place.
+
+One PackedStore instance per directory and process (PackedStore.open),
+shared by the download and segmentation threads.
+"""
+
+import threading
+import zlib
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+PACKED_DIRNAME = "packed"
+INDEX_NAME = "index.bin"
+SEGMENT_MAX_BYTES = 256 * 1024 * 1024
+
+KINDS = {"image": 1, "mask": 2, "alpha": 3}
+INDEX_DTYPE = np.dtype([
+    ("key", "S24"),        # image id
+    ("kind", "u1"),
+    ("segment", "u4"),
+    ("offset", "u8"),
+    ("length", "u4"),
+    ("height", "u2"),      # masks: shape of the unpacked mask
+    ("width", "u2"),
+])
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def packed_dir(data_dir: Path) -> Path:
+    return Path(data_dir) / PACKED_DIRNAME
+
+
+def has_packed(data_dir: Path) -> bool:
+    return (packed_dir(data_dir) / INDEX_NAME).exists()
+
+
+def encode_mask(mask255) -> bytes:
+    return zlib.compress(np.packbits(mask255 > 0).tobytes(), 1)
+
+
+def decode_mask(blob: bytes, height: int, width: int):
+    bits = np.unpackbits(np.frombuffer(zlib.decompress(blob), np.uint8), count=height * width)
+    return (bits.reshape(height, width) * 255).astype(np.uint8)
+
+
+class PackedStore:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.index_path = self.root / INDEX_NAME
+        self._lookup = {}          # (key, kind code) -> (segment, offset, length, height, width)
+        self._segment = 0
+        self._segment_size = 0
+        self._lock = threading.Lock()
+
+    # ---------- Open ----------
+
+    @classmethod
+    def open(cls, data_dir: Path) -> "PackedStore":
+        """Shared store of a project's data dir; repairs an interrupted append on first open."""
+        root = packed_dir(data_dir).resolve()
+        with _stores_lock:
+            store = _stores.get(root)
+            if store is None:
+                store = _stores[root] = cls(root)
+                store._load()
+            return store
+
+    def _load(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        records = np.zeros(0, dtype=INDEX_DTYPE)
+        if self.index_path.exists():
+            n = self.index_path.stat().st_size // INDEX_DTYPE.itemsize
+            if n:
+                records = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode="r", shape=(n,))
+            with self.index_path.open("r+b") as f:
+                f.truncate(n * INDEX_DTYPE.itemsize)   # torn last record
+
+        ends = {}
+        for rec in records:
+            seg, off, length = int(rec["segment"]), int(rec["offset"]), int(rec["length"])
+            self._lookup[(rec["key"].decode(), int(rec["kind"]))] = (
+                seg, off, length, int(rec["height"]), int(rec["width"]))
+            ends[seg] = max(ends.get(seg, 0), off + length)
+        del records
+
+        for seg_path in self.root.glob("blob_*.bin"):
+            seg = int(seg_path.stem.split("_")[1])
+            end = ends.get(seg, 0)
+            if seg_path.stat().st_size > end:
+                with seg_path.open("r+b") as f:
+                    f.truncate(end)
+
+        self._segment = max(ends, default=1)
+        self._segment_size = ends.get(self._segment, 0)
+
+    def _segment_path(self, seg: int) -> Path:
+        return self.root / f"blob_{seg:06d}.bin"
+
+    # ---------- Write ----------
+
+    def put(self, key: str, kind: str, blob: bytes, height: int = 0, width: int = 0):
+        key = str(key)
+        if len(key.encode()) > INDEX_DTYPE["key"].itemsize:
+            raise ValueError(f"Key too long for the packed index: {key}")
+        code = KINDS[kind]
+        with self._lock:
+            if self._segment_size and self._segment_size + len(blob) > SEGMENT_MAX_BYTES:
+                self._segment += 1
+                self._segment_size = 0
+            with self._segment_path(self._segment).open("ab") as f:
+                offset = f.tell()
+                f.write(blob)
+
+            rec = np.zeros(1, dtype=INDEX_DTYPE)
+            rec[0] = (key.encode(), code, self._segment, offset, len(blob), height, width)
+            # Index record last: until it exists, the blob is not part of the store
+            with self.index_path.open("ab") as f:
+                f.write(rec.tobytes())
+
+            self._segment_size = offset + len(blob)
+            self._lookup[(key, code)] = (self._segment, offset, len(blob), height, width)
+
+    def put_image(self, key: str, jpeg: bytes):
+        self.put(key, "image", jpeg)
+
+    def put_mask(self, key: str, kind: str, mask255):
+        h, w = mask255.shape[:2]
+        self.put(key, kind, encode_mask(mask255), h, w)
+
+    # ---------- Read ----------
+
+    def has(self, key: str, kind: str) -> bool:
+        return (str(key), KINDS[kind]) in self._lookup
+
+    def keys(self, kind: str) -> list:
+        code = KINDS[kind]
+        return [k for k, c in list(self._lookup) if c == code]
+
+    def get(self, key: str, kind: str):
+        """Raw blob, or None if the key is not stored."""
+        entry = self._lookup.get((str(key), KINDS[kind]))
+        if entry is None:
+            return None
+        seg, offset, length, _, _ = entry
+        with self._segment_path(seg).open("rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def get_image(self, key: str):
+        """Decoded BGR image, or None."""
+        blob = self.get(key, "image")
+        return None if blob is None else cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_COLOR)
+
+    def get_mask(self, key: str, kind: str):
+        """0 / 255 uint8 mask, or None."""
+        entry = self._lookup.get((str(key), KINDS[kind]))
+        if entry is None:
+            return None
+        return decode_mask(self.get(key, kind), entry[3], entry[4])
+
+    def totals(self) -> dict:
+        out = {kind: 0 for kind in KINDS}
+        names = {code: kind for kind, code in KINDS.items()}
+        for _, code in list(self._lookup):
+            out[names[code]] += 1
+        out["bytes"] = sum(p.stat().st_size for p in self.root.glob("blob_*.bin"))
+        return out
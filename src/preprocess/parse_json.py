@@ -1,15 +1,60 @@
 """
 parse_json.py
 
-Extract image id, url, coordinates, etc. from data/raw/*.json,
+Extract image id, url, coordinates, etc. from the raw pages in data/raw
+(compact raw store, see raw_store.py, or legacy images_*.json page files),
 perform deduplication + spatial thinning (keep at most 1 image per 50m),
 and export to data/csv/images_meta.csv for download_images.py to use.
+
+Rows whose id was not in the previous images_meta.csv are also written to
+data/csv/images_meta_new.csv (e.g. the images added by a refresh fetch).
+
+Cell winner (CELL_WINNER):
+    "centre": the image closest to the 50m cell centre wins (ties: smallest id).
+              Raw pages are read in chunks by a process pool (PARSE_WORKERS);
+              each chunk returns a candidate table and a deterministic reduce
+              picks one record per id and one winner per cell, so the output
+              does not depend on page order (which follows the async fetch's
+              completion order). Rows are sorted by id.
+    "first":  the first image read claims the cell (original behaviour, and
+              the only option for the streaming pipeline, which downloads rows
+              as soon as they are accepted).
+
+Thinning (THINNING):
+    "grid":   at most one image per GRID_SIZE_M cell (see CELL_WINNER). Two
+              images 1m apart on either side of a cell border are both kept.
+    "radius": true minimum distance: greedy Poisson-disk selection (images in
+              id order, accepted when no accepted image is closer than the
+              radius) on a hashed grid with neighbour lookup. All radii in
+              THINNING_RADII_M are computed from one read of the raw pages:
+              GRID_SIZE_M -> images_meta.csv, others -> images_meta_r{R}m.csv.
+
+Streaming (STREAM_PARSE): page files larger than STREAM_PARSE_MIN_BYTES are
+read item by item with ijson and raw-store pages line by line, and every item is reduced to (id, url, lon, lat)
+right away, so peak memory is bounded by PARSE_BATCH_RECORDS ("first") or
+PARSE_CHUNK_PAGES ("centre" / "radius") compact records instead of whole
+decoded pages.
+
+In "first" mode filtering is vectorized: records are read in batches of
+PARSE_BATCH_RECORDS, grid cells are computed with NumPy and ids / cells are
+deduplicated with np.unique. The result (rows, order and stats) is the same
+as the original per-item loop (_filter_records_loop), which is still used
+for the rare batches where one image id shows up in different cells.
 """
 
 from pathlib import Path
 import json
 import csv
+import hashlib
 import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+
+from src.preprocess import raw_store
 
 # Repository root directory, e.g. D:/tommytao/city-color-map
 PROJECT_ROOT = Path(__file__).resolve().parents[2]
@@ -18,6 +63,29 @@ PROJECT_ROOT = Path(__file__).resolve().parents[2]
 GRID_SIZE_M = 50  # Keep at most 1 image per 50 meters
 EARTH_RADIUS_M = 6378137.0  # WGS84
 
+# ===== Cell winner =====
+CELL_WINNER = "centre"           # "centre" (order-independent, parallel) or "first" (first image read wins)
+PARSE_WORKERS = max(1, min(8, (os.cpu_count() or 1) - 1))   # Processes for "centre" mode
+PARSE_CHUNK_PAGES = 64           # Raw pages per pool task
+
+# ===== Thinning =====
+THINNING = "grid"                  # "grid" (one image per cell) or "radius" (true minimum distance)
+THINNING_RADII_M = (25, 50, 100)   # "radius" mode: variants written in one pass (GRID_SIZE_M is the main CSV)
+
+# ===== Streaming =====
+STREAM_PARSE = True                # Iterate page items incrementally (ijson) instead of json.load per page
+STREAM_PARSE_MIN_BYTES = 512 * 1024  # A full page (LIMIT=2000, three signed thumb urls each) is ~1.7 MB;
+                                    # smaller pages are json.load-ed (faster, and small anyway)
+
+# ===== Batch filtering =====
+VECTORIZED_PARSE = True          # False: per-item Python loop (reference implementation)
+PARSE_BATCH_RECORDS = 200_000    # Records filtered per NumPy batch
+
+# Thumbnail urls kept per image (largest first); download_images picks the smallest sufficient one
+THUMB_FIELDS = ("thumb_2048_url", "thumb_1024_url", "thumb_256_url")
+CSV_FIELDS = ["id", "thumb_2048_url", "lon", "lat", "thumb_1024_url", "thumb_256_url"]
+NEW_CSV_NAME = "images_meta_new.csv"
+
 # ===== Utility functions =====
 
 def _lonlat_to_meter(lon, lat):
@@ -39,13 +107,42 @@ def _grid_cell_id(lon, lat, grid_size_m):
     return gx, gy
 
 
-# ===== Single-file parsing =====
-def _parse_one_file(json_path: Path, writer: csv.DictWriter, seen_ids: set, used_cells: set, stats: dict):
-    with json_path.open("r", encoding="utf-8") as f:
-        data = json.load(f)
+# ===== Item parsing =====
+def _item_fields(item: dict):
+    """
+    Return (id, urls, lon, lat) from either an API item
+    or a flattened raw-store record (see raw_store.compact_item).
+
+    urls is the tuple of THUMB_FIELDS values, or None if the item has no thumbnail url.
+    """
+    img_id = item.get("id")
+    url = tuple(item.get(f) for f in THUMB_FIELDS)
+    if not any(url):
+        url = None
+    if "computed_geometry" in item or "lon" not in item:
+        geom = item.get("computed_geometry") or {}
+        coords = geom.get("coordinates") or []
+        if len(coords) < 2:
+            return img_id, url, None, None
+        return img_id, url, coords[0], coords[1]
+    return img_id, url, item.get("lon"), item.get("lat")
+
+
+def _make_row(img_id, urls, lon, lat) -> dict:
+    row = {"id": img_id, "lon": lon, "lat": lat}
+    row.update(zip(THUMB_FIELDS, urls))
+    return row
+
+
+def _filter_records_loop(records, seen_ids: set, used_cells: set, stats: dict):
+    """
+    Per-item filter (reference implementation).
 
-    for item in data.get("data", []):
-        img_id = item.get("id")
+    records: list of (id, url, lon, lat)
+    Returns the rows to write, in input order.
+    """
+    rows = []
+    for img_id, url, lon, lat in records:
         if not img_id:
             stats["skip_no_id"] += 1
             continue
@@ -55,18 +152,10 @@ def _parse_one_file(json_path: Path, writer: csv.DictWriter, seen_ids: set, used
             stats["skip_dup_id"] += 1
             continue
 
-        url = item.get("thumb_2048_url")
         if not url:
             stats["skip_no_url"] += 1
             continue
 
-        geom = item.get("computed_geometry") or {}
-        coords = geom.get("coordinates") or []
-        if len(coords) < 2:
-            stats["skip_no_coord"] += 1
-            continue
-
-        lon, lat = coords[0], coords[1]
         if lon is None or lat is None:
             stats["skip_no_coord"] += 1
             continue
@@ -77,64 +166,478 @@ def _parse_one_file(json_path: Path, writer: csv.DictWriter, seen_ids: set, used
             stats["skip_dense"] += 1
             continue
 
-        # ---- Passed filters, write to CSV ----
+        # ---- Passed filters ----
         seen_ids.add(img_id)
         used_cells.add(cell_id)
+        rows.append(_make_row(img_id, url, lon, lat))
+    return rows
 
-        writer.writerow(
-            {
-                "id": img_id,
-                "thumb_2048_url": url,
-                "lon": lon,
-                "lat": lat,
-            }
-        )
-        stats["written"] += 1
 
+def _lonlat_to_meter_np(lon: np.ndarray, lat: np.ndarray):
+    """Vectorized _lonlat_to_meter."""
+    return np.radians(lon) * EARTH_RADIUS_M * np.cos(np.radians(lat)), np.radians(lat) * EARTH_RADIUS_M
 
-# ===== FastAPI entry point =====
-def run_parse_json(project_dir):
+
+def _grid_cells_np(lon: np.ndarray, lat: np.ndarray, grid_size_m):
+    """Vectorized _grid_cell_id: returns (gx, gy) int64 arrays."""
+    x, y = _lonlat_to_meter_np(lon, lat)
+    return np.floor_divide(x, grid_size_m).astype(np.int64), np.floor_divide(y, grid_size_m).astype(np.int64)
+
+
+def _filter_records_np(records, seen_ids: set, used_cells: set, stats: dict):
     """
-    Parse all JSON files under projects/{project_name}/data/raw,
-    extract fields -> deduplicate -> spatial thinning (50m),
-    and write to projects/{project_name}/data/csv/images_meta.csv
+    Vectorized equivalent of _filter_records_loop.
+
+    In the loop, a record is written when its id has not been written before
+    and its cell is still free. As long as every image id maps to a single
+    cell, that reduces to:
+        - the first record per free cell (with url + coordinates) is written
+        - any record after the write of its id is a duplicate
+        - the other records fail on url / coordinates / density
+    which needs no sequential state. Returns None (caller falls back to the
+    loop) if an id appears in several cells within the batch.
     """
-    project_dir = Path(project_dir)
-    raw_dir = project_dir / "data" / "raw"
-    csv_dir = project_dir / "data" / "csv"
-    csv_dir.mkdir(parents=True, exist_ok=True)
+    n = len(records)
+    if n == 0:
+        return []
+
+    # ---- Columns ----
+    ids = [r[0] for r in records]
+    has_id = np.fromiter(map(bool, ids), dtype=bool, count=n)
+    has_url = np.fromiter(map(bool, [r[1] for r in records]), dtype=bool, count=n)
+    lon = np.array([r[2] for r in records], dtype=np.float64)     # None -> nan
+    lat = np.array([r[3] for r in records], dtype=np.float64)
+    has_coord = ~(np.isnan(lon) | np.isnan(lat))
+
+    # id -> dense integer code (-1 = no id), via the ids' hashes;
+    # a hash collision between different ids sends the batch to the loop
+    id_list = [i for i in ids if i]
+    n_ids = len(set(id_list))      # also caches the str hashes used below
+    hashes = np.fromiter(map(hash, id_list), dtype=np.int64, count=len(id_list))
+    uniq_hashes, rep, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    if len(uniq_hashes) != n_ids:
+        return None
+    codes = np.full(n, -1, dtype=np.int64)
+    codes[has_id] = inverse
+    code_seen = np.fromiter((id_list[i] in seen_ids for i in rep.tolist()), dtype=bool, count=len(rep)) \
+        if seen_ids else np.zeros(len(rep), dtype=bool)
+    pre_seen = has_id & code_seen[np.maximum(codes, 0)] if len(rep) else np.zeros(n, dtype=bool)
+
+    cand = np.flatnonzero(has_id & ~pre_seen & has_url & has_coord)
+    gx, gy = _grid_cells_np(lon[cand], lat[cand], GRID_SIZE_M)
+    keys = (gx << 32) + (gy + (1 << 31))
+    cells, first, cell_of = np.unique(keys, return_index=True, return_inverse=True)
+
+    # ---- One cell per id, otherwise the loop decides ----
+    cand_codes = codes[cand]
+    if len(np.unique(cand_codes * len(cells) + cell_of)) != len(np.unique(cand_codes)):
+        return None
+
+    # ---- First candidate per free cell ----
+    free = np.fromiter(
+        ((a, b) not in used_cells for a, b in zip(gx[first].tolist(), gy[first].tolist())),
+        dtype=bool, count=len(first),
+    ) if used_cells else np.ones(len(first), dtype=bool)
+    first = np.sort(first[free])
+    winners = cand[first]
+    is_winner = np.zeros(n, dtype=bool)
+    is_winner[winners] = True
+
+    # ---- Duplicates: records after the write of their id ----
+    write_pos = np.full(len(rep) + 1, n, dtype=np.int64)
+    write_pos[codes[winners]] = winners
+    dup = has_id & (pre_seen | (np.arange(n) > write_pos[np.maximum(codes, 0)]))
+
+    live = has_id & ~dup
+    stats["skip_no_id"] += int(np.count_nonzero(~has_id))
+    stats["skip_dup_id"] += int(np.count_nonzero(dup))
+    stats["skip_no_url"] += int(np.count_nonzero(live & ~has_url))
+    stats["skip_no_coord"] += int(np.count_nonzero(live & has_url & ~has_coord))
+    stats["skip_dense"] += int(np.count_nonzero(live & has_url & has_coord & ~is_winner))
+
+    rows = []
+    for i, a, b in zip(winners.tolist(), gx[first].tolist(), gy[first].tolist()):
+        img_id, url, x, y = records[i]
+        seen_ids.add(img_id)
+        used_cells.add((a, b))
+        rows.append(_make_row(img_id, url, x, y))
+    return rows
 
-    out_csv = csv_dir / "images_meta.csv"
 
-    json_files = sorted(raw_dir.glob("*.json"))
-    if not json_files:
-        print(f"[WARN] No JSON files found under {raw_dir}. Please run fetch_images first.")
-        return
+def _filter_records(records, seen_ids: set, used_cells: set, stats: dict):
+    rows = _filter_records_np(records, seen_ids, used_cells, stats) if VECTORIZED_PARSE else None
+    if rows is None:
+        rows = _filter_records_loop(records, seen_ids, used_cells, stats)
+    stats["written"] += len(rows)
+    return rows
 
-    print(f"[INFO] Found {len(json_files)} raw JSON files. Start parsing (50m thinning)...")
 
-    seen_ids = set()
-    used_cells = set()
-    stats = {
-        "written": 0,
-        "skip_dup_id": 0,
-        "skip_dense": 0,
-        "skip_no_id": 0,
-        "skip_no_url": 0,
-        "skip_no_coord": 0,
+def _parse_records(records, writer: csv.DictWriter, seen_ids: set, used_cells: set, stats: dict):
+    """Filter a batch of (id, url, lon, lat) records into the CSV writer; returns the rows written."""
+    rows = _filter_records(records, seen_ids, used_cells, stats)
+    writer.writerows(rows)
+    return rows
+
+
+def _parse_items(items, writer: csv.DictWriter, seen_ids: set, used_cells: set, stats: dict):
+    """
+    Filter one page (or batch) of items into the CSV writer.
+
+    Returns:
+        list of the rows written (used by the streaming pipeline)
+    """
+    return _parse_records([_item_fields(item) for item in items], writer, seen_ids, used_cells, stats)
+
+
+# ===== Order-independent parsing ("centre" mode) =====
+# Rank of a record for its id: complete first, then url without coordinates, then no url
+RANK_COMPLETE, RANK_NO_COORD, RANK_NO_URL = 0, 1, 2
+
+
+def _cell_centre_dist(lon: np.ndarray, lat: np.ndarray, grid_size_m):
+    """Returns (cell key, distance in meters to the cell centre)."""
+    x, y = _lonlat_to_meter_np(lon, lat)
+    gx = np.floor_divide(x, grid_size_m)
+    gy = np.floor_divide(y, grid_size_m)
+    dist = np.hypot(x - (gx + 0.5) * grid_size_m, y - (gy + 0.5) * grid_size_m)
+    keys = (gx.astype(np.int64) << 32) + (gy.astype(np.int64) + (1 << 31))
+    return keys, dist
+
+
+def _first_per_group(groups: np.ndarray, order: np.ndarray) -> np.ndarray:
+    """Indices of the first element of every group along `order` (a sort by groups first)."""
+    g = groups[order]
+    head = np.ones(len(g), dtype=bool)
+    head[1:] = g[1:] != g[:-1]
+    return order[head]
+
+
+def _url_key(urls) -> int:
+    """Stable 63-bit hash of a url tuple (0 without urls), the last per-id tie-break."""
+    if not urls:
+        return 0
+    digest = hashlib.blake2b("\n".join(u or "" for u in urls).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") >> 1
+
+
+def _best_per_id(codes, rank, dist, url_key):
+    """
+    Best record of every id: complete > url only > none, then closest to the
+    cell centre, then smallest url key (so the pick does not depend on the
+    order pages were fetched in), then first.
+    """
+    return _first_per_group(codes, np.lexsort((np.arange(len(codes)), url_key, dist, rank, codes)))
+
+
+def _best_per_cell(reps, codes, rank, keys, dist):
+    """Among the complete id records `reps`: the one closest to its cell centre (ties: smallest id)."""
+    complete = reps[rank[reps] == RANK_COMPLETE]
+    order = complete[np.lexsort((codes[complete], dist[complete], keys[complete]))]
+    return complete, _first_per_group(keys, order)
+
+
+def _candidate_table(records, want_ids=None, all_urls=False) -> dict:
+    """
+    Candidate table of one chunk of records (id, url, lon, lat):
+    one row per id (its best record in the chunk), plus the urls of the
+    ids that win their cell within the chunk (and of `want_ids`), or of
+    every complete row with all_urls=True.
+    """
+    with_id = [r for r in records if r[0]]
+    n = len(with_id)
+    ids = np.array([str(r[0]) for r in with_id], dtype=str)
+    has_url = np.fromiter(map(bool, [r[1] for r in with_id]), dtype=bool, count=n)
+    lon = np.array([r[2] for r in with_id], dtype=np.float64)     # None -> nan
+    lat = np.array([r[3] for r in with_id], dtype=np.float64)
+    has_coord = ~(np.isnan(lon) | np.isnan(lat))
+    rank = np.where(has_url, np.where(has_coord, RANK_COMPLETE, RANK_NO_COORD), RANK_NO_URL).astype(np.int8)
+    url_key = np.fromiter((_url_key(r[1]) for r in with_id), dtype=np.int64, count=n)
+
+    keys = np.zeros(n, dtype=np.int64)
+    dist = np.full(n, np.inf)
+    ok = rank == RANK_COMPLETE
+    keys[ok], dist[ok] = _cell_centre_dist(lon[ok], lat[ok], GRID_SIZE_M)
+
+    # Ids sort the same way in every chunk, so codes order == id order
+    _, codes = np.unique(ids, return_inverse=True)
+    reps = _best_per_id(codes, rank, dist, url_key)
+    _, best = _best_per_cell(reps, codes, rank, keys, dist)
+
+    send = set(reps[rank[reps] == RANK_COMPLETE].tolist() if all_urls else best.tolist())
+    if want_ids:
+        send.update(i for i in reps.tolist() if ids[i] in want_ids)
+    return {
+        "records": n,
+        "no_id": len(records) - n,
+        "ids": ids[reps],
+        "rank": rank[reps],
+        "keys": keys[reps],
+        "dist": dist[reps],
+        "url_key": url_key[reps],
+        "lon": lon[reps],
+        "lat": lat[reps],
+        "urls": {str(ids[i]): with_id[i][1] for i in send},
     }
 
-    with out_csv.open("w", newline="", encoding="utf-8") as f:
-        fieldnames = ["id", "thumb_2048_url", "lon", "lat"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
 
-        for jf in json_files:
-            print(f"[INFO] Parsing {jf.name}")
-            _parse_one_file(jf, writer, seen_ids, used_cells, stats)
+def _chunk_candidates(task, want_ids=None, all_urls=False) -> dict:
+    """
+    Pool worker: candidate table of one chunk of raw pages.
+
+    task: ("store", raw_dir, [index entries]) or ("files", None, [page file paths])
+    """
+    kind, raw_dir, pages = task
+    records = []
+    if kind == "store":
+        store = raw_store.RawStore(raw_store.store_dir(raw_dir))
+        for entry in pages:
+            records.extend(map(_item_fields, store.iter_page_records(entry)))
+    else:
+        for path in pages:
+            records.extend(map(_item_fields, _iter_page_items(path)))
+    return _candidate_table(records, want_ids, all_urls)
+
+
+def _parse_tasks(raw_dir: Path, sources) -> list:
+    store, files = sources
+    tasks = []
+    if store is not None:
+        for i in range(0, len(store.entries), PARSE_CHUNK_PAGES):
+            tasks.append(("store", raw_dir, store.entries[i:i + PARSE_CHUNK_PAGES]))
+    for i in range(0, len(files), PARSE_CHUNK_PAGES):
+        tasks.append(("files", None, [str(f) for f in files[i:i + PARSE_CHUNK_PAGES]]))
+    return tasks
+
+
+def _reduce_candidates(raw_dir: Path, stats: dict, tag: str = "", all_urls: bool = False):
+    """
+    Parse all raw pages in parallel and reduce them to the best record per id.
+
+    The per-id (and later per-cell / per-radius) choices are minima over a
+    total order or follow the id order, so reducing the chunk tables gives
+    the same result as one pass over all records. Tables are combined in
+    task order (not completion order), so the output does not depend on
+    the number of workers either.
 
-    print(f"[DONE] Output written to {out_csv}")
-    print(
+    Returns a dict of arrays over all chunk rows ("reps": the rows kept per id,
+    "complete": the reps with url + coordinates), or None without raw pages.
+    """
+    sources = _snapshot_raw_sources(raw_dir)
+    store = sources[0]
+    if store is not None:
+        totals = store.totals()
+        stats["skip_dup_id"] += totals["dup"]
+        stats["skip_no_id"] += totals["no_id"]
+    tasks = _parse_tasks(raw_dir, sources)
+    if not tasks:
+        return None
+
+    workers = min(PARSE_WORKERS, len(tasks))
+    print(f"[INFO] {tag}Parsing {len(tasks)} chunks of raw pages with {workers} worker(s)")
+    if workers > 1:
+        # spawn, not fork: the API server process is multithreaded and may hold torch / OpenMP state
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            tables = list(ex.map(partial(_chunk_candidates, all_urls=all_urls), tasks))
+    else:
+        tables = [_chunk_candidates(t, all_urls=all_urls) for t in tasks]
+
+    cand = {k: np.concatenate([t[k] for t in tables]) for k in ("ids", "rank", "keys", "dist", "url_key", "lon", "lat")}
+    cand["chunk"] = np.concatenate([np.full(len(t["ids"]), i, dtype=np.int64) for i, t in enumerate(tables)])
+    cand["tables"] = tables
+    cand["tasks"] = tasks
+
+    _, codes = np.unique(cand["ids"], return_inverse=True)
+    reps = _best_per_id(codes, cand["rank"], cand["dist"], cand["url_key"])
+    cand["codes"] = codes
+    cand["reps"] = reps
+    cand["complete"] = reps[cand["rank"][reps] == RANK_COMPLETE]
+
+    stats["skip_no_id"] += sum(t["no_id"] for t in tables)
+    stats["skip_dup_id"] += sum(t["records"] for t in tables) - len(reps)
+    stats["skip_no_url"] += int(np.count_nonzero(cand["rank"][reps] == RANK_NO_URL))
+    stats["skip_no_coord"] += int(np.count_nonzero(cand["rank"][reps] == RANK_NO_COORD))
+    return cand
+
+
+def _candidate_rows(cand: dict, selected: np.ndarray) -> list:
+    """CSV rows of the selected candidate rows, sorted by id."""
+    selected = selected[np.argsort(cand["codes"][selected])]
+    ids, chunk, tables = cand["ids"], cand["chunk"], cand["tables"]
+
+    # A winner's chunk sent its url, unless the id won a different cell there
+    # (same id with different coordinates in several chunks): re-read those chunks.
+    missing = {}
+    for i in selected.tolist():
+        if str(ids[i]) not in tables[chunk[i]]["urls"]:
+            missing.setdefault(int(chunk[i]), set()).add(str(ids[i]))
+    for c, want in missing.items():
+        tables[c]["urls"].update(_chunk_candidates(cand["tasks"][c], want)["urls"])
+
+    rows = []
+    for i in selected.tolist():
+        img_id = str(ids[i])
+        rows.append(_make_row(img_id, tables[chunk[i]]["urls"][img_id], float(cand["lon"][i]), float(cand["lat"][i])))
+    return rows
+
+
+def _select_centre_rows(raw_dir: Path, stats: dict, tag: str = "") -> list:
+    """One row per 50m cell: the image closest to the cell centre (ties: smallest id)."""
+    cand = _reduce_candidates(raw_dir, stats, tag)
+    if cand is None:
+        return []
+    complete, winners = _best_per_cell(cand["reps"], cand["codes"], cand["rank"], cand["keys"], cand["dist"])
+    stats["skip_dense"] += len(complete) - len(winners)
+    return _candidate_rows(cand, winners)
+
+
+# ===== Minimum-distance thinning ("radius" mode) =====
+def _min_distance_thin(x: np.ndarray, y: np.ndarray, radius_m: float) -> np.ndarray:
+    """
+    Greedy minimum-distance thinning of points (meters), in array order.
+
+    A point is kept when no kept point lies closer than radius_m. Kept points
+    are bucketed on a radius_m hashed grid, so only the 3x3 neighbouring cells
+    are checked (each holds a handful of kept points at most): O(n) after the
+    caller's O(n log n) sort. Most points in dense areas are rejected without
+    a distance check: a fine grid of side < radius_m / sqrt(2) can hold at most
+    one kept point, so any later point in an occupied fine cell is too close.
+    Returns the kept indices.
+    """
+    if len(x) == 0:
+        return np.empty(0, dtype=np.int64)
+    fine = radius_m * 0.7071        # < radius_m / sqrt(2)
+    fx = np.floor_divide(x, fine).astype(np.int64)
+    fy = np.floor_divide(y, fine).astype(np.int64)
+    fine_keys = (fx << 32) + (fy - fy.min())
+    gx = np.floor_divide(x, radius_m).astype(np.int64)
+    gy = np.floor_divide(y, radius_m).astype(np.int64)
+    row = int(gy.max() - gy.min()) + 3
+    cells = ((gx - gx.min() + 1) * row + (gy - gy.min() + 1)).tolist()
+    neighbours = (-row - 1, -row, -row + 1, -1, 0, 1, row - 1, row, row + 1)
+
+    fine_keys = fine_keys.tolist()
+    xs = x.tolist()
+    ys = y.tolist()
+    r2 = radius_m * radius_m
+    occupied = set()
+    grid = {}
+    kept = []
+    for i in range(len(xs)):
+        if fine_keys[i] in occupied:
+            continue
+        px, py, c = xs[i], ys[i], cells[i]
+        free = True
+        for d in neighbours:
+            for j in grid.get(c + d, ()):
+                if (xs[j] - px) ** 2 + (ys[j] - py) ** 2 < r2:
+                    free = False
+                    break
+            if not free:
+                break
+        if free:
+            kept.append(i)
+            occupied.add(fine_keys[i])
+            grid.setdefault(c, []).append(i)
+    return np.array(kept, dtype=np.int64)
+
+
+def _select_radius_rows(raw_dir: Path, stats: dict, radii, tag: str = "") -> dict:
+    """
+    Minimum-distance thinning for every radius from one parse of the raw pages.
+
+    Returns {radius_m: rows}. stats["skip_dense"] is counted for GRID_SIZE_M.
+    """
+    cand = _reduce_candidates(raw_dir, stats, tag, all_urls=True)
+    if cand is None:
+        return {r: [] for r in radii}
+
+    # Id order: deterministic and spatially unbiased
+    pts = cand["complete"][np.argsort(cand["codes"][cand["complete"]])]
+    x, y = _lonlat_to_meter_np(cand["lon"][pts], cand["lat"][pts])
+    out = {}
+    for radius in radii:
+        kept = pts[_min_distance_thin(x, y, radius)]
+        out[radius] = _candidate_rows(cand, kept)
+        print(f"[INFO] {tag}Minimum distance {radius}m: {len(kept)} / {len(pts)} images kept")
+        if radius == GRID_SIZE_M:
+            stats["skip_dense"] += len(pts) - len(kept)
+    return out
+
+
+def _radius_csv(out_csv: Path, radius_m) -> Path:
+    return out_csv.parent / f"{out_csv.stem}_r{radius_m:g}m{out_csv.suffix}"
+
+
+# ===== Single-file parsing =====
+def _iter_page_items(json_path: Path):
+    """Items of one page file; large files are streamed with ijson (C backend when available)."""
+    json_path = Path(json_path)
+    with json_path.open("rb") as f:
+        if STREAM_PARSE and json_path.stat().st_size >= STREAM_PARSE_MIN_BYTES:
+            import ijson
+            yield from ijson.items(f, "data.item", use_float=True)
+        else:
+            yield from json.load(f).get("data", [])
+
+
+def _parse_one_file(json_path: Path, writer: csv.DictWriter, seen_ids: set, used_cells: set, stats: dict):
+    _parse_records(list(map(_item_fields, _iter_page_items(json_path))), writer, seen_ids, used_cells, stats)
+
+
+# ===== Raw sources =====
+def _legacy_page_files(raw_dir: Path):
+    """One-JSON-file-per-page layout (threaded engine / older projects)."""
+    return sorted(raw_dir.glob("images_*.json"))
+
+
+def _snapshot_raw_sources(raw_dir: Path):
+    """
+    Fix the set of raw pages to read: the store index as of now + legacy page files.
+    Pages appended later (e.g. by a concurrent fetch) are not included.
+    """
+    store = raw_store.RawStore.open(raw_dir, readonly=True) if raw_store.has_store(raw_dir) else None
+    return store, _legacy_page_files(raw_dir)
+
+
+def _iter_raw_pages(raw_dir: Path, stats: dict, tag: str = "", sources=None):
+    """
+    Yield (page_name, items) from the compact raw store (if present),
+    then from legacy page files.
+
+    Ids were already deduplicated when written to the store;
+    those duplicates are added to stats here.
+    """
+    store, files = sources or _snapshot_raw_sources(raw_dir)
+    if store is not None:
+        totals = store.totals()
+        stats["skip_dup_id"] += totals["dup"]
+        stats["skip_no_id"] += totals["no_id"]
+        print(f"[INFO] {tag}Reading raw store: {totals['pages']} pages, {totals['records']} records")
+        yield from store.iter_pages()
+
+    for jf in files:
+        print(f"[INFO] {tag}Parsing {jf.name}")
+        yield jf.name, list(_iter_page_items(jf))
+
+
+def _iter_raw_records(raw_dir: Path, stats: dict, tag: str = "", sources=None):
+    """Like _iter_raw_pages, but yields compact (id, url, lon, lat) records one at a time."""
+    store, files = sources or _snapshot_raw_sources(raw_dir)
+    if store is not None:
+        totals = store.totals()
+        stats["skip_dup_id"] += totals["dup"]
+        stats["skip_no_id"] += totals["no_id"]
+        print(f"[INFO] {tag}Reading raw store: {totals['pages']} pages, {totals['records']} records")
+        for entry in store.entries:
+            yield from map(_item_fields, store.iter_page_records(entry))
+
+    for jf in files:
+        print(f"[INFO] {tag}Parsing {jf.name}")
+        yield from map(_item_fields, _iter_page_items(jf))
+
+
+def _format_stats(stats: dict) -> str:
+    return (
         f"[STATS] written {stats['written']} | "
         f"dedup_skipped {stats['skip_dup_id']} | "
         f"density_skipped {stats['skip_dense']} | "
@@ -144,51 +647,125 @@ def run_parse_json(project_dir):
     )
 
 
-# ===== Command-line compatibility =====
-def _cli_default():
-    """
-    When running parse_json.py directly:
-    Default input:  PROJECT_ROOT/data/raw
-    Default output: PROJECT_ROOT/data/csv/images_meta.csv
-    """
-    raw_dir = PROJECT_ROOT / "data" / "raw"
-    csv_dir = PROJECT_ROOT / "data" / "csv"
-    csv_dir.mkdir(parents=True, exist_ok=True)
-    out_csv = csv_dir / "images_meta.csv"
-
-    json_files = sorted(raw_dir.glob("*.json"))
-    if not json_files:
-        print(f"[WARN] No JSON files found under {raw_dir}")
-        return
+def _read_csv_ids(csv_path: Path) -> set:
+    """Ids of an existing images_meta.csv (empty set if missing)."""
+    if not csv_path.exists():
+        return set()
+    with csv_path.open("r", encoding="utf-8") as f:
+        return {row["id"] for row in csv.DictReader(f) if row.get("id")}
 
-    print(f"[INFO] (CLI) Found {len(json_files)} raw JSON files. Start parsing (50m thinning)...")
 
-    seen_ids = set()
-    used_cells = set()
-    stats = {
+def _new_stats() -> dict:
+    return {
         "written": 0,
         "skip_dup_id": 0,
         "skip_dense": 0,
         "skip_no_id": 0,
         "skip_no_url": 0,
         "skip_no_coord": 0,
+        "new": 0,
     }
 
-    with out_csv.open("w", newline="", encoding="utf-8") as f:
-        fieldnames = ["id", "thumb_2048_url", "lon", "lat"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+
+def _radii():
+    """THINNING_RADII_M plus GRID_SIZE_M (the radius of images_meta.csv)."""
+    return sorted(set(THINNING_RADII_M) | {GRID_SIZE_M})
+
+
+def _write_rows_csv(path: Path, rows):
+    with path.open("w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
         writer.writeheader()
+        writer.writerows(rows)
 
-        for jf in json_files:
-            print(f"[INFO] (CLI) Parsing {jf.name}")
-            _parse_one_file(jf, writer, seen_ids, used_cells, stats)
 
-    print(f"[DONE] (CLI) Output written to {out_csv}")
-    print(
-        f"[STATS] written {stats['written']} | "
-        f"dedup_skipped {stats['skip_dup_id']} | "
-        f"density_skipped {stats['skip_dense']}"
-    )
+def _write_new_rows(rows, new_writer: csv.DictWriter, previous_ids: set, stats: dict):
+    for row in rows:
+        if row["id"] not in previous_ids:
+            new_writer.writerow(row)
+            stats["new"] += 1
+
+
+def _parse_raw_dir(raw_dir: Path, out_csv: Path, tag: str = ""):
+    if not raw_store.has_store(raw_dir) and not _legacy_page_files(raw_dir):
+        print(f"[WARN] No raw pages found under {raw_dir}. Please run fetch_images first.")
+        return None
+
+    if THINNING == "radius":
+        print(f"[INFO] {tag}Start parsing {raw_dir} (minimum distance {', '.join(f'{r:g}m' for r in _radii())})...")
+    else:
+        print(f"[INFO] {tag}Start parsing {raw_dir} (50m thinning, cell winner: {CELL_WINNER})...")
+
+    seen_ids = set()
+    used_cells = set()
+    stats = _new_stats()
+    previous_ids = _read_csv_ids(out_csv)
+    new_csv = out_csv.parent / NEW_CSV_NAME
+
+    with out_csv.open("w", newline="", encoding="utf-8") as f, \
+            new_csv.open("w", newline="", encoding="utf-8") as fnew:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        new_writer = csv.DictWriter(fnew, fieldnames=CSV_FIELDS)
+        new_writer.writeheader()
+
+        if THINNING == "radius" or CELL_WINNER == "centre":
+            if THINNING == "radius":
+                variants = _select_radius_rows(raw_dir, stats, _radii(), tag)
+                rows = variants.pop(GRID_SIZE_M)
+                for radius, variant_rows in variants.items():
+                    _write_rows_csv(_radius_csv(out_csv, radius), variant_rows)
+                    print(f"[DONE] {tag}{radius:g}m variant written to {_radius_csv(out_csv, radius)}")
+            else:
+                rows = _select_centre_rows(raw_dir, stats, tag)
+            writer.writerows(rows)
+            stats["written"] += len(rows)
+            _write_new_rows(rows, new_writer, previous_ids, stats)
+        else:
+            batch = []
+            for record in _iter_raw_records(raw_dir, stats, tag):
+                batch.append(record)
+                if len(batch) < PARSE_BATCH_RECORDS:
+                    continue
+                _write_new_rows(_parse_records(batch, writer, seen_ids, used_cells, stats), new_writer, previous_ids, stats)
+                batch = []
+            _write_new_rows(_parse_records(batch, writer, seen_ids, used_cells, stats), new_writer, previous_ids, stats)
+
+    print(f"[DONE] {tag}Output written to {out_csv} ({stats['new']} new images in {new_csv.name})")
+    print(_format_stats(stats))
+    return stats
+
+
+# ===== FastAPI entry point =====
+def run_parse_json(project_dir):
+    """
+    Parse all raw pages under projects/{project_name}/data/raw
+    (compact raw store and/or images_*.json page files),
+    extract fields -> deduplicate -> spatial thinning (50m),
+    and write to projects/{project_name}/data/csv/images_meta.csv
+    """
+    project_dir = Path(project_dir)
+    raw_dir = project_dir / "data" / "raw"
+    csv_dir = project_dir / "data" / "csv"
+    csv_dir.mkdir(parents=True, exist_ok=True)
+
+    out_csv = csv_dir / "images_meta.csv"
+    _parse_raw_dir(raw_dir, out_csv)
+
+
+# ===== Command-line compatibility =====
+def _cli_default():
+    """
+    When running parse_json.py directly:
+    Default input:  PROJECT_ROOT/data/raw
+    Default output: PROJECT_ROOT/data/csv/images_meta.csv
+    """
+    raw_dir = PROJECT_ROOT / "data" / "raw"
+    csv_dir = PROJECT_ROOT / "data" / "csv"
+    csv_dir.mkdir(parents=True, exist_ok=True)
+    out_csv = csv_dir / "images_meta.csv"
+
+    _parse_raw_dir(raw_dir, out_csv, tag="(CLI) ")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+"""
+raw_store.py
+
+Compact append-only store for raw Mapillary pages.
+
+Instead of one JSON file per page, pages are appended to a few large
+segment files as they arrive:
+
+    data/raw/store/
+        seg_000001.ndjson.gz    one gzip member per page, one record per line
+        seg_000002.ndjson.gz    (new segment every SEGMENT_MAX_BYTES)
+        index.jsonl             one line per page:
+                                {"page", "segment", "offset", "length", "records", "dup", "no_id"}
+
+Records are flattened API items: {"id", "lon", "lat", <other scalar fields>}
+(e.g. thumb_2048_url). Duplicates are dropped while writing and counted per
+page: records identical to a stored one (overlapping tiles), and records
+without url or coordinates of an id that already has a complete one. Other
+records of the same id are all kept, so parse_json still picks the best
+record per id from every candidate.
+
+The index is the source of truth: a segment tail that is not referenced by the
+index (interrupted write) is truncated on open, and a page that is already
+indexed is not appended twice, so re-fetching a page after a crash is harmless.
+
+Reading:
+    store = RawStore.open(raw_dir)
+    for page_name, records in store.iter_pages(): ...
+    records = store.read_page(entry)   # random access through the index
+    for rec in store.iter_page_records(entry): ...   # one record at a time
+"""
+
+import gzip
+import io
+import json
+import threading
+from pathlib import Path
+
+STORE_DIRNAME = "store"
+INDEX_NAME = "index.jsonl"
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def store_dir(raw_dir: Path) -> Path:
+    return Path(raw_dir) / STORE_DIRNAME
+
+
+def has_store(raw_dir: Path) -> bool:
+    return (store_dir(raw_dir) / INDEX_NAME).exists()
+
+
+def compact_item(item: dict):
+    """
+    Flatten one API item.
+
+    Returns None when the item has no id (it cannot be deduplicated or used).
+    """
+    img_id = item.get("id")
+    if not img_id:
+        return None
+
+    geom = item.get("computed_geometry") or {}
+    coords = geom.get("coordinates") or []
+    rec = {
+        "id": str(img_id),
+        "lon": coords[0] if len(coords) >= 2 else None,
+        "lat": coords[1] if len(coords) >= 2 else None,
+    }
+    for k, v in item.items():
+        if k not in rec and k != "computed_geometry" and isinstance(v, (str, int, float)):
+            rec[k] = v
+    return rec
+
+
+def _is_complete(rec: dict) -> bool:
+    """Record with coordinates and at least one thumbnail url."""
+    if rec.get("lon") is None or rec.get("lat") is None:
+        return False
+    return any(v for k, v in rec.items() if k.startswith("thumb_") and k.endswith("_url"))
+
+
+def _record_key(rec: dict):
+    return rec["id"], hash(json.dumps(rec, ensure_ascii=False, sort_keys=True, separators=(",", ":")))
+
+
+class RawStore:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.index_path = self.root / INDEX_NAME
+        self.entries = []
+        self._pages = set()
+        self._keys = None         # (id, record hash) of the stored records, loaded lazily on first append
+        self._complete_ids = None  # ids with a complete stored record
+        self._lock = threading.Lock()
+
+    # ---------- Open ----------
+
+    @classmethod
+    def open(cls, raw_dir: Path, readonly: bool = False) -> "RawStore":
+        """
+        Load the index. Writers (readonly=False) also repair an interrupted
+        append: torn index line and unindexed segment tails are dropped.
+        """
+        store = cls(store_dir(raw_dir))
+        if not readonly:
+            store.root.mkdir(parents=True, exist_ok=True)
+
+        if store.index_path.exists():
+            with store.index_path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except Exception:
+                        break  # torn last line
+                    store.entries.append(entry)
+                    store._pages.add(entry["page"])
+
+        if not readonly:
+            # Rewrite the index without a torn tail
+            with store.index_path.open("w", encoding="utf-8") as f:
+                for entry in store.entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            store._truncate_unindexed_tails()
+        return store
+
+    def _truncate_unindexed_tails(self):
+        ends = {}
+        for e in self.entries:
+            ends[e["segment"]] = max(ends.get(e["segment"], 0), e["offset"] + e["length"])
+        for seg in self.root.glob("seg_*.ndjson.gz"):
+            end = ends.get(seg.name, 0)
+            if seg.stat().st_size > end:
+                with seg.open("r+b") as f:
+                    f.truncate(end)
+
+    # ---------- Write ----------
+
+    def _current_segment(self) -> Path:
+        if self.entries:
+            seg = self.root / self.entries[-1]["segment"]
+            if seg.exists() and seg.stat().st_size < SEGMENT_MAX_BYTES:
+                return seg
+            n = int(self.entries[-1]["segment"].split("_")[1].split(".")[0]) + 1
+        else:
+            n = 1
+        return self.root / f"seg_{n:06d}.ndjson.gz"
+
+    def _load_keys(self):
+        self._keys = set()
+        self._complete_ids = set()
+        for _, records in self.iter_pages():
+            for rec in records:
+                self._remember(rec)
+
+    def _remember(self, rec: dict):
+        self._keys.add(_record_key(rec))
+        if _is_complete(rec):
+            self._complete_ids.add(rec["id"])
+
+    def _is_dup(self, rec: dict) -> bool:
+        if rec["id"] in self._complete_ids and not _is_complete(rec):
+            return True   # can never beat the complete record in parse_json
+        return _record_key(rec) in self._keys
+
+    def append_page(self, page_name: str, items: list) -> dict:
+        """
+        Append one API page (thread-safe, idempotent per page name).
+
+        Returns the index entry (or the existing one if the page was already stored).
+        """
+        with self._lock:
+            if page_name in self._pages:
+                return next(e for e in self.entries if e["page"] == page_name)
+            if self._keys is None:
+                self._load_keys()
+
+            records = []
+            dup = 0
+            no_id = 0
+            for item in items:
+                rec = compact_item(item)
+                if rec is None:
+                    no_id += 1
+                    continue
+                if self._is_dup(rec):
+                    dup += 1
+                    continue
+                self._remember(rec)
+                records.append(rec)
+
+            payload = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in records)
+            blob = gzip.compress(payload.encode("utf-8"), compresslevel=6)
+
+            seg = self._current_segment()
+            with seg.open("ab") as f:
+                offset = f.tell()
+                f.write(blob)
+
+            entry = {
+                "page": page_name,
+                "segment": seg.name,
+                "offset": offset,
+                "length": len(blob),
+                "records": len(records),
+                "dup": dup,
+                "no_id": no_id,
+            }
+            # Index line last: until it exists, the page is not part of the store
+            with self.index_path.open("a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+            self.entries.append(entry)
+            self._pages.add(page_name)
+            return entry
+
+    # ---------- Read ----------
+
+    def read_page(self, entry: dict) -> list:
+        return list(self.iter_page_records(entry))
+
+    def iter_page_records(self, entry: dict):
+        """Yield the records of one page, decompressing line by line."""
+        with (self.root / entry["segment"]).open("rb") as f:
+            f.seek(entry["offset"])
+            blob = f.read(entry["length"])
+        with gzip.GzipFile(fileobj=io.BytesIO(blob)) as g:
+            for line in g:
+                if line.strip():
+                    yield json.loads(line)
+
+    def iter_pages(self):
+        """Yield (page_name, records) in append order."""
+        for entry in self.entries:
+            yield entry["page"], self.read_page(entry)
+
+    def totals(self) -> dict:
+        return {
+            "pages": len(self.entries),
+            "records": sum(e["records"] for e in self.entries),
+            "dup": sum(e["dup"] for e in self.entries),
+            "no_id": sum(e["no_id"] for e in self.entries),
+        }
@@ -0,0 +1,111 @@
+"""
+spatial_order.py
+
+Coarse-to-fine ordering of image points over their bounding box, used by
+download_images.py and segment_building.py so that any prefix of a run
+(cancelled, interrupted or still in progress) is an even sample of the
+whole map instead of one fully covered corner.
+
+Quadtree levels over a Hilbert curve:
+    - points are indexed on a 2^ORDER x 2^ORDER grid along a Hilbert curve;
+      every quadtree cell is one contiguous range of Hilbert indices
+    - level 0 takes one point for the whole bbox, level 1 one point in each
+      quadrant without a point yet, level 2 one per sub-quadrant, ...
+    - inside a level, cells are visited in digit-reversed order (the four
+      quadrants first, then their children, ...), so a level that is only
+      partly done is spread out as well
+    - points sharing a finest cell, and points without coordinates, come last
+
+Usage:
+    order = coarse_to_fine(lons, lats)       # index array
+    rows = order_rows(rows)                   # images_meta.csv dicts with lon / lat
+"""
+
+import numpy as np
+
+ORDER = 16   # Grid bits per axis (65536 x 65536 cells)
+
+
+def _hilbert_index(x, y, order=ORDER):
+    """Hilbert curve index of integer grid coordinates (vectorised xy2d)."""
+    x = x.astype(np.int64).copy()
+    y = y.astype(np.int64).copy()
+    n = 1 << order
+    d = np.zeros(len(x), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # Rotate the quadrant so the sub-curve has the standard orientation
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+
+def _reverse_digits(keys, level):
+    """Reverse the base-4 digits of level-`level` cell keys."""
+    out = np.zeros_like(keys)
+    k = keys.copy()
+    for _ in range(level):
+        out = (out << 2) | (k & 3)
+        k >>= 2
+    return out
+
+
+def coarse_to_fine(lons, lats, order=ORDER) -> np.ndarray:
+    """Indices of the points in coarse-to-fine order (points without coordinates last)."""
+    lon = np.asarray(lons, dtype=np.float64)
+    lat = np.asarray(lats, dtype=np.float64)
+    valid = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+    missing = np.flatnonzero(~(np.isfinite(lon) & np.isfinite(lat)))
+    if len(valid) == 0:
+        return missing
+
+    # ---- Hilbert index on a grid over the points' bbox ----
+    n = 1 << order
+    v_lon, v_lat = lon[valid], lat[valid]
+    span = max(v_lon.max() - v_lon.min(), v_lat.max() - v_lat.min()) or 1.0
+    gx = np.clip(((v_lon - v_lon.min()) / span * n).astype(np.int64), 0, n - 1)
+    gy = np.clip(((v_lat - v_lat.min()) / span * n).astype(np.int64), 0, n - 1)
+    h = _hilbert_index(gx, gy, order)
+
+    by_h = np.argsort(h, kind="stable")
+    hs = h[by_h]
+    chosen = np.zeros(len(hs), dtype=bool)
+    out = []
+
+    # ---- One new point per still empty quadtree cell, level by level ----
+    for level in range(order + 1):
+        keys = hs >> (2 * (order - level))
+        covered = np.isin(keys, keys[chosen]) if chosen.any() else np.zeros(len(hs), dtype=bool)
+        cand = np.flatnonzero(~chosen & ~covered)
+        if len(cand) == 0:
+            continue
+        # keys are sorted: the first candidate of every cell
+        ck = keys[cand]
+        first = cand[np.r_[True, ck[1:] != ck[:-1]]]
+        chosen[first] = True
+        out.append(first[np.argsort(_reverse_digits(keys[first], level), kind="stable")])
+
+    out.append(np.flatnonzero(~chosen))   # duplicates within the finest cells
+    return np.concatenate([valid[by_h[np.concatenate(out)]], missing])
+
+
+def _coord(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def order_rows(rows: list) -> list:
+    """images_meta.csv rows (dicts with lon / lat) in coarse-to-fine order."""
+    if not rows:
+        return rows
+    order = coarse_to_fine([_coord(r.get("lon")) for r in rows], [_coord(r.get("lat")) for r in rows])
+    return [rows[i] for i in order]
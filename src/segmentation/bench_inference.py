@@ -0,0 +1,292 @@
+"""
+bench_inference.py
+
+Speed / quality report of the inference backends and resolution modes
+(segment_building.INFER_BACKEND / INFER_RESOLUTION) on a sample of a
+project's images.
+
+The sample is the first --sample images in coarse-to-fine order, so it is
+spread over the whole bbox. Every backend x mode runs the batched Step 1
+path (preprocess + SegFormer, INFER_BATCH_SIZE images per batch, one warm-up
+batch not timed) and reports:
+    input size (median of the sample), images/s, and agreement of its
+    building masks with the reference (default: torch backend, "config"
+    mode, the model's own test resolution): mean / min IoU and pixel accuracy.
+
+With --min-iou, the fastest backend / mode whose mean IoU meets the
+threshold is reported as the pick (the ONNX parity check).
+
+With --workers, it instead reports how Step 1 scales over worker
+processes (segment_building INFER_WORKERS): for each worker count, the
+cores (--cores, default CPU_BUDGET or all) are split evenly into threads per worker and
+the sample is segmented into a temporary directory. Every count, 1
+included, runs in spawned worker processes, timed from when all of them
+have loaded the model, so worker start-up does not skew the speedups.
+
+Backends: torch | onnx | onnx_int8 (see onnx_backend.py)
+Modes:    config | native | short_side[:N] | scale[:F]
+
+Examples:
+    python -m src.segmentation.bench_inference projects/amsterdam
+    python -m src.segmentation.bench_inference projects/amsterdam --sample 64 --modes config native short_side:256 scale:0.5
+    python -m src.segmentation.bench_inference projects/amsterdam --backends torch onnx onnx_int8 --modes config --min-iou 0.95
+    python -m src.segmentation.bench_inference projects/amsterdam --workers 1 2 4 8 --sample 512
+    python -m src.segmentation.bench_inference projects/amsterdam --json
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.segmentation import segment_building as sb
+
+DEFAULT_MODES = ["config", "native", "short_side", "scale"]
+DEFAULT_BACKENDS = ["torch"]
+
+
+def parse_mode(text: str) -> tuple:
+    """'short_side:256' -> resolution key ('short_side', 256, INFER_SCALE)."""
+    name, _, value = text.partition(":")
+    if name == "short_side" and value:
+        return sb.resolution_key(name, short_side=int(value))
+    if name == "scale" and value:
+        return sb.resolution_key(name, scale=float(value))
+    return sb.resolution_key(name)
+
+
+def mode_label(key: tuple) -> str:
+    mode, short_side, scale = key
+    if mode == "short_side":
+        return f"short_side:{short_side}"
+    if mode == "scale":
+        return f"scale:{scale:g}"
+    return mode
+
+
+def sample_images(project_dir: Path, n: int) -> list:
+    """(id, BGR image) of the first n images in coarse-to-fine order."""
+    data_dir = Path(project_dir) / "data"
+    artifacts = sb.Artifacts(data_dir / "images", data_dir / "masks", data_dir / "building_rgba",
+                             data_dir / "palettes")
+    rank = sb.image_rank(data_dir / "csv" / "images_meta.csv")
+    out = []
+    for img_id in sb.order_ids(artifacts.image_ids(), rank):
+        img_bgr = artifacts.read_image(img_id)
+        if img_bgr is not None:
+            out.append((img_id, img_bgr))
+        if len(out) >= n:
+            break
+    return out
+
+
+def _run_mode(model, building_ids, key: tuple, images: list) -> tuple:
+    """Masks of the sample in one mode, plus timing and input size."""
+    pipeline = sb.build_test_pipeline(model, *key)
+    batch_size = max(1, sb.INFER_BATCH_SIZE)
+
+    # Warm-up batch: first call at a new input size allocates buffers (one input size per batch)
+    warm = [sb.preprocess_image(pipeline, img) for _, img in images[:batch_size]]
+    first = tuple(warm[0]["inputs"].shape)
+    sb.segment_batch(model, building_ids, [d for d in warm if tuple(d["inputs"].shape) == first])
+
+    masks = {}
+    shapes = []          # input shape of every image
+    t0 = time.perf_counter()
+    buckets = {}
+    for img_id, img_bgr in images:
+        data = sb.preprocess_image(pipeline, img_bgr)
+        shape = tuple(data["inputs"].shape)
+        shapes.append(shape)
+        bucket = buckets.setdefault(shape, [])
+        bucket.append((img_id, data))
+        if len(bucket) >= batch_size:
+            masks.update(zip([i for i, _ in bucket],
+                             sb.segment_batch(model, building_ids, [d for _, d in bucket])))
+            bucket.clear()
+    for bucket in buckets.values():
+        if bucket:
+            masks.update(zip([i for i, _ in bucket],
+                             sb.segment_batch(model, building_ids, [d for _, d in bucket])))
+    wall = time.perf_counter() - t0
+
+    shapes.sort(key=lambda s: s[-2] * s[-1])
+    median = shapes[len(shapes) // 2] if shapes else (0, 0, 0)
+    pixels = float(np.mean([s[-2] * s[-1] for s in shapes])) if shapes else 0.0
+    return masks, wall, f"{median[-1]}x{median[-2]}", pixels
+
+
+def _agreement(masks: dict, reference: dict) -> dict:
+    ious, accs = [], []
+    for img_id, ref in reference.items():
+        m = masks.get(img_id)
+        if m is None:
+            continue
+        a, b = m > 0, ref > 0
+        union = np.logical_or(a, b).sum()
+        ious.append(np.logical_and(a, b).sum() / union if union else 1.0)
+        accs.append(float((a == b).mean()))
+    return {
+        "mean_iou": round(float(np.mean(ious)), 4) if ious else None,
+        "min_iou": round(float(np.min(ious)), 4) if ious else None,
+        "pixel_acc": round(float(np.mean(accs)), 4) if accs else None,
+    }
+
+
+def run_benchmark(project_dir: Path, modes: list, sample: int = 32, reference: str = "config",
+                  backends: list = None, reference_backend: str = "torch", min_iou: float = None) -> dict:
+    images = sample_images(project_dir, sample)
+    if not images:
+        raise FileNotFoundError(f"No images in {Path(project_dir) / 'data' / 'images'}")
+
+    backends = list(backends or DEFAULT_BACKENDS)
+    if reference_backend not in backends:
+        backends.insert(0, reference_backend)
+    keys = [parse_mode(m) for m in modes]
+    ref_key = parse_mode(reference)
+
+    results = {}
+    devices = {}
+    for backend in backends:
+        devices[backend] = sb.pick_device(backend)
+        model, building_ids = sb.load_segmenter(devices[backend], backend=backend)
+        runs = keys + [ref_key] if backend == reference_backend and ref_key not in keys else keys
+        for key in runs:
+            results[(backend, key)] = _run_mode(model, building_ids, key, images)
+        del model
+
+    ref_masks, _, _, ref_pixels = results[(reference_backend, ref_key)]
+    rows = []
+    for (backend, key), (masks, wall, size, pixels) in results.items():
+        rows.append({
+            "backend": backend,
+            "device": devices[backend],
+            "mode": mode_label(key),
+            "input_size": size,
+            "relative_pixels": round(pixels / ref_pixels, 3) if ref_pixels else None,
+            "wall_s": round(wall, 3),
+            "images_per_s": round(len(images) / wall, 2) if wall else 0.0,
+            **_agreement(masks, ref_masks),
+        })
+
+    pick = None
+    if min_iou is not None:
+        ok = [r for r in rows if r["mean_iou"] is not None and r["mean_iou"] >= min_iou]
+        if ok:
+            best = max(ok, key=lambda r: r["images_per_s"])
+            pick = {"backend": best["backend"], "mode": best["mode"], "images_per_s": best["images_per_s"],
+                    "mean_iou": best["mean_iou"]}
+    return {
+        "project": str(project_dir),
+        "images": len(images),
+        "reference": f"{reference_backend}/{mode_label(ref_key)}",
+        "batch_size": sb.INFER_BATCH_SIZE,
+        "min_iou": min_iou,
+        "pick": pick,
+        "modes": rows,
+    }
+
+
+def run_scaling(project_dir: Path, worker_counts: list, sample: int = 256, cores: int = None) -> dict:
+    """
+    Step 1 images/s for each worker count (threads per worker = cores // workers),
+    relative to 1 worker (added if missing). Every count runs in spawned worker
+    processes; the clock starts once all of them have loaded the model.
+    The planner entry is what a run of the project would pick now (images
+    without a mask, cores = one run's share of CPU_BUDGET by default).
+    """
+    cores = cores or sb.THREAD_BUDGET.share()
+    data_dir = Path(project_dir) / "data"
+    rank = sb.image_rank(data_dir / "csv" / "images_meta.csv")
+    if 1 not in worker_counts:
+        worker_counts = [1] + list(worker_counts)
+    rows = []
+    for workers in worker_counts:
+        tmp = Path(tempfile.mkdtemp(prefix="bench_shards_"))
+        try:
+            artifacts = sb.Artifacts(data_dir / "images", tmp / "masks", tmp / "building_rgba", tmp / "palettes",
+                                     packed=False)
+            sb.ensure_dirs(artifacts.out_mask_dir)
+            todo = sb.order_ids(artifacts.image_ids(), rank)[:sample]
+            threads = max(1, cores // workers)
+            with sb._shard_pool(workers, threads, warm=True) as pool:
+                t0 = time.perf_counter()
+                for _ in sb._segment_step1_sharded(artifacts, todo, len(todo), workers, threads, pool):
+                    pass
+                wall = time.perf_counter() - t0
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        rows.append({"workers": workers, "threads": threads, "wall_s": round(wall, 3),
+                     "images_per_s": round(len(todo) / wall, 2) if wall else 0.0})
+
+    base = next(r["images_per_s"] for r in rows if r["workers"] == 1)
+    for r in rows:
+        r["speedup"] = round(r["images_per_s"] / base, 2) if base else None
+        r["efficiency"] = round(r["images_per_s"] / (base * r["workers"]), 2) if base else None
+    project = sb.Artifacts(data_dir / "images", data_dir / "masks", data_dir / "building_rgba", data_dir / "palettes")
+    pending = sum(not project.has_mask(img_id) for img_id in project.image_ids())
+    planned = sb.plan_workers(pending, cores)
+    return {"project": str(project_dir), "images": sample, "cores": cores,
+            "planner": {"images": pending, "workers": planned[0], "threads": planned[1]}, "runs": rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare SegFormer inference backends / resolution modes "
+                                                 "on a project sample")
+    parser.add_argument("project_dir", help="Project directory (with data/images)")
+    parser.add_argument("--modes", nargs="+", default=DEFAULT_MODES,
+                        help="config | native | short_side[:N] | scale[:F]")
+    parser.add_argument("--backends", nargs="+", default=DEFAULT_BACKENDS, choices=["torch", "onnx", "onnx_int8"])
+    parser.add_argument("--reference", default="config", help="Mode the masks are compared against")
+    parser.add_argument("--reference-backend", default="torch", choices=["torch", "onnx", "onnx_int8"])
+    parser.add_argument("--min-iou", type=float, default=None,
+                        help="Pick the fastest backend / mode with at least this mean IoU")
+    parser.add_argument("--sample", type=int, default=32, help="Number of images")
+    parser.add_argument("--batch-size", type=int, default=sb.INFER_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, nargs="+", default=None,
+                        help="Report Step 1 scaling over these worker process counts instead")
+    parser.add_argument("--cores", type=int, default=None, help="Cores for --workers (default: CPU_BUDGET or all available)")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args()
+
+    sb.INFER_BATCH_SIZE = args.batch_size
+    if args.workers:
+        result = run_scaling(Path(args.project_dir), args.workers, sample=args.sample, cores=args.cores)
+        if args.json:
+            print(json.dumps(result, indent=2))
+            return
+        print(f"[BENCH] {result['images']} images, {result['cores']} cores, planner "
+              f"({result['planner']['images']} images to segment): "
+              f"{result['planner']['workers']} workers x {result['planner']['threads']} threads")
+        for r in result["runs"]:
+            print(f"[BENCH] {r['workers']:>2} workers x {r['threads']:>2} threads | {r['images_per_s']:>7} img/s | "
+                  f"speedup {r['speedup']}x | efficiency {r['efficiency']:.0%}")
+        return
+
+    result = run_benchmark(Path(args.project_dir), args.modes, sample=args.sample, reference=args.reference,
+                           backends=args.backends, reference_backend=args.reference_backend, min_iou=args.min_iou)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print(f"[BENCH] {result['images']} images, batch={result['batch_size']}, reference={result['reference']}")
+    for r in result["modes"]:
+        print(f"[BENCH] {r['backend']:<9} {r['mode']:<16} input {r['input_size']:>9} ({r['relative_pixels']:.2f}x px) | "
+              f"{r['images_per_s']:>6} img/s | IoU mean {r['mean_iou']:.3f} min {r['min_iou']:.3f} | "
+              f"pixel acc {r['pixel_acc']:.3f}")
+    if result["min_iou"] is not None:
+        pick = result["pick"]
+        if pick is None:
+            print(f"[BENCH] No backend / mode reaches mean IoU {result['min_iou']}")
+        else:
+            print(f"[BENCH] Pick (mean IoU >= {result['min_iou']}): INFER_BACKEND = \"{pick['backend']}\", "
+                  f"mode {pick['mode']} ({pick['images_per_s']} img/s, IoU {pick['mean_iou']:.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+onnx_backend.py
+
+ONNX Runtime CPU backend for the SegFormer building segmentation
+(segment_building.INFER_BACKEND = "onnx" / "onnx_int8").
+
+Export (once, where torch + mmseg are installed):
+    python -m src.segmentation.onnx_backend export            # fp32 graph
+    python -m src.segmentation.onnx_backend export --int8     # + int8 variant
+    python -m src.segmentation.onnx_backend quantize          # int8 from an existing fp32 graph
+
+Then compare the backends against the PyTorch masks and pick the fastest one
+that is accurate enough:
+    python -m src.segmentation.bench_inference projects/amsterdam --backends torch onnx onnx_int8 --min-iou 0.95
+
+Exported graph:
+    input   "inputs"  float32 (N, 3, H, W), 0-255, channels as produced by the
+                      test pipeline; the data_preprocessor's channel swap and
+                      mean / std normalization are part of the graph
+    output  "logits"  float32 (N, classes, H/4, W/4), the decode head output
+Batch, height and width are dynamic, so one graph serves every
+INFER_RESOLUTION mode. Like mmseg's EncoderDecoder, the logits are resized
+(bilinear) to the image size before the argmax.
+
+The int8 variant is onnxruntime's dynamic quantization of the MatMul / Gemm
+weights (attention and MLP layers of MiT-B0); activations are quantized on
+the fly, so no calibration set is needed.
+
+Files (segment_building.ONNX_PATH / ONNX_INT8_PATH), each with a .json
+sidecar holding the class names, so building ids are known without loading
+the checkpoint.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+OPSET = 17
+INPUT_NAME = "inputs"
+OUTPUT_NAME = "logits"
+
+
+def meta_path(onnx_path: Path) -> Path:
+    return Path(f"{onnx_path}.json")
+
+
+def export_onnx(model, out_path: Path, opset: int = OPSET) -> Path:
+    """Export an mmseg EncoderDecoder (init_model) to ONNX, preprocessing included."""
+    import torch
+
+    class _Logits(torch.nn.Module):
+        def __init__(self, seg_model):
+            super().__init__()
+            self.model = seg_model
+            pre = seg_model.data_preprocessor
+            self.swap = bool(getattr(pre, "channel_conversion", False))
+            self.register_buffer("mean", pre.mean.detach().clone().view(1, -1, 1, 1).float())
+            self.register_buffer("std", pre.std.detach().clone().view(1, -1, 1, 1).float())
+
+        def forward(self, x):
+            if self.swap:
+                x = x.flip(1)
+            x = (x - self.mean) / self.std
+            return self.model(x, mode="tensor")
+
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    wrapper = _Logits(model).eval().cpu()
+    dummy = torch.zeros(1, 3, 512, 683)
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper, dummy, str(out_path),
+            input_names=[INPUT_NAME], output_names=[OUTPUT_NAME],
+            dynamic_axes={INPUT_NAME: {0: "batch", 2: "height", 3: "width"},
+                          OUTPUT_NAME: {0: "batch", 2: "logit_height", 3: "logit_width"}},
+            opset_version=opset, do_constant_folding=True,
+        )
+    classes = list(model.dataset_meta.get("classes") or [])
+    meta_path(out_path).write_text(json.dumps({"classes": classes, "opset": opset}), encoding="utf-8")
+    return out_path
+
+
+def quantize_onnx(src: Path, dst: Path) -> Path:
+    """Dynamic int8 quantization (MatMul / Gemm weights) of an exported graph."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(str(src), str(dst), op_types_to_quantize=["MatMul", "Gemm"], weight_type=QuantType.QInt8)
+    meta_path(dst).write_text(meta_path(src).read_text(encoding="utf-8"), encoding="utf-8")
+    return Path(dst)
+
+
+class OnnxSegmenter:
+    """
+    ONNX Runtime session with the attributes segment_building uses from an
+    mmseg model: cfg (for the test pipeline) and dataset_meta (classes).
+    """
+
+    def __init__(self, onnx_path: Path, cfg, threads: int = 0):
+        import onnxruntime as ort
+
+        self.path = Path(onnx_path)
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(self.path), opts, providers=["CPUExecutionProvider"])
+        self.cfg = cfg
+        meta = json.loads(meta_path(self.path).read_text(encoding="utf-8")) if meta_path(self.path).exists() else {}
+        self.dataset_meta = {"classes": meta.get("classes")}
+
+    def logits(self, batch) -> np.ndarray:
+        """Decode head logits of preprocessed images of the same input size."""
+        x = np.stack([np.asarray(d["inputs"]) for d in batch]).astype(np.float32)
+        return self.session.run([OUTPUT_NAME], {INPUT_NAME: x})[0]
+
+    def building_masks(self, batch, building_ids) -> list:
+        """Building masks (0 / 255) at the original image size."""
+        masks = []
+        for d, logit in zip(batch, self.logits(batch)):
+            h, w = d["data_samples"].ori_shape[:2]
+            hwc = np.ascontiguousarray(logit.transpose(1, 2, 0))     # (C, h, w) -> (h, w, C) for cv2
+            up = cv2.resize(hwc, (w, h), interpolation=cv2.INTER_LINEAR)
+            seg = up.reshape(h, w, -1).argmax(axis=2)
+            masks.append(np.isin(seg, building_ids).astype(np.uint8) * 255)
+        return masks
+
+
+def main():
+    # Lazy import: the export needs torch + mmseg, segment_building imports this module
+    from src.segmentation import segment_building as sb
+
+    parser = argparse.ArgumentParser(description="Export SegFormer to ONNX / quantize it to int8")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_exp = sub.add_parser("export", help="Export the checkpoint to ONNX (fp32)")
+    p_exp.add_argument("--out", default=str(sb.ONNX_PATH))
+    p_exp.add_argument("--opset", type=int, default=OPSET)
+    p_exp.add_argument("--int8", action="store_true", help="Also write the int8 variant")
+    p_q = sub.add_parser("quantize", help="Dynamic int8 quantization of the fp32 graph")
+    p_q.add_argument("--src", default=str(sb.ONNX_PATH))
+    p_q.add_argument("--out", default=str(sb.ONNX_INT8_PATH))
+    args = parser.parse_args()
+
+    if args.cmd == "export":
+        model, _ = sb.load_segmenter("cpu", backend="torch")
+        out = export_onnx(model, Path(args.out), args.opset)
+        print(f"[SUCCESS] ONNX model written: {out}")
+        if args.int8:
+            print(f"[SUCCESS] int8 model written: {quantize_onnx(out, sb.ONNX_INT8_PATH)}")
+    else:
+        print(f"[SUCCESS] int8 model written: {quantize_onnx(Path(args.src), Path(args.out))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,20 +10,60 @@ Purpose:
 Notes:
 - tqdm has been removed
 - Uses generator (yield) logs for real-time progress display in the frontend
+- Images are processed coarse-to-fine over the bbox (PROCESS_ORDER), so a
+  partial run already covers the whole map evenly
+- Step 1 runs batched inference (INFER_BATCH_SIZE images per forward pass);
+  a background loader decodes and preprocesses images PREFETCH_IMAGES ahead
+- INFER_RESOLUTION chooses the inference input size (config / native /
+  short_side / scale); compare modes with bench_inference.py
+- INFER_BACKEND runs the model in PyTorch or in ONNX Runtime (fp32 / int8,
+  exported with onnx_backend.py)
+- On the CPU, Step 1 can be sharded over worker processes (INFER_WORKERS),
+  each with its own model copy; plan_workers() splits the run's CPU share
+  into workers x threads. THREAD_BUDGET keeps the process's torch / OpenCV /
+  KMeans threads at CPU_BUDGET / (runs in progress)
+- The model is resident (MODEL, a ModelHolder): loaded once per process and
+  shared by all runs and projects, optionally freed after MODEL_IDLE_EVICT_S
+- FUSED_PIPELINE runs the three steps per image in one pass: one image
+  decode, mask and shadow-free alpha stay in memory up to the color
+  clustering, and only the FUSED_ARTIFACTS are written
+- StreamingSegmenter runs all three steps per image, so the fetch pipeline
+  can segment each image as soon as it has been downloaded
+- PACKED_STORE keeps masks and shadow-free alphas in the project's packed
+  store (packed_store.py) instead of PNG files; the steps then pass bit-packed
+  masks between each other and the RGBA / palette PNGs are rendered on request
 """
 
 import sys
 import glob
 import csv
+import json
+import gc
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeout
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
 
 import cv2
 import numpy as np
 # from tqdm import tqdm  <-- tqdm removed
 from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
+
+from src.preprocess.spatial_order import order_rows
+from src.preprocess.parse_json import NEW_CSV_NAME, _read_csv_ids
+from src.preprocess.packed_store import PackedStore, decode_mask, encode_mask, has_packed
+from src.segmentation.onnx_backend import OnnxSegmenter
 
 from mmseg.apis import init_model, inference_model
 from mmseg.utils import register_all_modules
+from mmengine.config import Config
+from mmengine.dataset import Compose
 import torch
 
 # ================== Path configuration ==================
@@ -48,6 +88,77 @@ WHITE_TH = 240
 BLACK_TH = 20
 MIN_SAMPLES = 500
 
+# Reuse color_summary.csv rows of images whose palette PNG already exists,
+# so incremental (refresh) runs only cluster the new images
+REUSE_COLOR_ROWS = True
+
+# "coarse_to_fine": process images in the spatial order of download_images
+# (positions from images_meta.csv); "name": file name order
+PROCESS_ORDER = "coarse_to_fine"
+
+# Keep masks / alphas in data/packed instead of masks/, building_rgba/ and palettes/ PNGs
+PACKED_STORE = False
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".bmp"}
+
+# ===== Fused pipeline =====
+# Steps 1-3 per image on the image / mask / alpha in memory instead of three
+# passes over PNG files; only FUSED_ARTIFACTS are written (color_summary.csv
+# always is). Outputs not written are not shown by the web viewer; an image
+# is only skipped on the next run if its written artifacts and color row exist.
+# Step 1 runs in this process (no INFER_WORKERS sharding) in this mode.
+FUSED_PIPELINE = False
+ARTIFACT_KINDS = ("masks", "rgba", "palettes")
+FUSED_ARTIFACTS = ("masks", "rgba", "palettes")
+
+# ===== Batched inference (Step 1) =====
+INFER_BATCH_SIZE = 8     # Images per forward pass (images of the same input size are batched together)
+PREFETCH_IMAGES = 32     # Images the background loader decodes / preprocesses ahead of the model
+
+# ===== Inference resolution =====
+# "config":     test_pipeline of the model config, Resize(scale=(2048, 512), keep_ratio):
+#               a 512x384 download is upscaled to 683x512
+# "native":     images as downloaded (long side <= download_images.MAX_LONG_SIDE)
+# "short_side": short side resized to INFER_SHORT_SIDE
+# "scale":      image size x INFER_SCALE
+# The model resizes its logits back to the image size, so masks always match the image.
+INFER_RESOLUTION = "config"
+INFER_SHORT_SIDE = 256
+INFER_SCALE = 0.75
+
+# ===== Inference backend =====
+# "torch":     mmseg / PyTorch (CUDA when available)
+# "onnx":      ONNX Runtime CPU, fp32 graph at ONNX_PATH
+# "onnx_int8": ONNX Runtime CPU, dynamically quantized graph at ONNX_INT8_PATH
+# Export with: python -m src.segmentation.onnx_backend export --int8
+# Read when the model is loaded.
+INFER_BACKEND = "torch"
+ONNX_PATH = PROJECT_ROOT / "segformer_mit-b0_ade20k.onnx"
+ONNX_INT8_PATH = PROJECT_ROOT / "segformer_mit-b0_ade20k.int8.onnx"
+ONNX_THREADS = 0         # ONNX Runtime intra-op threads (0 = one per physical core)
+
+# ===== CPU budget / sharding (Step 1 on the CPU) =====
+# Every run gets CPU_BUDGET / (runs in progress) cores (see ThreadBudget), so
+# two projects at once do not oversubscribe the box. plan_workers() splits a
+# run's share into worker processes x intra-op threads; each worker holds a
+# model copy.
+CPU_BUDGET = 0               # Cores for all runs of this process together (0 = all cores available to it)
+INFER_WORKERS = 0            # Step 1 processes (0 = planner, 1 = in this process)
+THREADS_PER_WORKER = 0       # Intra-op threads per worker (0 = planner)
+PLANNER_THREADS = 4          # Planner: threads per worker (one forward pass scales well up to about this)
+MAX_INFER_WORKERS = 8
+MIN_IMAGES_PER_WORKER = 32   # Planner: fewer images do not pay for a worker's model load
+WORKER_START_TIMEOUT_S = 600 # Warm pools (bench_inference): give up if the workers are not ready by then
+
+# Module settings copied into the worker processes (spawned: fresh interpreter)
+_WORKER_SETTINGS = ("INFER_BACKEND", "ONNX_PATH", "ONNX_INT8_PATH", "INFER_RESOLUTION", "INFER_SHORT_SIDE",
+                    "INFER_SCALE", "INFER_BATCH_SIZE")
+
+# ===== Resident model =====
+MODEL_IDLE_EVICT_S = 0   # Free the model after this many idle seconds (0 = keep it loaded)
+
+_END = object()
+
 
 def find_ckpt():
     """Find the checkpoint file. Return None if not found (caller handles the error)."""
@@ -88,11 +199,16 @@ def shadow_mask_lab(img_bgr, valid_mask255):
     return shadow
 
 
-def save_building_only_shadowfree(img_bgr, mask255, out_path: Path):
+def shadowfree_alpha(img_bgr, mask255):
+    """Alpha of the building cut-out: building pixels minus detected shadows."""
+    alpha = np.where(mask255 == 0, 0, 255).astype(np.uint8)
+    alpha[shadow_mask_lab(img_bgr, mask255) == 255] = 0
+    return alpha
+
+
+def save_building_only_shadowfree(img_bgr, mask255, out_path: Path, alpha=None):
     bgra = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2BGRA)
-    bgra[mask255 == 0, 3] = 0
-    sh_mask = shadow_mask_lab(img_bgr, mask255)
-    bgra[sh_mask == 255, 3] = 0
+    bgra[..., 3] = shadowfree_alpha(img_bgr, mask255) if alpha is None else alpha
     cv2.imwrite(str(out_path), bgra)
 
 
@@ -130,6 +246,287 @@ def get_dominant_colors(bgr, alpha, k=TOPK):
     return [(centers[i].tolist(), float(ratios[i])) for i in order]
 
 
+def image_rank(meta_csv: Path):
+    """Image id -> position in coarse-to-fine order (empty dict without images_meta.csv)."""
+    meta_csv = Path(meta_csv)
+    if PROCESS_ORDER != "coarse_to_fine" or not meta_csv.exists():
+        return {}
+    with meta_csv.open("r", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    return {row.get("id"): i for i, row in enumerate(order_rows(rows))}
+
+
+def order_ids(ids, rank: dict):
+    """Sort image ids by rank (unranked ones last, by id)."""
+    return sorted(ids, key=lambda img_id: (rank.get(img_id, len(rank)), img_id))
+
+
+def load_color_rows(csv_path: Path):
+    """Previous color_summary.csv rows keyed by file name (empty dict if missing)."""
+    csv_path = Path(csv_path)
+    if not csv_path.exists():
+        return {}
+    with csv_path.open("r", newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return {row[0]: row for row in reader if row}
+
+
+def pick_device(backend=None):
+    if (backend or INFER_BACKEND) != "torch":
+        return "cpu (onnxruntime)"
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+class ThreadBudget:
+    """
+    Thread counts of torch, OpenCV and OpenMP / BLAS (KMeans) for the runs in
+    this process.
+
+    These are process-wide settings, so runs cannot each keep their own: on
+    every run start and end, all of them are set to CPU_BUDGET / (runs in
+    progress). A run's in-process threads shrink when another run starts and
+    grow back when it ends; the original values are restored after the last
+    run. Only the sharded Step 1 worker processes (_shard_init) hold a fixed
+    per-run budget: their count and threads are planned from the share at the
+    time they start.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._saved = None
+        self._limiter = None
+
+    def share(self) -> int:
+        """Cores per run in progress."""
+        return max(1, (CPU_BUDGET or available_cores()) // max(1, self._runs))
+
+    @contextmanager
+    def run(self):
+        """Register a running pipeline; yields its current share in cores."""
+        with self._lock:
+            if self._runs == 0:
+                self._saved = (torch.get_num_threads(), cv2.getNumThreads())
+            self._runs += 1
+            share = self._apply()
+        try:
+            yield share
+        finally:
+            with self._lock:
+                self._runs -= 1
+                if self._runs:
+                    self._apply()
+                else:
+                    self._limiter.restore_original_limits()
+                    self._limiter = None
+                    torch.set_num_threads(self._saved[0])
+                    cv2.setNumThreads(self._saved[1])
+
+    def _apply(self) -> int:
+        n = self.share()
+        torch.set_num_threads(n)
+        cv2.setNumThreads(n)
+        if self._limiter is not None:
+            self._limiter.restore_original_limits()
+        self._limiter = threadpool_limits(limits=n)
+        return n
+
+
+THREAD_BUDGET = ThreadBudget()
+
+
+def plan_workers(n_images: int, cores: int) -> tuple:
+    """(worker processes, threads per worker) for n_images on `cores` cores."""
+    workers = INFER_WORKERS
+    if workers <= 0:
+        per_worker = THREADS_PER_WORKER or min(PLANNER_THREADS, cores)
+        workers = min(cores // per_worker, MAX_INFER_WORKERS, n_images // MIN_IMAGES_PER_WORKER)
+    workers = max(1, min(workers, cores))
+    threads = THREADS_PER_WORKER or max(1, cores // workers)
+    return workers, threads
+
+
+def model_path(backend=None) -> Path:
+    """Checkpoint / ONNX graph of INFER_BACKEND (or `backend`); raises FileNotFoundError if missing."""
+    backend = backend or INFER_BACKEND
+    if backend in ("onnx", "onnx_int8"):
+        onnx_path = ONNX_INT8_PATH if backend == "onnx_int8" else ONNX_PATH
+        if not onnx_path.exists():
+            raise FileNotFoundError(f"ONNX model not found: {onnx_path} "
+                                    "(python -m src.segmentation.onnx_backend export --int8)")
+        return onnx_path
+    if backend == "torch":
+        ckpt = find_ckpt()
+        if ckpt is None:
+            raise FileNotFoundError(f"Checkpoint not found: {CKPT_GLOB}")
+        return Path(ckpt)
+    raise ValueError(f"Unknown inference backend: {backend}")
+
+
+def load_segmenter(device, backend=None):
+    """
+    Load SegFormer with the INFER_BACKEND (or `backend`). Returns (model, building_ids);
+    raises FileNotFoundError without checkpoint / exported ONNX graph.
+    """
+    register_all_modules(init_default_scope=False)
+    backend = backend or INFER_BACKEND
+    path = model_path(backend)
+    if backend == "torch":
+        model = init_model(str(CFG_PATH), str(path), device=device)
+    else:
+        model = OnnxSegmenter(path, Config.fromfile(str(CFG_PATH)), threads=ONNX_THREADS)
+    classes = model.dataset_meta.get("classes")
+    building_ids = pick_building_ids(classes) if classes else [1]
+    return model, building_ids
+
+
+def _building_mask(result, building_ids):
+    seg = result.pred_sem_seg.data.squeeze().cpu().numpy().astype(np.int32)
+    return (np.isin(seg, building_ids)).astype(np.uint8) * 255
+
+
+def segment_mask(model, building_ids, img_bgr, pipeline=None):
+    """Building mask (0 / 255) of one BGR image (through `pipeline` if given)."""
+    if pipeline is not None:
+        return segment_batch(model, building_ids, [preprocess_image(pipeline, img_bgr)])[0]
+    img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
+    return _building_mask(inference_model(model, img_rgb), building_ids)
+
+
+def resolution_key(mode=None, short_side=None, scale=None):
+    """(mode, short_side, scale) with the module defaults filled in."""
+    return (mode or INFER_RESOLUTION,
+            INFER_SHORT_SIDE if short_side is None else short_side,
+            INFER_SCALE if scale is None else scale)
+
+
+def build_test_pipeline(model, mode=None, short_side=None, scale=None):
+    """
+    The model's test pipeline for in-memory images, as used by inference_model
+    (which rebuilds it on every call), with the Resize step of the inference
+    resolution mode (INFER_RESOLUTION by default).
+    """
+    mode, short_side, scale = resolution_key(mode, short_side, scale)
+    cfg = [dict(t) for t in model.cfg.test_pipeline if t.get("type") != "LoadAnnotations"]
+    cfg[0]["type"] = "LoadImageFromNDArray"
+
+    if mode != "config":
+        cfg = [t for t in cfg if t.get("type") != "Resize"]
+        if mode == "short_side":
+            cfg.insert(1, dict(type="Resize", scale=(short_side * 4, short_side), keep_ratio=True))
+        elif mode == "scale":
+            cfg.insert(1, dict(type="Resize", scale_factor=scale, keep_ratio=True))
+        elif mode != "native":
+            raise ValueError(f"Unknown inference resolution mode: {mode}")
+    return Compose(cfg)
+
+
+def preprocess_image(pipeline, img_bgr):
+    """Model input of one image (same color conversion as segment_mask)."""
+    return pipeline(dict(img=cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)))
+
+
+def segment_batch(model, building_ids, batch):
+    """Building masks of preprocessed images (same input size) in one forward pass."""
+    if isinstance(model, OnnxSegmenter):
+        return model.building_masks(batch, building_ids)
+    data = {"inputs": [d["inputs"] for d in batch], "data_samples": [d["data_samples"] for d in batch]}
+    with torch.no_grad():
+        results = model.test_step(data)
+    masks = []
+    for d, r in zip(batch, results):
+        mask255 = _building_mask(r, building_ids)
+        ori_shape = getattr(d["data_samples"], "ori_shape", None)
+        if ori_shape is not None and mask255.shape[:2] != tuple(ori_shape[:2]):
+            mask255 = cv2.resize(mask255, (ori_shape[1], ori_shape[0]), interpolation=cv2.INTER_NEAREST)
+        masks.append(mask255)
+    return masks
+
+
+def prefetch(items, load, depth=PREFETCH_IMAGES):
+    """
+    Yield (item, load(item)) in order, with load running in a background
+    thread up to `depth` items ahead. A failing load yields None.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def worker():
+        try:
+            for item in items:
+                if stop.is_set():
+                    return
+                try:
+                    value = load(item)
+                except Exception:
+                    value = None
+                put((item, value))
+        finally:
+            put(_END)
+
+    threading.Thread(target=worker, name="segment-prefetch", daemon=True).start()
+    try:
+        while True:
+            entry = q.get()
+            if entry is _END:
+                return
+            yield entry
+    finally:
+        stop.set()
+
+
+def rgba_name(img_id) -> str:
+    """Shadow-free PNG name; also the "file" column of color_summary.csv."""
+    return f"{img_id}_building_shadowfree.png"
+
+
+def palette_image(bgr, alpha, colors):
+    bgra = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA)
+    bgra[alpha == 0, 3] = 0
+    return compose_with_palette_keep_alpha(bgra, colors, PALETTE_W)
+
+
+def extract_colors(img_id, artifacts: "Artifacts"):
+    """Dominant colors of one building cut-out; writes its palette image. Returns the CSV row or None."""
+    bgr, alpha = artifacts.read_rgba(img_id)
+    if bgr is None:
+        return None
+
+    colors = get_dominant_colors(bgr, alpha, k=TOPK)
+    artifacts.write_palette(img_id, bgr, alpha, colors)
+    return [rgba_name(img_id), [c for c, _ in colors], [r for _, r in colors]]
+
+
+def colors_in_memory(img_id, img_bgr, mask255, artifacts: "Artifacts", write=ARTIFACT_KINDS):
+    """
+    Steps 2-3 on an image and its mask in memory (no PNG round-trip); writes
+    the artifacts named in `write`. Returns the CSV row.
+    """
+    alpha = shadowfree_alpha(img_bgr, mask255)
+    if "rgba" in write:
+        artifacts.write_rgba(img_id, img_bgr, mask255, alpha=alpha)
+    colors = get_dominant_colors(img_bgr, alpha, k=TOPK)
+    if "palettes" in write:
+        artifacts.write_palette(img_id, img_bgr, alpha, colors)
+    return [rgba_name(img_id), [c for c, _ in colors], [r for _, r in colors]]
+
+
 def compose_with_palette_keep_alpha(bgra, colors, palette_w=PALETTE_W):
     h, w = bgra.shape[:2]
     card = np.zeros((h, palette_w, 4), np.uint8)
@@ -146,24 +543,298 @@ def compose_with_palette_keep_alpha(bgra, colors, palette_w=PALETTE_W):
     return np.concatenate([bgra, card], axis=1)
 
 
-def _segment_pipeline(in_dir: Path, out_mask_dir: Path, out_only_dir: Path, out_palette_dir: Path, csv_out: Path):
+class Artifacts:
+    """
+    Where the steps read and write their outputs.
+
+    Files by default: masks/{id}_building.png, building_rgba/{id}_building_shadowfree.png
+    and palettes/{id}_palette.png. With packed=True, masks and shadow-free alphas
+    go to the project's packed store and the RGBA / palette PNGs are not
+    written (see render_packed). Images are read from in_dir or, if not there,
+    from the packed store (download_images.PACKED_STORE).
+    """
+
+    def __init__(self, in_dir: Path, out_mask_dir: Path, out_only_dir: Path, out_palette_dir: Path, packed=None):
+        self.in_dir = Path(in_dir)
+        self.out_mask_dir = Path(out_mask_dir)
+        self.out_only_dir = Path(out_only_dir)
+        self.out_palette_dir = Path(out_palette_dir)
+        self.packed = PACKED_STORE if packed is None else packed
+
+        data_dir = self.in_dir.parent
+        self.store = PackedStore.open(data_dir) if self.packed or has_packed(data_dir) else None
+        self._image_paths = {}
+
+    # ---------- Images ----------
+
+    def image_ids(self) -> list:
+        """Ids of the images in in_dir and in the packed store."""
+        if self.in_dir.exists():
+            for p in self.in_dir.iterdir():
+                if p.suffix.lower() in IMAGE_SUFFIXES:
+                    self._image_paths[p.stem] = p
+        ids = set(self._image_paths)
+        if self.store is not None:
+            ids.update(self.store.keys("image"))
+        return list(ids)
+
+    def image_name(self, img_id) -> str:
+        p = self._image_paths.get(img_id)
+        return p.name if p is not None else f"{img_id}.jpg"
+
+    def read_image(self, img_id):
+        p = self._image_paths.get(img_id) or self.in_dir / f"{img_id}.jpg"
+        if p.exists():
+            return cv2.imread(str(p))
+        return self.store.get_image(img_id) if self.store is not None else None
+
+    def read_image_bytes(self, img_id):
+        """Encoded image (JPEG) as stored, or None."""
+        p = self._image_paths.get(img_id) or self.in_dir / f"{img_id}.jpg"
+        if p.exists():
+            return p.read_bytes()
+        return self.store.get(img_id, "image") if self.store is not None else None
+
+    # ---------- Step 1: building masks ----------
+
+    def _mask_path(self, img_id) -> Path:
+        return self.out_mask_dir / f"{img_id}_building.png"
+
+    def has_mask(self, img_id) -> bool:
+        if self.packed:
+            return self.store.has(img_id, "mask")
+        return self._mask_path(img_id).exists()
+
+    def read_mask(self, img_id):
+        if self.packed:
+            return self.store.get_mask(img_id, "mask")
+        return cv2.imread(str(self._mask_path(img_id)), cv2.IMREAD_GRAYSCALE)
+
+    def write_mask(self, img_id, mask255):
+        if self.packed:
+            self.store.put_mask(img_id, "mask", mask255)
+        else:
+            cv2.imwrite(str(self._mask_path(img_id)), mask255)
+
+    # ---------- Step 2: shadow-free cut-outs ----------
+
+    def has_rgba(self, img_id) -> bool:
+        if self.packed:
+            return self.store.has(img_id, "alpha")
+        return (self.out_only_dir / rgba_name(img_id)).exists()
+
+    def write_rgba(self, img_id, img_bgr, mask255, alpha=None):
+        """Shadow-free cut-out (alpha: shadowfree_alpha() if already computed)."""
+        if self.packed:
+            self.store.put_mask(img_id, "alpha", shadowfree_alpha(img_bgr, mask255) if alpha is None else alpha)
+        else:
+            save_building_only_shadowfree(img_bgr, mask255, self.out_only_dir / rgba_name(img_id), alpha)
+
+    def read_rgba(self, img_id):
+        """(bgr, alpha) of the cut-out, or (None, None)."""
+        if not self.packed:
+            return load_rgba(self.out_only_dir / rgba_name(img_id))
+        alpha = self.store.get_mask(img_id, "alpha")
+        bgr = self.read_image(img_id) if alpha is not None else None
+        return (bgr, alpha) if bgr is not None else (None, None)
+
+    def rgba_ids(self) -> list:
+        if self.packed:
+            return self.store.keys("alpha")
+        suffix = "_building_shadowfree"
+        return [p.stem[:-len(suffix)] for p in self.out_only_dir.glob("*.png") if p.stem.endswith(suffix)]
+
+    # ---------- Step 3: palettes ----------
+
+    def has_palette(self, img_id) -> bool:
+        if self.packed:
+            return self.store.has(img_id, "alpha")   # rendered on request
+        return (self.out_palette_dir / f"{img_id}_palette.png").exists()
+
+    def has_outputs(self, img_id, kinds) -> bool:
+        """All artifacts named in kinds (ARTIFACT_KINDS) exist."""
+        checks = {"masks": self.has_mask, "rgba": self.has_rgba, "palettes": self.has_palette}
+        return all(checks[kind](img_id) for kind in kinds)
+
+    def write_palette(self, img_id, bgr, alpha, colors):
+        if not self.packed:
+            cv2.imwrite(str(self.out_palette_dir / f"{img_id}_palette.png"), palette_image(bgr, alpha, colors))
+
+
+def render_packed(data_dir: Path, folder: str, name: str):
+    """
+    Encoded file content for a static url (images/, masks/, building_rgba/,
+    palettes/) whose output is kept in the packed store; None if it is not there.
+    """
+    data_dir = Path(data_dir)
+    if not has_packed(data_dir):
+        return None
+    store = PackedStore.open(data_dir)
+    stem = Path(name).stem
+
+    if folder == "images":
+        return store.get(stem, "image")
+    if folder == "masks" and stem.endswith("_building"):
+        mask = store.get_mask(stem[:-len("_building")], "mask")
+        return None if mask is None else cv2.imencode(".png", mask)[1].tobytes()
+
+    if folder == "building_rgba" and stem.endswith("_building_shadowfree"):
+        img_id = stem[:-len("_building_shadowfree")]
+    elif folder == "palettes" and stem.endswith("_palette"):
+        img_id = stem[:-len("_palette")]
+    else:
+        return None
+    alpha = store.get_mask(img_id, "alpha")
+    bgr = store.get_image(img_id) if alpha is not None else None
+    if bgr is None:
+        bgr = cv2.imread(str(data_dir / "images" / f"{img_id}.jpg")) if alpha is not None else None
+    if bgr is None:
+        return None
+
+    if folder == "building_rgba":
+        bgra = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA)
+        bgra[..., 3] = alpha
+        return cv2.imencode(".png", bgra)[1].tobytes()
+
+    row = load_color_rows(data_dir / "csv" / "color_summary.csv").get(rgba_name(img_id))
+    colors = list(zip(json.loads(row[1]), json.loads(row[2]))) if row else []
+    return cv2.imencode(".png", palette_image(bgr, alpha, colors))[1].tobytes()
+
+
+class ModelHolder:
+    """
+    Resident SegFormer model shared by every pipeline, project and request of
+    this process. Loaded on first use (or by warm() at server start), kept
+    while in use and, with MODEL_IDLE_EVICT_S, freed after being idle.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = 0
+        self._timer = None
+        self.model = None
+        self.building_ids = None
+        self._pipelines = {}       # resolution_key() -> test pipeline
+        self.device = None
+        self.load_s = None
+        self.loads = 0
+        self.last_used = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
+
+    def acquire(self) -> bool:
+        """Register a user, loading the model if needed. Returns True if this call loaded it."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.model is None:
+                device = pick_device()
+                t0 = time.perf_counter()
+                model, building_ids = load_segmenter(device)
+                self.model, self.building_ids, self.device = model, building_ids, device
+                self.load_s = time.perf_counter() - t0
+                self.loads += 1
+                loaded_now = True
+            else:
+                loaded_now = False
+            self._users += 1
+            return loaded_now
+
+    def release(self):
+        with self._lock:
+            self._users = max(0, self._users - 1)
+            self.last_used = time.monotonic()
+            if self._users == 0 and MODEL_IDLE_EVICT_S > 0 and self.model is not None:
+                self._timer = threading.Timer(MODEL_IDLE_EVICT_S, self._evict_if_idle)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def get_pipeline(self, mode=None, short_side=None, scale=None):
+        """Test pipeline of an inference resolution (INFER_RESOLUTION by default), built once."""
+        key = resolution_key(mode, short_side, scale)
+        with self._lock:
+            if key not in self._pipelines:
+                self._pipelines[key] = build_test_pipeline(self.model, *key)
+            return self._pipelines[key]
+
+    @contextmanager
+    def use(self):
+        loaded_now = self.acquire()
+        try:
+            yield loaded_now
+        finally:
+            self.release()
+
+    def warm(self) -> bool:
+        """Load now (e.g. at server start) without holding it."""
+        with self.use() as loaded_now:
+            return loaded_now
+
+    def _evict_if_idle(self):
+        with self._lock:
+            self._timer = None
+            if self._users or self.model is None:
+                return
+            if time.monotonic() - self.last_used < MODEL_IDLE_EVICT_S:
+                return
+            self.model = self.building_ids = None
+            self._pipelines = {}
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def describe(self) -> str:
+        backend = "onnx" if isinstance(self.model, OnnxSegmenter) else "torch"
+        return (f"Device: {self.device}, backend: {backend}, loaded in {self.load_s:.1f}s, "
+                f"resolution: {INFER_RESOLUTION}")
+
+
+MODEL = ModelHolder()
+
+
+def _segment_pipeline(in_dir: Path, out_mask_dir: Path, out_only_dir: Path, out_palette_dir: Path, csv_out: Path,
+                      fused=None, artifacts=None, new_only=False):
     """
     Core generator pipeline:
     Includes three major steps and yields logs for each processed image.
+    Registered with THREAD_BUDGET for its CPU share.
+    fused / artifacts: FUSED_PIPELINE / FUSED_ARTIFACTS if None.
+    new_only: segment only the images in images_meta_new.csv (refresh runs);
+    color rows of the other images are carried over from the previous CSV.
     """
+    fused = FUSED_PIPELINE if fused is None else fused
+    write = tuple(FUSED_ARTIFACTS if artifacts is None else artifacts)
+    unknown = set(write) - set(ARTIFACT_KINDS)
+    if unknown:
+        yield f"[ERROR] Unknown artifacts: {', '.join(sorted(unknown))} (choose from {', '.join(ARTIFACT_KINDS)})\n"
+        return
+
+    with THREAD_BUDGET.run() as cores:
+        yield from _segment_steps(in_dir, out_mask_dir, out_only_dir, out_palette_dir, csv_out, cores,
+                                  write if fused else None, new_only)
+
+
+def _segment_steps(in_dir, out_mask_dir, out_only_dir, out_palette_dir, csv_out, cores: int, fused_write=None,
+                   new_only=False):
     in_dir = Path(in_dir)
     out_mask_dir = Path(out_mask_dir)
     out_only_dir = Path(out_only_dir)
     out_palette_dir = Path(out_palette_dir)
     csv_out = Path(csv_out)
 
-    if not in_dir.exists():
+    if not in_dir.exists() and not has_packed(in_dir.parent):
         yield f"[ERROR] Input directory does not exist: {in_dir}\n"
         return
 
-    # Collect image files
-    imgs = [p for p in in_dir.iterdir() if p.suffix.lower() in {".jpg", ".jpeg", ".png", ".bmp"}]
+    # Collect images (files in in_dir and packed images)
+    artifacts = Artifacts(in_dir, out_mask_dir, out_only_dir, out_palette_dir)
+    imgs = artifacts.image_ids()
     total_imgs = len(imgs)
+    rank = image_rank(in_dir.parent / "csv" / "images_meta.csv")
+    imgs = order_ids(imgs, rank)
 
     if not imgs:
         yield f"[WARN] No image files found in {in_dir}.\n"
@@ -172,45 +843,57 @@ def _segment_pipeline(in_dir: Path, out_mask_dir: Path, out_only_dir: Path, out_
     ensure_dirs(out_mask_dir, out_only_dir, out_palette_dir, csv_out.parent)
     yield f"[INFO] Found {total_imgs} images. Starting pipeline...\n"
 
-    # ================= Step 1: Semantic segmentation =================
-    need_infer = any(not (out_mask_dir / f\"{p.stem}_building.png\").exists() for p in imgs)
-
-    if need_infer:
-        device = "cuda:0" if torch.cuda.is_available() else "cpu"
-        yield f"[INFO] Loading SegFormer model (Device: {device})...\n"
-
-        try:
-            register_all_modules(init_default_scope=False)
-            ckpt = find_ckpt()
-            if ckpt is None:
-                yield f"[ERROR] Checkpoint not found: {CKPT_GLOB}\n"
-                return
-
-            model = init_model(str(CFG_PATH), ckpt, device=device)
-            classes = model.dataset_meta.get("classes")
-            building_ids = pick_building_ids(classes) if classes else [1]
+    new_ids = None
+    if new_only:
+        new_csv = in_dir.parent / "csv" / NEW_CSV_NAME
+        if new_csv.exists():
+            new_ids = _read_csv_ids(new_csv)
+            yield f"[INFO] Segmenting only the {sum(i in new_ids for i in imgs)} new images ({NEW_CSV_NAME}).\n"
+        else:
+            yield f"[WARN] {NEW_CSV_NAME} not found, segmenting all images.\n"
+
+    if fused_write is not None:
+        yield from _segment_fused(artifacts, imgs, csv_out, fused_write, new_ids)
+        return
 
-            yield "[INFO] Model loaded. Starting [Step 1/3] semantic segmentation...\n"
+    if new_ids is not None:
+        imgs = [img_id for img_id in imgs if img_id in new_ids]
+        total_imgs = len(imgs)
 
-            # --- Step 1 loop ---
-            for i, p in enumerate(imgs):
-                out_path = out_mask_dir / f"{p.stem}_building.png"
+    # ================= Step 1: Semantic segmentation =================
+    todo = [img_id for img_id in imgs if not artifacts.has_mask(img_id)]
+    workers, threads = (1, cores) if pick_device().startswith("cuda") else plan_workers(len(todo), cores)
 
-                # Progress log, e.g. [Step 1/3] (1/33) Segmenting: 12345.jpg ...
-                yield f"[INFO] [Step 1/3] ({i+1}/{total_imgs}) Segmenting: {p.name} ...\n"
+    if todo and workers > 1:
+        yield (f"[INFO] Starting [Step 1/3] semantic segmentation on {workers} worker processes x "
+               f"{threads} threads ({cores} cores)...\n")
+        try:
+            yield from _segment_step1_sharded(artifacts, todo, total_imgs, workers, threads)
+        except Exception as e:
+            yield f"[ERROR] Segmentation inference failed: {e}\n"
+            return
+        yield "[SUCCESS] ✅ Step 1 completed: semantic segmentation done.\n"
 
-                if out_path.exists():
-                    continue
+    elif todo:
+        if not MODEL.loaded:
+            yield f"[INFO] Loading SegFormer model (Device: {pick_device()})...\n"
 
-                img_bgr = cv2.imread(str(p))
-                if img_bgr is None:
-                    continue
+        try:
+            try:
+                loaded_now = MODEL.acquire()
+            except FileNotFoundError as e:
+                yield f"[ERROR] {e}\n"
+                return
 
-                img_rgb = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2RGB)
-                result = inference_model(model, img_rgb)
-                seg = result.pred_sem_seg.data.squeeze().cpu().numpy().astype(np.int32)
-                mask255 = (np.isin(seg, building_ids)).astype(np.uint8) * 255
-                cv2.imwrite(str(out_path), mask255)
+            try:
+                if loaded_now:
+                    yield f"[INFO] Model loaded ({MODEL.describe()}). Starting [Step 1/3] semantic segmentation...\n"
+                else:
+                    yield (f"[INFO] Using resident SegFormer model ({MODEL.describe()}). "
+                           "Starting [Step 1/3] semantic segmentation...\n")
+                yield from _segment_step1(artifacts, imgs, total_imgs)
+            finally:
+                MODEL.release()
 
             yield "[SUCCESS] ✅ Step 1 completed: semantic segmentation done.\n"
 
@@ -223,31 +906,28 @@ def _segment_pipeline(in_dir: Path, out_mask_dir: Path, out_only_dir: Path, out_
     # ================= Step 2: Shadow removal =================
     yield "[INFO] Starting [Step 2/3] shadow removal and alpha masking...\n"
     count = 0
-    for i, p in enumerate(imgs):
-        out_path = out_only_dir / f"{p.stem}_building_shadowfree.png"
+    for i, img_id in enumerate(imgs):
+        yield f"[INFO] [Step 2/3] ({i+1}/{total_imgs}) Removing shadow: {artifacts.image_name(img_id)} ...\n"
 
-        yield f"[INFO] [Step 2/3] ({i+1}/{total_imgs}) Removing shadow: {p.name} ...\n"
-
-        if out_path.exists():
+        if artifacts.has_rgba(img_id):
             count += 1
             continue
 
-        mask_path = out_mask_dir / f"{p.stem}_building.png"
-        if not mask_path.exists():
+        if not artifacts.has_mask(img_id):
             continue
 
-        mask255 = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
-        img_bgr = cv2.imread(str(p))
+        mask255 = artifacts.read_mask(img_id)
+        img_bgr = artifacts.read_image(img_id)
         if mask255 is None or img_bgr is None:
             continue
 
-        save_building_only_shadowfree(img_bgr, mask255, out_path)
+        artifacts.write_rgba(img_id, img_bgr, mask255)
         count += 1
 
     yield f"[SUCCESS] ✅ Step 2 completed. Generated {count} transparent PNGs.\n"
 
     # ================= Step 3: Color extraction =================
-    files = sorted(out_only_dir.glob("*.png"))
+    files = order_ids(artifacts.rgba_ids(), rank)
     total_files = len(files)
 
     if not files:
@@ -256,35 +936,372 @@ def _segment_pipeline(in_dir: Path, out_mask_dir: Path, out_only_dir: Path, out_
 
     yield "[INFO] Starting [Step 3/3] dominant color extraction and palette generation...\n"
 
+    previous_rows = load_color_rows(csv_out) if REUSE_COLOR_ROWS else {}
+    reused = 0
+
     with csv_out.open("w", newline="", encoding="utf-8") as fcsv:
         writer = csv.writer(fcsv)
         writer.writerow(["file", "palette_rgb", "ratios"])
 
-        for i, fp in enumerate(files):
-            yield f"[INFO] [Step 3/3] ({i+1}/{total_files}) Extracting colors: {fp.name} ...\n"
+        for i, img_id in enumerate(files):
+            prev = previous_rows.get(rgba_name(img_id))
+            if prev is not None and artifacts.has_palette(img_id):
+                writer.writerow(prev)
+                reused += 1
+                continue
+
+            yield f"[INFO] [Step 3/3] ({i+1}/{total_files}) Extracting colors: {rgba_name(img_id)} ...\n"
+
+            row = extract_colors(img_id, artifacts)
+            if row is not None:
+                writer.writerow(row)
+
+    if reused:
+        yield f"[INFO] Reused {reused} color rows from the previous run.\n"
+    yield "[SUCCESS] ✅ Step 3 completed. CSV saved.\n"
+
+
+def _segment_step1(artifacts: Artifacts, imgs: list, total_imgs: int):
+    """Step 1 loop with the resident model: loader thread decodes + preprocesses, batches by input size."""
+    model, building_ids, pipeline = MODEL.model, MODEL.building_ids, MODEL.get_pipeline()
+
+    def load(img_id):
+        if artifacts.has_mask(img_id):
+            return None
+        img_bgr = artifacts.read_image(img_id)
+        return None if img_bgr is None else preprocess_image(pipeline, img_bgr)
+
+    def flush(bucket):
+        masks = segment_batch(model, building_ids, [data for _, data in bucket])
+        for (img_id, _), mask255 in zip(bucket, masks):
+            artifacts.write_mask(img_id, mask255)
+        bucket.clear()
+
+    buckets = {}
+    for i, (img_id, data) in enumerate(prefetch(imgs, load)):
+        # Progress log, e.g. [Step 1/3] (1/33) Segmenting: 12345.jpg ...
+        yield f"[INFO] [Step 1/3] ({i+1}/{total_imgs}) Segmenting: {artifacts.image_name(img_id)} ...\n"
+
+        if data is None:
+            continue  # mask exists or image unreadable
+
+        bucket = buckets.setdefault(tuple(data["inputs"].shape), [])
+        bucket.append((img_id, data))
+        if len(bucket) >= max(1, INFER_BATCH_SIZE):
+            flush(bucket)
+
+    for bucket in buckets.values():
+        if bucket:
+            flush(bucket)
+
+
+def _shard_init(settings: dict, threads: int, ready=None):
+    """Worker process start: same settings as the parent, `threads` threads, resident model."""
+    global ONNX_THREADS
+    globals().update(settings)
+    ONNX_THREADS = threads
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    threadpool_limits(limits=threads)
+    MODEL.acquire()
+    if ready is not None:
+        ready.put(os.getpid())
+
+
+def _shard_segment(items: list) -> list:
+    """Worker: (id, JPEG bytes) -> (id, packed mask, height, width); mask None if undecodable."""
+    pipeline = MODEL.get_pipeline()
+    out = []
+    buckets = {}
+    for img_id, blob in items:
+        img_bgr = cv2.imdecode(np.frombuffer(blob, np.uint8), cv2.IMREAD_COLOR) if blob else None
+        if img_bgr is None:
+            out.append((img_id, None, 0, 0))
+            continue
+        data = preprocess_image(pipeline, img_bgr)
+        buckets.setdefault(tuple(data["inputs"].shape), []).append((img_id, data))
+
+    for bucket in buckets.values():
+        masks = segment_batch(MODEL.model, MODEL.building_ids, [data for _, data in bucket])
+        for (img_id, _), mask255 in zip(bucket, masks):
+            out.append((img_id, encode_mask(mask255), mask255.shape[0], mask255.shape[1]))
+    return out
+
+
+@contextmanager
+def _shard_pool(workers: int, threads: int, warm: bool = False):
+    """Spawned Step 1 workers; with warm=True, returns once every worker has its model loaded."""
+    model_path()    # fail here, not as a broken pool
+    settings = {name: globals()[name] for name in _WORKER_SETTINGS}
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Queue() if warm else None
+    with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_shard_init,
+                             initargs=(settings, threads, ready)) as pool:
+        if warm:
+            deadline = time.monotonic() + WORKER_START_TIMEOUT_S
+            try:
+                # Each submit without an idle worker starts one more process; a failed start
+                # (e.g. the model load in _shard_init) breaks the pool and raises here
+                for fut in [pool.submit(_shard_segment, []) for _ in range(workers)]:
+                    fut.result(timeout=max(0.0, deadline - time.monotonic()))
+                for _ in range(workers):
+                    ready.get(timeout=max(0.0, deadline - time.monotonic()))
+            except (FuturesTimeout, queue.Empty):
+                _stop_pool(pool)
+                raise TimeoutError(f"Step 1 workers not ready after {WORKER_START_TIMEOUT_S}s")
+            except BaseException:
+                _stop_pool(pool)
+                raise
+        yield pool
+
+
+def _stop_pool(pool: ProcessPoolExecutor):
+    """Drop queued tasks and kill the workers, so leaving the pool does not wait for a stuck one."""
+    procs = list((pool._processes or {}).values())     # shutdown() drops the list
+    pool.shutdown(wait=False, cancel_futures=True)
+    for proc in procs:
+        proc.terminate()
+
+
+def _segment_step1_sharded(artifacts: Artifacts, todo: list, total_imgs: int, workers: int, threads: int,
+                           pool=None):
+    """
+    Step 1 on `workers` processes: the parent reads the images and writes the
+    masks (so the packed store has one writer), workers get INFER_BATCH_SIZE
+    images per task, at most two tasks ahead each. Runs on `pool` if given
+    (see _shard_pool), else on a new one.
+    """
+    if pool is None:
+        with _shard_pool(workers, threads) as pool:
+            yield from _segment_step1_sharded(artifacts, todo, total_imgs, workers, threads, pool)
+        return
+
+    chunk = max(1, INFER_BATCH_SIZE)
+    starts = iter(range(0, len(todo), chunk))
+    done = total_imgs - len(todo)
+    pending = set()
+
+    def submit():
+        start = next(starts, None)
+        if start is not None:
+            items = [(img_id, artifacts.read_image_bytes(img_id)) for img_id in todo[start:start + chunk]]
+            pending.add(pool.submit(_shard_segment, items))
+
+    for _ in range(2 * workers):
+        submit()
+
+    while pending:
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for fut in finished:
+            pending.discard(fut)
+            for img_id, blob, h, w in fut.result():
+                done += 1
+                yield f"[INFO] [Step 1/3] ({done}/{total_imgs}) Segmented: {artifacts.image_name(img_id)}\n"
+                if blob is not None:
+                    artifacts.write_mask(img_id, decode_mask(blob, h, w))
+            submit()
+
+
+def _segment_fused(artifacts: Artifacts, imgs: list, csv_out: Path, write: tuple, new_ids=None):
+    """
+    Steps 1-3 in one pass per image: the loader thread decodes each image once
+    (and preprocesses it if it has no mask yet), inference is batched as in
+    Step 1, and shadow removal + colors run on the arrays in memory.
+    Images outside new_ids (if given) keep their previous color row.
+    """
+    total_imgs = len(imgs)
+    previous_rows = load_color_rows(csv_out) if REUSE_COLOR_ROWS else {}
+    done = {img_id for img_id in imgs
+            if (rgba_name(img_id) in previous_rows and artifacts.has_outputs(img_id, write))
+            or (new_ids is not None and img_id not in new_ids)}
+    need_infer = any(img_id not in done and not artifacts.has_mask(img_id) for img_id in imgs)
+    written = ", ".join(write) or "color_summary.csv only"
+    yield f"[INFO] Fused pipeline: segmentation, shadow removal and colors per image (writing: {written}).\n"
+
+    rows = {}
+    stats = {"reused": 0, "inferred": 0}
+
+    pipeline = None
+    with ExitStack() as stack:
+        def use_model():
+            """Enter the resident model (loading it if needed); pipeline stays None if it is missing."""
+            nonlocal pipeline
+            if not MODEL.loaded:
+                yield f"[INFO] Loading SegFormer model (Device: {pick_device()})...\n"
+            try:
+                stack.enter_context(MODEL.use())
+            except FileNotFoundError as e:
+                yield f"[ERROR] {e}\n"
+                return
+            yield f"[INFO] SegFormer model ready ({MODEL.describe()}).\n"
+            pipeline = MODEL.get_pipeline()
+
+        if need_infer:
+            yield from use_model()
+            if pipeline is None:
+                return
+
+        def load(img_id):
+            if img_id in done:
+                return None
+            img_bgr = artifacts.read_image(img_id)
+            if img_bgr is None:
+                return None
+            mask255 = artifacts.read_mask(img_id) if artifacts.has_mask(img_id) else None
+            # An unreadable mask counts as missing; without the model yet, the main loop preprocesses
+            data = preprocess_image(pipeline, img_bgr) if mask255 is None and pipeline is not None else None
+            return img_bgr, mask255, data
+
+        def flush(bucket):
+            masks = segment_batch(MODEL.model, MODEL.building_ids, [data for _, _, data in bucket])
+            for (img_id, img_bgr, _), mask255 in zip(bucket, masks):
+                if "masks" in write:
+                    artifacts.write_mask(img_id, mask255)
+                rows[img_id] = colors_in_memory(img_id, img_bgr, mask255, artifacts, write)
+            stats["inferred"] += len(bucket)
+            bucket.clear()
+
+        buckets = {}
+        for i, (img_id, item) in enumerate(prefetch(imgs, load)):
+            yield f"[INFO] [Fused] ({i+1}/{total_imgs}) Processing: {artifacts.image_name(img_id)} ...\n"
+            if img_id in done:
+                prev = previous_rows.get(rgba_name(img_id))
+                if prev is not None:
+                    rows[img_id] = prev
+                    stats["reused"] += 1
+                continue
+            if item is None:
+                continue  # unreadable image
 
-            bgr, alpha = load_rgba(fp)
-            if bgr is None:
+            img_bgr, mask255, data = item
+            if mask255 is not None:
+                rows[img_id] = colors_in_memory(img_id, img_bgr, mask255, artifacts, write)
                 continue
 
-            colors = get_dominant_colors(bgr, alpha, k=TOPK)
-            bgra = cv2.cvtColor(bgr, cv2.COLOR_BGR2BGRA)
-            bgra[alpha == 0, 3] = 0
-            out_img = compose_with_palette_keep_alpha(bgra, colors, PALETTE_W)
+            if data is None:
+                yield f"[WARN] Unreadable mask, segmenting again: {artifacts.image_name(img_id)}\n"
+                if pipeline is None:
+                    yield from use_model()
+                    if pipeline is None:
+                        return
+                data = preprocess_image(pipeline, img_bgr)
 
-            out_name = f"{fp.stem.replace('_building_shadowfree', '')}_palette.png"
-            cv2.imwrite(str(out_palette_dir / out_name), out_img)
+            bucket = buckets.setdefault(tuple(data["inputs"].shape), [])
+            bucket.append((img_id, img_bgr, data))
+            if len(bucket) >= max(1, INFER_BATCH_SIZE):
+                flush(bucket)
 
-            writer.writerow([fp.name, [c for c, _ in colors], [r for _, r in colors]])
+        for bucket in buckets.values():
+            if bucket:
+                flush(bucket)
 
-    yield "[SUCCESS] ✅ Step 3 completed. CSV saved.\n"
+    with csv_out.open("w", newline="", encoding="utf-8") as fcsv:
+        writer = csv.writer(fcsv)
+        writer.writerow(["file", "palette_rgb", "ratios"])
+        writer.writerows(rows[img_id] for img_id in imgs if img_id in rows)
+
+    if stats["reused"]:
+        yield f"[INFO] Reused {stats['reused']} color rows from the previous run.\n"
+    yield (f"[SUCCESS] ✅ Fused pipeline completed: {len(rows)} color rows "
+           f"({stats['inferred']} images segmented). CSV saved.\n")
+
+
+class StreamingSegmenter:
+    """
+    Steps 1-3 for one image at a time (fetch_pipeline hands over each image
+    as soon as it has been written). Outputs that already exist are reused,
+    like in _segment_pipeline; color_summary.csv is written by finish().
+    """
+
+    def __init__(self, project_dir):
+        data_dir = Path(project_dir) / "data"
+        self.artifacts = Artifacts(data_dir / "images", data_dir / "masks", data_dir / "building_rgba",
+                                   data_dir / "palettes")
+        self.csv_out = data_dir / "csv" / "color_summary.csv"
+        ensure_dirs(self.artifacts.out_mask_dir, self.artifacts.out_only_dir, self.artifacts.out_palette_dir,
+                    self.csv_out.parent)
+
+        self.previous_rows = load_color_rows(self.csv_out) if REUSE_COLOR_ROWS else {}
+        self.rows = {}
+        self.model = None
+        self.building_ids = None
+        self._budget = ExitStack()
+
+    def load_model(self) -> bool:
+        """Use the resident model (loading it if needed) within THREAD_BUDGET; release both with close()."""
+        self._budget.enter_context(THREAD_BUDGET.run())
+        loaded_now = MODEL.acquire()
+        self.model, self.building_ids = MODEL.model, MODEL.building_ids
+        return loaded_now
+
+    def close(self):
+        if self.model is not None:
+            self.model = self.building_ids = None
+            MODEL.release()
+        self._budget.close()
+
+    def process(self, img_path: Path) -> bool:
+        """Mask, shadow-free cut-out and palette of one image. Returns False if it produced no color row."""
+        art = self.artifacts
+        img_id = Path(img_path).stem
+        name = rgba_name(img_id)
+
+        prev = self.previous_rows.get(name)
+        if prev is not None and art.has_rgba(img_id) and art.has_palette(img_id):
+            self.rows[name] = prev
+            return True
+
+        if art.has_rgba(img_id):
+            row = extract_colors(img_id, art)
+        else:
+            img_bgr = art.read_image(img_id)
+            if img_bgr is None:
+                return False
+            mask255 = art.read_mask(img_id) if art.has_mask(img_id) else None
+            if mask255 is None:
+                if self.model is None:
+                    return False
+                mask255 = segment_mask(self.model, self.building_ids, img_bgr, MODEL.get_pipeline())
+                art.write_mask(img_id, mask255)
+            row = colors_in_memory(img_id, img_bgr, mask255, art)
+        if row is None:
+            return False
+        self.rows[name] = row
+        return True
+
+    def finish(self) -> int:
+        """
+        Write color_summary.csv for all transparent PNGs, like a batch Step 3:
+        rows of this run, reused previous rows, and colors of any PNG that has neither.
+        Returns the row count.
+        """
+        # Ranked here: images_meta.csv is still being written while images stream in
+        rank = image_rank(self.csv_out.parent / "images_meta.csv")
+        rows = []
+        for img_id in order_ids(self.artifacts.rgba_ids(), rank):
+            row = self.rows.get(rgba_name(img_id))
+            prev = self.previous_rows.get(rgba_name(img_id))
+            if row is None and prev is not None and self.artifacts.has_palette(img_id):
+                row = prev
+            if row is None:
+                row = extract_colors(img_id, self.artifacts)
+            if row is not None:
+                rows.append(row)
+
+        with self.csv_out.open("w", newline="", encoding="utf-8") as fcsv:
+            writer = csv.writer(fcsv)
+            writer.writerow(["file", "palette_rgb", "ratios"])
+            writer.writerows(rows)
+        return len(rows)
 
 
 # =========================================================
 
-def run_segment_building(project_dir):
+def run_segment_building(project_dir, fused=None, artifacts=None, new_only=False):
     """
     FastAPI entry point (Generator).
+    fused / artifacts: override FUSED_PIPELINE / FUSED_ARTIFACTS for this run.
+    new_only: only segment the images of the last refresh (images_meta_new.csv).
     """
     project_dir = Path(project_dir)
     in_dir = project_dir / "data" / "images"
@@ -294,7 +1311,8 @@ def run_segment_building(project_dir):
     csv_out = project_dir / "data" / "csv" / "color_summary.csv"
 
     # Return the iterator from _segment_pipeline
-    return _segment_pipeline(in_dir, out_mask_dir, out_only_dir, out_palette_dir, csv_out)
+    return _segment_pipeline(in_dir, out_mask_dir, out_only_dir, out_palette_dir, csv_out,
+                             fused=fused, artifacts=artifacts, new_only=new_only)
 
 
 def main():